@@ -0,0 +1,121 @@
+"""Baseline schema
+
+Creates the schema on an empty database, and brings databases created by the old
+create_all/db_migration startup path up to the same shape, so both can be stamped
+at this revision and follow later migrations.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+def _create_index(inspector, table, name, columns, unique=False):
+    if name not in {index["name"] for index in inspector.get_indexes(table)}:
+        op.create_index(name, table, columns, unique=unique)
+
+def _add_missing_columns(inspector, table, columns):
+    existing = {column["name"] for column in inspector.get_columns(table)}
+    missing = [column for column in columns if column.name not in existing]
+    if missing:
+        with op.batch_alter_table(table) as batch:
+            for column in missing:
+                batch.add_column(column)
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+
+    if "users" not in tables:
+        op.create_table(
+            "users",
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("email", sa.String, nullable=True),
+            sa.Column("hashed_password", sa.String, nullable=True),
+            sa.Column("is_active", sa.Boolean),
+            sa.Column("rate_limit_rpm", sa.Integer, nullable=True),
+            sa.Column("rate_limit_rpd", sa.Integer, nullable=True),
+            sa.Column("token_limit_tpm", sa.Integer, nullable=True),
+        )
+    else:
+        _add_missing_columns(inspector, "users", [
+            sa.Column("rate_limit_rpm", sa.Integer, nullable=True),
+            sa.Column("rate_limit_rpd", sa.Integer, nullable=True),
+            sa.Column("token_limit_tpm", sa.Integer, nullable=True),
+        ])
+    _create_index(inspector, "users", "ix_users_id", ["id"])
+    _create_index(inspector, "users", "ix_users_email", ["email"], unique=True)
+
+    if "chat_sessions" not in tables:
+        op.create_table(
+            "chat_sessions",
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("user_id", sa.Integer, sa.ForeignKey("users.id"), nullable=True),
+            sa.Column("session_token", sa.String),
+            sa.Column("created_at", sa.DateTime),
+            sa.Column("updated_at", sa.DateTime),
+            sa.Column("is_active", sa.Boolean),
+            sa.Column("rate_limit_rpm", sa.Integer),
+            sa.Column("rate_limit_rpd", sa.Integer),
+            sa.Column("total_requests_limit", sa.Integer, nullable=True),
+            sa.Column("total_token_limit", sa.Integer, nullable=True),
+            sa.Column("plan_type", sa.String),
+            sa.Column("generation_profile", sa.String, nullable=True),
+            sa.Column("request_count", sa.Integer),
+            sa.Column("token_count", sa.Integer),
+        )
+    else:
+        _add_missing_columns(inspector, "chat_sessions", [
+            sa.Column("total_token_limit", sa.Integer, nullable=True),
+            sa.Column("generation_profile", sa.String, nullable=True),
+        ])
+    _create_index(inspector, "chat_sessions", "ix_chat_sessions_id", ["id"])
+    _create_index(inspector, "chat_sessions", "ix_chat_sessions_session_token", ["session_token"], unique=True)
+
+    if "chat_messages" not in tables:
+        op.create_table(
+            "chat_messages",
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("session_id", sa.Integer, sa.ForeignKey("chat_sessions.id")),
+            sa.Column("role", sa.String),
+            sa.Column("content", sa.Text),
+            sa.Column("created_at", sa.DateTime),
+            sa.Column("token_count", sa.Integer, nullable=True),
+            sa.Column("event_id", sa.String, nullable=True),
+        )
+    else:
+        _add_missing_columns(inspector, "chat_messages", [
+            sa.Column("token_count", sa.Integer, nullable=True),
+            sa.Column("event_id", sa.String, nullable=True),
+        ])
+    _create_index(inspector, "chat_messages", "ix_chat_messages_id", ["id"])
+    _create_index(inspector, "chat_messages", "ix_chat_messages_event_id", ["event_id"], unique=True)
+    _create_index(inspector, "chat_messages", "ix_chat_messages_session_id_id", ["session_id", "id"])
+
+    if "archived_sessions" not in tables:
+        op.create_table(
+            "archived_sessions",
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("session_id", sa.Integer, sa.ForeignKey("chat_sessions.id")),
+            sa.Column("segment", sa.String),
+            sa.Column("offset", sa.BigInteger),
+            sa.Column("length", sa.Integer),
+            sa.Column("checksum", sa.BigInteger),
+            sa.Column("message_count", sa.Integer),
+            sa.Column("last_message_id", sa.Integer),
+            sa.Column("archived_at", sa.DateTime),
+        )
+    _create_index(inspector, "archived_sessions", "ix_archived_sessions_id", ["id"])
+    _create_index(inspector, "archived_sessions", "ix_archived_sessions_session_id", ["session_id"])
+
+def downgrade():
+    op.drop_table("archived_sessions")
+    op.drop_table("chat_messages")
+    op.drop_table("chat_sessions")
+    op.drop_table("users")
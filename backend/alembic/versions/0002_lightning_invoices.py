@@ -0,0 +1,38 @@
+"""Lightning invoices
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        "lightning_invoices",
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("payment_hash", sa.String),
+        sa.Column("payment_request", sa.Text),
+        sa.Column("session_token", sa.String),
+        sa.Column("plan_type", sa.String),
+        sa.Column("quantity", sa.Integer),
+        sa.Column("amount_sats", sa.Integer),
+        sa.Column("generation_profile", sa.String, nullable=True),
+        sa.Column("state", sa.String),
+        sa.Column("created_at", sa.DateTime),
+        sa.Column("expires_at", sa.DateTime),
+        sa.Column("settled_at", sa.DateTime, nullable=True),
+        sa.Column("settle_index", sa.BigInteger, nullable=True),
+        sa.Column("amount_paid_sats", sa.Integer, nullable=True),
+    )
+    op.create_index("ix_lightning_invoices_id", "lightning_invoices", ["id"])
+    op.create_index("ix_lightning_invoices_payment_hash", "lightning_invoices", ["payment_hash"], unique=True)
+    op.create_index("ix_lightning_invoices_session_token", "lightning_invoices", ["session_token"])
+
+def downgrade():
+    op.drop_table("lightning_invoices")
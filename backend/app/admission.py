@@ -0,0 +1,220 @@
+import math
+import time
+import uuid
+import random
+import asyncio
+from contextlib import contextmanager, asynccontextmanager
+from typing import Optional
+
+from fastapi import HTTPException, status
+
+from app.core import settings, redis_client, async_redis_client, run_pipeline, run_pipeline_async, redis_call, redis_call_async
+from app.data import ChatSession
+from app.metrics import Metrics
+
+ADMISSION_SCRIPT = """
+local now_t = redis.call('TIME')
+local now = tonumber(now_t[1]) * 1000 + math.floor(tonumber(now_t[2]) / 1000)
+local ticket = ARGV[1]
+local priority = tonumber(ARGV[2])
+local max_concurrency = tonumber(ARGV[3])
+local queue_size = tonumber(ARGV[4])
+local waiter_ttl = tonumber(ARGV[5])
+local lease = tonumber(ARGV[6])
+local interval = tonumber(ARGV[7])
+local burst = tonumber(ARGV[8])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local gone = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now)
+if #gone > 0 then
+    redis.call('ZREM', KEYS[2], unpack(gone))
+    redis.call('ZREM', KEYS[3], unpack(gone))
+end
+
+local position = redis.call('ZRANK', KEYS[2], ticket)
+if not position then
+    local waiting = redis.call('ZCARD', KEYS[2])
+    if waiting >= queue_size then
+        return {-1, waiting, 0}
+    end
+    redis.call('ZADD', KEYS[2], string.format('%.0f', priority * 1e13 + now), ticket)
+    position = redis.call('ZRANK', KEYS[2], ticket)
+end
+redis.call('ZADD', KEYS[3], now + waiter_ttl, ticket)
+
+if position >= max_concurrency - redis.call('ZCARD', KEYS[1]) then
+    return {0, position, 0}
+end
+
+if interval > 0 then
+    local tat = tonumber(redis.call('GET', KEYS[4]))
+    if tat == nil or tat < now then
+        tat = now
+    end
+    local allow_at = tat + interval - burst * interval
+    if now < allow_at then
+        return {0, position, math.ceil(allow_at - now)}
+    end
+    redis.call('SET', KEYS[4], tostring(tat + interval), 'PX', math.ceil(tat + interval - now) + 1000)
+end
+
+redis.call('ZREM', KEYS[2], ticket)
+redis.call('ZREM', KEYS[3], ticket)
+redis.call('ZADD', KEYS[1], now + lease, ticket)
+return {1, position, 0}
+"""
+
+class AdmissionControl:
+    """
+    Cluster-wide governor in front of the model call.
+    At most ADMISSION_MAX_CONCURRENCY calls hold a slot at once, and with ADMISSION_MAX_RPS set
+    slots are handed out at that rate (GCRA, ADMISSION_BURST deep). Callers that do not get a
+    slot wait in a Redis queue ordered by ADMISSION_PLAN_PRIORITY, then arrival, and poll until
+    they reach its head. A full queue or a wait longer than ADMISSION_QUEUE_TIMEOUT is answered
+    with 503 and Retry-After. Slots are leases, so a crashed worker cannot hold one forever, and
+    waiters that stop polling drop out after ADMISSION_WAITER_TTL. While Redis is unavailable
+    calls are admitted without the governor.
+    """
+
+    HOLDERS_KEY = "{admission}:holders"
+    QUEUE_KEY = "{admission}:queue"
+    WAITERS_KEY = "{admission}:waiters"
+    RATE_KEY = "{admission}:rate"
+    KEYS = [HOLDERS_KEY, QUEUE_KEY, WAITERS_KEY, RATE_KEY]
+
+    _admission_script = redis_client.register_script(ADMISSION_SCRIPT)
+    _async_admission_script = async_redis_client.register_script(ADMISSION_SCRIPT)
+
+    @staticmethod
+    def enabled() -> bool:
+        return settings.ADMISSION_CONTROL
+
+    @classmethod
+    def _args(cls, ticket: str, session: ChatSession) -> list:
+        interval = 1000 / settings.ADMISSION_MAX_RPS if settings.ADMISSION_MAX_RPS > 0 else 0
+        return [
+            ticket,
+            settings.ADMISSION_PLAN_PRIORITY.get(session.plan_type, 0),
+            settings.ADMISSION_MAX_CONCURRENCY,
+            settings.ADMISSION_QUEUE_SIZE,
+            int(settings.ADMISSION_WAITER_TTL * 1000),
+            int(settings.ADMISSION_LEASE * 1000),
+            interval,
+            max(settings.ADMISSION_BURST, 1),
+        ]
+
+    @staticmethod
+    def _retry_after(position: int) -> int:
+        """Seconds until a queue of this length has likely drained"""
+        if settings.ADMISSION_MAX_RPS > 0:
+            return max(1, math.ceil(position / settings.ADMISSION_MAX_RPS))
+        return 1
+
+    @classmethod
+    def _unavailable(cls, session: ChatSession, result: str, position: int) -> HTTPException:
+        Metrics.admission(session.plan_type, result)
+        detail = "Model capacity exhausted, too many requests waiting" if result == "queue_full" else "Timed out waiting for model capacity"
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=detail,
+            headers={"Retry-After": str(cls._retry_after(position))}
+        )
+
+    @staticmethod
+    def _poll_delay(wait_ms: int, remaining: float) -> float:
+        delay = max(wait_ms / 1000, settings.ADMISSION_POLL_INTERVAL) * random.uniform(0.8, 1.2)
+        return min(delay, remaining)
+
+    @classmethod
+    def acquire(cls, session: ChatSession) -> Optional[str]:
+        """Wait for a slot; returns the ticket to release, or None when admission control is off"""
+        if not cls.enabled():
+            return None
+
+        ticket = uuid.uuid4().hex
+        args = cls._args(ticket, session)
+        deadline = time.monotonic() + settings.ADMISSION_QUEUE_TIMEOUT
+
+        with Metrics.stage("admission"):
+            while True:
+                code, position, wait_ms = redis_call(
+                    lambda: cls._admission_script(keys=cls.KEYS, args=args),
+                    lambda: (1, 0, 0)
+                )
+                if code == 1:
+                    Metrics.admission(session.plan_type, "admitted")
+                    return ticket
+                if code == -1:
+                    raise cls._unavailable(session, "queue_full", position)
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    cls.release(ticket)
+                    raise cls._unavailable(session, "timeout", position)
+                time.sleep(cls._poll_delay(wait_ms, remaining))
+
+    @classmethod
+    async def acquire_async(cls, session: ChatSession) -> Optional[str]:
+        """Async variant of acquire"""
+        if not cls.enabled():
+            return None
+
+        ticket = uuid.uuid4().hex
+        args = cls._args(ticket, session)
+        deadline = time.monotonic() + settings.ADMISSION_QUEUE_TIMEOUT
+
+        with Metrics.stage("admission"):
+            while True:
+                code, position, wait_ms = await redis_call_async(
+                    lambda: cls._async_admission_script(keys=cls.KEYS, args=args),
+                    lambda: (1, 0, 0)
+                )
+                if code == 1:
+                    Metrics.admission(session.plan_type, "admitted")
+                    return ticket
+                if code == -1:
+                    raise cls._unavailable(session, "queue_full", position)
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    await cls.release_async(ticket)
+                    raise cls._unavailable(session, "timeout", position)
+                await asyncio.sleep(cls._poll_delay(wait_ms, remaining))
+
+    @classmethod
+    def _queue_release(cls, pipe, ticket: str):
+        pipe.zrem(cls.HOLDERS_KEY, ticket)
+        pipe.zrem(cls.QUEUE_KEY, ticket)
+        pipe.zrem(cls.WAITERS_KEY, ticket)
+
+    @classmethod
+    def release(cls, ticket: Optional[str]):
+        """Give back a slot, or leave the queue"""
+        if ticket is None:
+            return
+        redis_call(lambda: run_pipeline(lambda pipe: cls._queue_release(pipe, ticket)), lambda: None)
+
+    @classmethod
+    async def release_async(cls, ticket: Optional[str]):
+        """Async variant of release"""
+        if ticket is None:
+            return
+        await redis_call_async(lambda: run_pipeline_async(lambda pipe: cls._queue_release(pipe, ticket)), lambda: None)
+
+    @classmethod
+    @contextmanager
+    def admit(cls, session: ChatSession):
+        ticket = cls.acquire(session)
+        try:
+            yield ticket
+        finally:
+            cls.release(ticket)
+
+    @classmethod
+    @asynccontextmanager
+    async def admit_async(cls, session: ChatSession):
+        ticket = await cls.acquire_async(session)
+        try:
+            yield ticket
+        finally:
+            await cls.release_async(ticket)
@@ -1,77 +1,159 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import insert, select, update
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import time
-import google.generativeai as genai
-from typing import List, Optional, Dict, Any
+import asyncio
+import json
+import datetime
+from email.utils import format_datetime
+import logging
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
 
-from app.data import ChatSession, ChatMessage, Message, Session, SessionCreate, ApiLimitConfig, TokenLimitConfig, ChatRequest, ChatResponse, get_db
-from app.core import settings, get_session_token
-from app.redis import RedisTokenBucket
+from app.data import ChatSession, ChatMessage, User, LightningInvoice, Message, MessageBase, Session, SessionCreate, ApiLimitConfig, TokenLimitConfig, GenerationProfileConfig, GenerationProfile, ChatRequest, ChatResponse, SessionBatchCreate, SessionBatchTokens, SessionBatchUpdate, SessionBatch, UserCreate, UserLimitConfig, UserQuota, QuotaUsage, InvoiceCreate, Invoice, InvoiceStatus, get_db, get_async_db, AsyncSessionLocal
+from app.core import settings, get_session_token, RedisRateLimiter, RedisCircuit, redis_call, redis_call_async
+from app.redis import RedisTokenBucket, TokenBucketMissing
+from app.fallback import LocalLimiter
+from app.admission import AdmissionControl
+from app.idempotency import Idempotency, claim_idempotency_key
+from app.quota import Quota
+from app.cache import SessionCache, ResponseCache, get_request_session_cache
+from app.persistence import WriteBehind
+from app.usage import UsageReconciler
+from app.retention import Retention
+from app.lightning import LightningSettlement, MockLnd, get_backend
+from app.context import ConversationContext
+from app.models import ModelRegistry
+from app.tokenizer import Tokenizer
+from app.providers import get_provider
+from app.metrics import Metrics
 
-genai.configure(api_key=settings.GEMINI_API_KEY)
+STREAM_RESERVATION_BLOCK = 256
+
+logger = logging.getLogger(__name__)
 
 chat_router = APIRouter(prefix="/chat", tags=["chat"])
 session_router = APIRouter(prefix="/sessions", tags=["sessions"])
+quota_router = APIRouter(prefix="/quotas", tags=["quotas"])
+payment_router = APIRouter(prefix="/payments", tags=["payments"])
+
+def _request_count_update(session: ChatSession, delta: int = 1):
+    return update(ChatSession).where(ChatSession.id == session.id).values(
+        request_count=ChatSession.request_count + delta
+    )
+
+def _token_count_update(session: ChatSession):
+    return update(ChatSession).where(ChatSession.id == session.id).values(
+        token_count=session.token_count,
+        is_active=session.is_active
+    )
+
+def _deactivate_update(session: ChatSession):
+    return update(ChatSession).where(ChatSession.id == session.id).values(is_active=False)
+
+def _is_total_token_limit_error(error: HTTPException) -> bool:
+    return error.status_code == status.HTTP_429_TOO_MANY_REQUESTS and "Total token limit" in error.detail
+
+def _stored_token_count_query(session: ChatSession):
+    return select(ChatSession.token_count).where(ChatSession.id == session.id)
+
+def with_token_bucket(db: Session, session: ChatSession, operation):
+    """Run a token bucket script, recreating the bucket from chat_sessions if Redis lost it"""
+    try:
+        return operation()
+    except TokenBucketMissing:
+        token_count = max(db.execute(_stored_token_count_query(session)).scalar() or 0, session.token_count or 0)
+        RedisTokenBucket.initialize_token_bucket(session.session_token, session.total_token_limit, token_count)
+        return operation()
+
+async def with_token_bucket_async(db: AsyncSession, session: ChatSession, operation):
+    """Async variant of with_token_bucket"""
+    try:
+        return await operation()
+    except TokenBucketMissing:
+        token_count = max((await db.execute(_stored_token_count_query(session))).scalar() or 0, session.token_count or 0)
+        await RedisTokenBucket.initialize_token_bucket_async(session.session_token, session.total_token_limit, token_count)
+        return await operation()
+
+def check_local_rate_limit(session: ChatSession):
+    """Per-session limits kept in process while Redis is unavailable; user and global quotas need Redis"""
+    if session.plan_type != 'request':
+        return None
+    return LocalLimiter.check_rate_limit(session)
+
+def refund_local_rate_limit(session: ChatSession):
+    if session.plan_type == 'request':
+        LocalLimiter.refund_request(session)
 
 class RateLimiter:
     """Custom rate limiter that uses the database and Redis"""
     
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, request_cache: Optional[dict] = None):
         self.db = db
+        self.request_cache = request_cache
+        self.rate_limit = None
     
     def check_rate_limit(self, session_token: str):
         """Check if a request is within rate limits"""
-        from app.core import RedisRateLimiter
+        with Metrics.stage("session_lookup"):
+            session = SessionCache.get(self.db, session_token, self.request_cache)
         
-        session = self.db.query(ChatSession).filter(
-            ChatSession.session_token == session_token,
-            ChatSession.is_active == True
-        ).first()
-        
-        if not session:
+        if not session or not session.is_active:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Session not found or inactive"
             )
         
-        if session.total_requests_limit is not None and session.request_count >= session.total_requests_limit:
-            session.is_active = False
-            self.db.commit()
+        with Metrics.stage("rate_limit"):
+            request_count = SessionCache.incr_request_count(self.db, session)
+            if request_count is None:
+                Metrics.rate_limited("total_requests")
+                self.deactivate(session)
+                
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Total request limit reached. Session terminated."
+                )
             
-            raise HTTPException(
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail="Total request limit reached. Session terminated."
-            )
-        
-        if session.plan_type == 'request':
-            RedisRateLimiter.check_rate_limit(
-                session_token=session_token,
-                rpm_limit=session.rate_limit_rpm,
-                rpd_limit=session.rate_limit_rpd,
-                plan_type=session.plan_type
-            )
+            user_limits = Quota.user_limits(self.db, session.user_id)
+            if Quota.applies(session, user_limits):
+                try:
+                    self.rate_limit = redis_call(
+                        lambda: Quota.check_rate_limit(session, user_limits),
+                        lambda: check_local_rate_limit(session)
+                    )
+                except HTTPException:
+                    SessionCache.incr_request_count(self.db, session, delta=-1)
+                    raise
         
-        session.request_count += 1
-        self.db.commit()
+        session.request_count = request_count
+        if not (WriteBehind.enabled() and WriteBehind.append_usage(session, request_count=request_count)):
+            with Metrics.stage("db_commit"):
+                self.db.execute(_request_count_update(session))
+                self.db.commit()
         
         return session
 
+    def deactivate(self, session: ChatSession):
+        session.is_active = False
+        self.db.execute(_deactivate_update(session))
+        self.db.commit()
+        SessionCache.invalidate(session.session_token)
+
 class TokenLimiter:
     """Custom token limiter that uses Redis for the token bucket algorithm"""
     
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, request_cache: Optional[dict] = None):
         self.db = db
+        self.request_cache = request_cache
     
     def check_token_limit(self, session_token: str, tokens_to_use: int):
         """Check if token usage is within limits and track usage"""
-
-        session = self.db.query(ChatSession).filter(
-            ChatSession.session_token == session_token,
-            ChatSession.is_active == True
-        ).first()
+        session = SessionCache.get(self.db, session_token, self.request_cache)
         
-        if not session:
+        if not session or not session.is_active:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Session not found or inactive"
@@ -80,162 +162,983 @@ class TokenLimiter:
         if session.plan_type != 'token':
             return session
         
+        return self.charge_tokens(session, tokens_to_use)
+
+    def charge_tokens(self, session: ChatSession, tokens_to_use: int):
+        """Consume tokens outright, for usage that did not go through a reservation"""
+        user_limits = Quota.user_limits(self.db, session.user_id)
         try:
-            total_tokens_used = RedisTokenBucket.check_token_limit(
-                session_token=session_token,
-                tokens_to_use=tokens_to_use
+            total_tokens_used = redis_call(
+                lambda: with_token_bucket(self.db, session, lambda: RedisTokenBucket.check_token_limit(
+                    session_token=session.session_token,
+                    tokens_to_use=tokens_to_use,
+                    quota_keys=Quota.token_keys(session, user_limits)
+                )),
+                lambda: LocalLimiter.charge_tokens(session, tokens_to_use)
             )
-        
-            session.token_count = total_tokens_used
+        except HTTPException as e:
+            self._deactivate_if_exhausted(session, e)
+            raise
+
+        redis_call(lambda: Quota.charge_tokens(session, user_limits, tokens_to_use), lambda: None)
+        self._record_usage(session, total_tokens_used)
+
+        return session
+
+    def reserve_tokens(self, session: ChatSession, estimate: int, min_tokens: int):
+        """Reserve tokens for an upcoming model call, before any upstream cost is incurred"""
+        try:
+            with Metrics.stage("token_reserve"):
+                return redis_call(
+                    lambda: with_token_bucket(self.db, session, lambda: RedisTokenBucket.reserve_tokens(
+                        session_token=session.session_token,
+                        estimate=estimate,
+                        min_tokens=min_tokens
+                    )),
+                    lambda: LocalLimiter.reserve_tokens(session, estimate, min_tokens)
+                )
+        except HTTPException as e:
+            self._deactivate_if_exhausted(session, e)
+            raise
+
+    def settle_tokens(self, session: ChatSession, reservation: dict, actual_tokens: int):
+        """Settle a reservation to the actual usage and record it on the session"""
+        with Metrics.stage("token_settle"):
+            if reservation.get("local"):
+                total_tokens_used = LocalLimiter.settle_tokens(session, reservation, actual_tokens)
+            else:
+                user_limits = Quota.user_limits(self.db, session.user_id)
+                total_tokens_used = redis_call(
+                    lambda: RedisTokenBucket.settle_tokens(
+                        session_token=session.session_token,
+                        reservation=reservation,
+                        actual_tokens=actual_tokens,
+                        quota_keys=Quota.token_keys(session, user_limits)
+                    ),
+                    lambda: LocalLimiter.defer_settle(session, reservation, actual_tokens)
+                )
+                redis_call(lambda: Quota.charge_tokens(session, user_limits, actual_tokens), lambda: None)
+
+        self._record_usage(session, total_tokens_used)
+
+        return session
+
+    def release_tokens(self, session: ChatSession, reservation: dict):
+        """Refund a reservation whose model call did not complete"""
+        if reservation.get("local"):
+            LocalLimiter.settle_tokens(session, reservation, 0)
+        else:
+            redis_call(
+                lambda: RedisTokenBucket.release_tokens(session.session_token, reservation),
+                lambda: LocalLimiter.defer_settle(session, reservation, 0)
+            )
+
+    def token_usage(self, session: ChatSession) -> dict:
+        return redis_call(
+            lambda: RedisTokenBucket.get_token_usage(session.session_token),
+            lambda: LocalLimiter.get_token_usage(session)
+        )
+
+    def _record_usage(self, session: ChatSession, total_tokens_used: int):
+        session.token_count = total_tokens_used
+        if session.total_token_limit is not None and total_tokens_used >= session.total_token_limit:
+            session.is_active = False
+
+        if session.is_active:
+            if RedisCircuit.is_open():
+                with Metrics.stage("db_commit"):
+                    self.db.execute(_token_count_update(session))
+                    self.db.commit()
+            else:
+                UsageReconciler.mark(session)
+            SessionCache.update_fields(session.session_token, token_count=total_tokens_used)
+        else:
+            self.db.execute(_token_count_update(session))
             self.db.commit()
-            
-            return session
-            
+            SessionCache.invalidate(session.session_token)
+
+    def _deactivate_if_exhausted(self, session: ChatSession, error: HTTPException):
+        if _is_total_token_limit_error(error):
+            session.is_active = False
+            self.db.execute(_deactivate_update(session))
+            self.db.commit()
+            SessionCache.invalidate(session.session_token)
+
+class AsyncRateLimiter:
+    """Async counterpart of RateLimiter, backed by the async engine and redis.asyncio"""
+
+    def __init__(self, db: AsyncSession, request_cache: Optional[dict] = None):
+        self.db = db
+        self.request_cache = request_cache
+        self.rate_limit = None
+
+    async def check_rate_limit(self, session_token: str):
+        """Check if a request is within rate limits"""
+        with Metrics.stage("session_lookup"):
+            session = await SessionCache.get_async(self.db, session_token, self.request_cache)
+
+        if not session or not session.is_active:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Session not found or inactive"
+            )
+
+        with Metrics.stage("rate_limit"):
+            request_count = await SessionCache.incr_request_count_async(self.db, session)
+            if request_count is None:
+                Metrics.rate_limited("total_requests")
+                await self.deactivate(session)
+
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Total request limit reached. Session terminated."
+                )
+
+            user_limits = await Quota.user_limits_async(self.db, session.user_id)
+            if Quota.applies(session, user_limits):
+                try:
+                    self.rate_limit = await redis_call_async(
+                        lambda: Quota.check_rate_limit_async(session, user_limits),
+                        lambda: check_local_rate_limit(session)
+                    )
+                except HTTPException:
+                    await SessionCache.incr_request_count_async(self.db, session, delta=-1)
+                    raise
+
+        session.request_count = request_count
+        if not (WriteBehind.enabled() and await WriteBehind.append_usage_async(session, request_count=request_count)):
+            with Metrics.stage("db_commit"):
+                await self.db.execute(_request_count_update(session))
+                await self.db.commit()
+
+        return session
+
+    async def deactivate(self, session: ChatSession):
+        session.is_active = False
+        await self.db.execute(_deactivate_update(session))
+        await self.db.commit()
+        await SessionCache.invalidate_async(session.session_token)
+
+class AsyncTokenLimiter:
+    """Async counterpart of TokenLimiter's reserve/settle API"""
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def charge_tokens(self, session: ChatSession, tokens_to_use: int):
+        """Consume tokens outright, for usage that did not go through a reservation"""
+        user_limits = await Quota.user_limits_async(self.db, session.user_id)
+        try:
+            total_tokens_used = await redis_call_async(
+                lambda: with_token_bucket_async(self.db, session, lambda: RedisTokenBucket.check_token_limit_async(
+                    session_token=session.session_token,
+                    tokens_to_use=tokens_to_use,
+                    quota_keys=Quota.token_keys(session, user_limits)
+                )),
+                lambda: LocalLimiter.charge_tokens(session, tokens_to_use)
+            )
         except HTTPException as e:
-            if e.status_code == status.HTTP_429_TOO_MANY_REQUESTS and "Total token limit" in e.detail:
-                session.is_active = False
-                self.db.commit()
-            
+            await self._deactivate_if_exhausted(session, e)
+            raise
+
+        await redis_call_async(lambda: Quota.charge_tokens_async(session, user_limits, tokens_to_use), lambda: None)
+        await self._record_usage(session, total_tokens_used)
+
+        return session
+
+    async def reserve_tokens(self, session: ChatSession, estimate: int, min_tokens: int):
+        """Reserve tokens for an upcoming model call, before any upstream cost is incurred"""
+        try:
+            with Metrics.stage("token_reserve"):
+                return await redis_call_async(
+                    lambda: with_token_bucket_async(self.db, session, lambda: RedisTokenBucket.reserve_tokens_async(
+                        session_token=session.session_token,
+                        estimate=estimate,
+                        min_tokens=min_tokens
+                    )),
+                    lambda: LocalLimiter.reserve_tokens(session, estimate, min_tokens)
+                )
+        except HTTPException as e:
+            await self._deactivate_if_exhausted(session, e)
             raise
 
-def get_rate_limiter(db: Session = Depends(get_db)):
+    async def settle_tokens(self, session: ChatSession, reservation: dict, actual_tokens: int):
+        """Settle a reservation to the actual usage and record it on the session"""
+        with Metrics.stage("token_settle"):
+            if reservation.get("local"):
+                total_tokens_used = LocalLimiter.settle_tokens(session, reservation, actual_tokens)
+            else:
+                user_limits = await Quota.user_limits_async(self.db, session.user_id)
+                total_tokens_used = await redis_call_async(
+                    lambda: RedisTokenBucket.settle_tokens_async(
+                        session_token=session.session_token,
+                        reservation=reservation,
+                        actual_tokens=actual_tokens,
+                        quota_keys=Quota.token_keys(session, user_limits)
+                    ),
+                    lambda: LocalLimiter.defer_settle(session, reservation, actual_tokens)
+                )
+                await redis_call_async(lambda: Quota.charge_tokens_async(session, user_limits, actual_tokens), lambda: None)
+
+        await self._record_usage(session, total_tokens_used)
+
+        return session
+
+    async def release_tokens(self, session: ChatSession, reservation: dict):
+        """Refund a reservation whose model call did not complete"""
+        if reservation.get("local"):
+            LocalLimiter.settle_tokens(session, reservation, 0)
+        else:
+            await redis_call_async(
+                lambda: RedisTokenBucket.release_tokens_async(session.session_token, reservation),
+                lambda: LocalLimiter.defer_settle(session, reservation, 0)
+            )
+
+    async def extend_reservation(self, session: ChatSession, reservation: dict, estimate: int, min_tokens: int):
+        """
+        Grow a reservation while a streamed response is still generating.
+        If Redis went away since the reservation was made, the stream keeps going on what is
+        already reserved; max_output_tokens was capped to the remaining budget up front.
+        """
+        if reservation.get("local"):
+            return LocalLimiter.extend_reservation(session, reservation, estimate, min_tokens)
+        return await redis_call_async(
+            lambda: RedisTokenBucket.extend_reservation_async(session.session_token, reservation, estimate, min_tokens),
+            lambda: reservation
+        )
+
+    async def token_usage(self, session: ChatSession) -> dict:
+        return await redis_call_async(
+            lambda: RedisTokenBucket.get_token_usage_async(session.session_token),
+            lambda: LocalLimiter.get_token_usage(session)
+        )
+
+    async def _record_usage(self, session: ChatSession, total_tokens_used: int):
+        session.token_count = total_tokens_used
+        if session.total_token_limit is not None and total_tokens_used >= session.total_token_limit:
+            session.is_active = False
+
+        if session.is_active:
+            if RedisCircuit.is_open():
+                with Metrics.stage("db_commit"):
+                    await self.db.execute(_token_count_update(session))
+                    await self.db.commit()
+            else:
+                UsageReconciler.mark(session)
+            await SessionCache.update_fields_async(session.session_token, token_count=total_tokens_used)
+        else:
+            await self.db.execute(_token_count_update(session))
+            await self.db.commit()
+            await SessionCache.invalidate_async(session.session_token)
+
+    async def _deactivate_if_exhausted(self, session: ChatSession, error: HTTPException):
+        if _is_total_token_limit_error(error):
+            session.is_active = False
+            await self.db.execute(_deactivate_update(session))
+            await self.db.commit()
+            await SessionCache.invalidate_async(session.session_token)
+
+def get_rate_limiter(
+    db: Session = Depends(get_db),
+    request_cache: dict = Depends(get_request_session_cache)
+):
     """Create a rate limiter instance"""
-    return RateLimiter(db)
+    return RateLimiter(db, request_cache)
 
-def get_token_limiter(db: Session = Depends(get_db)):
+def get_token_limiter(
+    db: Session = Depends(get_db),
+    request_cache: dict = Depends(get_request_session_cache)
+):
     """Create a token limiter instance"""
-    return TokenLimiter(db)
+    return TokenLimiter(db, request_cache)
+
+def get_async_rate_limiter(
+    db: AsyncSession = Depends(get_async_db),
+    request_cache: dict = Depends(get_request_session_cache)
+):
+    """Create an async rate limiter instance"""
+    return AsyncRateLimiter(db, request_cache)
+
+def get_async_token_limiter(db: AsyncSession = Depends(get_async_db)):
+    """Create an async token limiter instance"""
+    return AsyncTokenLimiter(db)
 
 def check_rate_limit(
+    response: Response,
     session_token: str = Depends(get_session_token),
     rate_limiter: RateLimiter = Depends(get_rate_limiter),
     db: Session = Depends(get_db)
 ):
     """Check if the request is within rate limits"""
-    return rate_limiter.check_rate_limit(session_token)
+    session = rate_limiter.check_rate_limit(session_token)
+    response.headers.update(RedisRateLimiter.get_headers(rate_limiter.rate_limit))
+    return session
 
-@chat_router.post("/message", response_model=ChatResponse)
-def send_message(
-    chat_request: ChatRequest,
-    session: ChatSession = Depends(check_rate_limit),
-    db: Session = Depends(get_db),
-    token_limiter: TokenLimiter = Depends(get_token_limiter)
+async def check_rate_limit_async(
+    response: Response,
+    session_token: str = Depends(get_session_token),
+    rate_limiter: AsyncRateLimiter = Depends(get_async_rate_limiter)
 ):
+    """Check if the request is within rate limits without blocking the event loop"""
+    session = await rate_limiter.check_rate_limit(session_token)
+    response.headers.update(RedisRateLimiter.get_headers(rate_limiter.rate_limit))
+    return session
+
+def ensure_session_active(session: ChatSession):
     if not session.is_active:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Session is inactive or terminated"
         )
-    
-    try:
-        start_time = time.time()
-        
-        model = genai.GenerativeModel(
-            model_name="gemini-1.5-flash",
-            generation_config={
-                "temperature": 0.7,
-                "top_k": 40,
-                "top_p": 0.95,
-                "max_output_tokens": 1024,
-            }
-        )
-        
-        history = []
-        for msg in chat_request.history:
-            history.append({
-                "role": "user" if msg.role == "user" else "model",
-                "parts": [{"text": msg.content}]
-            })
-        
-        chat = model.start_chat(history=history)
 
-        input_tokens = 0
- 
-        if session.plan_type == 'token':
-            input_tokens = len(chat_request.message) // 4
-        
-        result = chat.send_message(chat_request.message)
-        response_text = result.text
+def build_gemini_history(messages) -> List[Dict[str, Any]]:
+    """Convert chat messages into the Gemini history format"""
+    history = []
+    for msg in messages:
+        history.append({
+            "role": "user" if msg.role == "user" else "model",
+            "parts": [{"text": msg.content}]
+        })
+    return history
 
-        usage_metadata = getattr(result, 'usage_metadata', None)
-        
-        total_tokens = 0
-        output_tokens = 0
-        
-        if usage_metadata:
-            prompt_token_count = getattr(usage_metadata, 'prompt_token_count', 0)
-            candidates_token_count = getattr(usage_metadata, 'candidates_token_count', 0)
-            total_tokens = prompt_token_count + candidates_token_count
-            input_tokens = prompt_token_count
-            output_tokens = candidates_token_count
-        else:
-            output_tokens = len(response_text) // 4
-            total_tokens = input_tokens + output_tokens
-        
-        if session.plan_type == 'token':
-            token_limiter.check_token_limit(session.session_token, total_tokens)
-        
-        end_time = time.time()
-        latency_ms = int((end_time - start_time) * 1000)
-        
-        db_user_msg = ChatMessage(
+def estimate_prompt_tokens(message: str, history: List[MessageBase]) -> int:
+    return max(Tokenizer.count_prompt(message, history), 1)
+
+def resolve_history(db: Session, session: ChatSession, chat_request: ChatRequest) -> List[MessageBase]:
+    """Use the stored conversation when the client opted into server_context, the uploaded history otherwise"""
+    if chat_request.server_context:
+        return ConversationContext.get_history(db, session, chat_request.message)
+    return chat_request.history
+
+async def resolve_history_async(db: AsyncSession, session: ChatSession, chat_request: ChatRequest) -> List[MessageBase]:
+    if chat_request.server_context:
+        return await ConversationContext.get_history_async(db, session, chat_request.message)
+    return chat_request.history
+
+def create_chat(profile: str, history: List[Dict[str, Any]]):
+    return get_provider().start_chat(profile, history)
+
+def get_token_counts(result, response_text: str, input_tokens: int):
+    """Return (input_tokens, output_tokens, total_tokens) from usage_metadata, falling back to an estimate"""
+    usage_metadata = getattr(result, 'usage_metadata', None)
+
+    if usage_metadata:
+        input_tokens = getattr(usage_metadata, 'prompt_token_count', 0)
+        output_tokens = getattr(usage_metadata, 'candidates_token_count', 0)
+    else:
+        output_tokens = Tokenizer.count(response_text, memoize=False)
+
+    return input_tokens, output_tokens, input_tokens + output_tokens
+
+def build_chat_messages(session: ChatSession, user_content: str, response_text: str, input_tokens: int, output_tokens: int):
+    return [
+        ChatMessage(
             session_id=session.id,
             role="user",
-            content=chat_request.message,
+            content=user_content,
             token_count=input_tokens
-        )
-        db.add(db_user_msg)
-        
-        db_assistant_msg = ChatMessage(
+        ),
+        ChatMessage(
             session_id=session.id,
             role="assistant",
             content=response_text,
             token_count=output_tokens
         )
-        db.add(db_assistant_msg)
-        
+    ]
+
+def persist_chat_messages(db: Session, session: ChatSession, messages: List[ChatMessage]):
+    with Metrics.stage("persist"):
+        if not (WriteBehind.enabled() and WriteBehind.append_messages(session, messages)):
+            with Metrics.stage("db_commit"):
+                db.add_all(messages)
+                db.commit()
+        ConversationContext.append(session, messages)
+
+async def persist_chat_messages_async(db: AsyncSession, session: ChatSession, messages: List[ChatMessage]):
+    with Metrics.stage("persist"):
+        if not (WriteBehind.enabled() and await WriteBehind.append_messages_async(session, messages)):
+            with Metrics.stage("db_commit"):
+                db.add_all(messages)
+                await db.commit()
+        await ConversationContext.append_async(session, messages)
+
+def get_response_cache_key(profile: str, chat_request: ChatRequest, history_messages: List[MessageBase]) -> Optional[str]:
+    if not ResponseCache.enabled() or not chat_request.use_cache:
+        return None
+    return ResponseCache.make_key(
+        ModelRegistry.get_model_name(profile),
+        ModelRegistry.get_generation_config(profile),
+        history_messages,
+        chat_request.message
+    )
+
+def build_cache_entry(response_text: str, input_tokens: int, output_tokens: int, total_tokens: int) -> dict:
+    return {
+        "content": response_text,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": total_tokens,
+    }
+
+def refund_request(db: Session, session: ChatSession):
+    """Give back the request the rate limit dependency counted, e.g. for an unbilled cache hit"""
+    user_limits = Quota.user_limits(db, session.user_id)
+    if Quota.applies(session, user_limits):
+        redis_call(
+            lambda: Quota.refund_request(session, user_limits),
+            lambda: refund_local_rate_limit(session)
+        )
+
+    request_count = SessionCache.incr_request_count(db, session, delta=-1)
+    session.request_count = request_count
+    if not (WriteBehind.enabled() and WriteBehind.append_refund(session, request_count)):
+        db.execute(_request_count_update(session, delta=-1))
         db.commit()
+
+async def refund_request_async(db: AsyncSession, session: ChatSession):
+    """Async variant of refund_request"""
+    user_limits = await Quota.user_limits_async(db, session.user_id)
+    if Quota.applies(session, user_limits):
+        await redis_call_async(
+            lambda: Quota.refund_request_async(session, user_limits),
+            lambda: refund_local_rate_limit(session)
+        )
+
+    request_count = await SessionCache.incr_request_count_async(db, session, delta=-1)
+    session.request_count = request_count
+    if not (WriteBehind.enabled() and await WriteBehind.append_refund_async(session, request_count)):
+        await db.execute(_request_count_update(session, delta=-1))
+        await db.commit()
+
+def serve_cached_response(db: Session, session: ChatSession, chat_request: ChatRequest, entry: dict, token_limiter: TokenLimiter, start_time: float):
+    """
+    Answer from the response cache, billing token plans per RESPONSE_CACHE_BILLING
+    and request plans per RESPONSE_CACHE_REQUEST_BILLING
+    """
+    billed_tokens = ResponseCache.billed_tokens(entry)
+    token_usage = None
+
+    if session.plan_type == 'token':
+        if billed_tokens:
+            token_limiter.charge_tokens(session, billed_tokens)
+        token_usage = token_limiter.token_usage(session)
+    elif not ResponseCache.bills_request():
+        refund_request(db, session)
+
+    persist_chat_messages(db, session, build_chat_messages(session, chat_request.message, entry["content"], entry["input_tokens"], entry["output_tokens"]))
+
+    latency_ms = int((time.time() - start_time) * 1000)
+    response = build_chat_response(session, entry["content"], latency_ms, billed_tokens, token_usage)
+    response["cached"] = True
+    return response
+
+async def serve_cached_response_async(db: AsyncSession, session: ChatSession, chat_request: ChatRequest, entry: dict, token_limiter: AsyncTokenLimiter, start_time: float):
+    """Async variant of serve_cached_response"""
+    billed_tokens = ResponseCache.billed_tokens(entry)
+    token_usage = None
+
+    if session.plan_type == 'token':
+        if billed_tokens:
+            await token_limiter.charge_tokens(session, billed_tokens)
+        token_usage = await token_limiter.token_usage(session)
+    elif not ResponseCache.bills_request():
+        await refund_request_async(db, session)
+
+    await persist_chat_messages_async(db, session, build_chat_messages(session, chat_request.message, entry["content"], entry["input_tokens"], entry["output_tokens"]))
+
+    latency_ms = int((time.time() - start_time) * 1000)
+    response = build_chat_response(session, entry["content"], latency_ms, billed_tokens, token_usage)
+    response["cached"] = True
+    return response
+
+def build_chat_response(session: ChatSession, response_text: str, latency_ms: int, total_tokens: int, token_usage: Optional[dict]):
+    tokens_remaining = None
+    requests_remaining = None
+
+    if session.plan_type == 'token':
+        tokens_remaining = token_usage.get('tokens_remaining') if token_usage else None
+    elif session.total_requests_limit is not None:
+        requests_remaining = session.total_requests_limit - session.request_count
+
+    return {
+        "content": response_text,
+        "latency_ms": latency_ms,
+        "requests_remaining": requests_remaining,
+        "tokens_remaining": tokens_remaining,
+        "token_usage": total_tokens if session.plan_type == 'token' else None,
+        "session_active": session.is_active,
+        "cached": False
+    }
+
+def send_message(
+    chat_request: ChatRequest,
+    idempotency: Optional[dict] = Depends(claim_idempotency_key),
+    session: ChatSession = Depends(check_rate_limit),
+    db: Session = Depends(get_db),
+    token_limiter: TokenLimiter = Depends(get_token_limiter)
+):
+    ensure_session_active(session)
+    
+    start_time = time.time()
+    history_messages = resolve_history(db, session, chat_request)
+    profile = ModelRegistry.resolve_profile(session)
+    cache_key = get_response_cache_key(profile, chat_request, history_messages)
+    if cache_key is not None:
+        entry = ResponseCache.get(cache_key)
+        Metrics.response_cache(entry is not None)
+        if entry is not None:
+            return Idempotency.complete(idempotency, serve_cached_response(db, session, chat_request, entry, token_limiter, start_time))
+
+    history = build_gemini_history(history_messages)
+    generation_config = ModelRegistry.get_generation_config(profile)
+    input_tokens = 0
+    reservation = None
+
+    if session.plan_type == 'token':
+        input_tokens = estimate_prompt_tokens(chat_request.message, history_messages)
+        reservation = token_limiter.reserve_tokens(
+            session,
+            estimate=input_tokens + generation_config["max_output_tokens"],
+            min_tokens=input_tokens + 1
+        )
+        generation_config["max_output_tokens"] = reservation["reserved"] - input_tokens
+    
+    try:
+        with AdmissionControl.admit(session), Metrics.model_call(get_provider().name):
+            chat = create_chat(profile, history)
+            result = chat.send_message(chat_request.message, generation_config=generation_config)
+            response_text = result.text
+
+        input_tokens, output_tokens, total_tokens = get_token_counts(result, response_text, input_tokens)
+        Metrics.record_tokens(session.plan_type, input_tokens, output_tokens)
+        
+        if reservation is not None:
+            token_limiter.settle_tokens(session, reservation, total_tokens)
+            reservation = None
+
+        if cache_key is not None and generation_config == ModelRegistry.get_generation_config(profile):
+            ResponseCache.set(cache_key, build_cache_entry(response_text, input_tokens, output_tokens, total_tokens))
         
-        tokens_remaining = None
-        requests_remaining = None
+        latency_ms = int((time.time() - start_time) * 1000)
         
+        persist_chat_messages(db, session, build_chat_messages(session, chat_request.message, response_text, input_tokens, output_tokens))
+        
+        token_usage = None
         if session.plan_type == 'token':
-            token_usage = RedisTokenBucket.get_token_usage(session.session_token)
-            tokens_remaining = token_usage.get('tokens_remaining')
-        elif session.total_requests_limit is not None:
-            requests_remaining = session.total_requests_limit - session.request_count
+            token_usage = token_limiter.token_usage(session)
         
-        return {
-            "content": response_text,
-            "latency_ms": latency_ms,
-            "requests_remaining": requests_remaining,
-            "tokens_remaining": tokens_remaining,
-            "token_usage": total_tokens if session.plan_type == 'token' else None,
-            "session_active": session.is_active
-        }
+        return Idempotency.complete(idempotency, build_chat_response(session, response_text, latency_ms, total_tokens, token_usage))
         
+    except HTTPException:
+        if reservation is not None:
+            token_limiter.release_tokens(session, reservation)
+        raise
+    except Exception as e:
+        if reservation is not None:
+            token_limiter.release_tokens(session, reservation)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error communicating with Gemini API: {str(e)}"
+        )
+
+async def send_message_async(
+    chat_request: ChatRequest,
+    idempotency: Optional[dict] = Depends(claim_idempotency_key),
+    session: ChatSession = Depends(check_rate_limit_async),
+    db: AsyncSession = Depends(get_async_db),
+    token_limiter: AsyncTokenLimiter = Depends(get_async_token_limiter)
+):
+    ensure_session_active(session)
+
+    start_time = time.time()
+    history_messages = await resolve_history_async(db, session, chat_request)
+    profile = ModelRegistry.resolve_profile(session)
+    cache_key = get_response_cache_key(profile, chat_request, history_messages)
+    if cache_key is not None:
+        entry = await ResponseCache.get_async(cache_key)
+        Metrics.response_cache(entry is not None)
+        if entry is not None:
+            return await Idempotency.complete_async(idempotency, await serve_cached_response_async(db, session, chat_request, entry, token_limiter, start_time))
+
+    history = build_gemini_history(history_messages)
+    generation_config = ModelRegistry.get_generation_config(profile)
+    input_tokens = 0
+    reservation = None
+
+    if session.plan_type == 'token':
+        input_tokens = estimate_prompt_tokens(chat_request.message, history_messages)
+        reservation = await token_limiter.reserve_tokens(
+            session,
+            estimate=input_tokens + generation_config["max_output_tokens"],
+            min_tokens=input_tokens + 1
+        )
+        generation_config["max_output_tokens"] = reservation["reserved"] - input_tokens
+
+    try:
+        async with AdmissionControl.admit_async(session):
+            with Metrics.model_call(get_provider().name):
+                chat = create_chat(profile, history)
+                result = await chat.send_message_async(chat_request.message, generation_config=generation_config)
+                response_text = result.text
+
+        input_tokens, output_tokens, total_tokens = get_token_counts(result, response_text, input_tokens)
+        Metrics.record_tokens(session.plan_type, input_tokens, output_tokens)
+
+        if reservation is not None:
+            await token_limiter.settle_tokens(session, reservation, total_tokens)
+            reservation = None
+
+        if cache_key is not None and generation_config == ModelRegistry.get_generation_config(profile):
+            await ResponseCache.set_async(cache_key, build_cache_entry(response_text, input_tokens, output_tokens, total_tokens))
+
+        latency_ms = int((time.time() - start_time) * 1000)
+
+        await persist_chat_messages_async(db, session, build_chat_messages(session, chat_request.message, response_text, input_tokens, output_tokens))
+
+        token_usage = None
+        if session.plan_type == 'token':
+            token_usage = await token_limiter.token_usage(session)
+
+        return await Idempotency.complete_async(idempotency, build_chat_response(session, response_text, latency_ms, total_tokens, token_usage))
+
+    except HTTPException:
+        if reservation is not None:
+            await token_limiter.release_tokens(session, reservation)
+        raise
     except Exception as e:
+        if reservation is not None:
+            await token_limiter.release_tokens(session, reservation)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error communicating with Gemini API: {str(e)}"
         )
 
+chat_router.post("/message", response_model=ChatResponse)(
+    send_message_async if settings.ASYNC_CHAT else send_message
+)
+
+def format_sse(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Encode one server-sent event"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def get_chunk_text(chunk) -> str:
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+# Strong references to running finish_stream tasks, which outlive a disconnected client's stream
+stream_finishers: set = set()
+
+async def finish_stream(
+    session: ChatSession,
+    ticket: Optional[str],
+    reservation: Optional[dict],
+    message: str,
+    response_text: str,
+    input_tokens: int,
+    output_tokens: int
+):
+    """
+    Release the admission slot, settle or refund the reservation and persist the exchange
+    of a finished stream; returns the token usage of token-plan sessions. Runs as a task of
+    its own, shielded from the cancellation of a stream whose client disconnected.
+    """
+    await AdmissionControl.release_async(ticket)
+
+    async with AsyncSessionLocal() as db:
+        limiter = AsyncTokenLimiter(db)
+
+        if reservation is not None:
+            if response_text:
+                await limiter.settle_tokens(session, reservation, input_tokens + output_tokens)
+            else:
+                await limiter.release_tokens(session, reservation)
+
+        if response_text:
+            await persist_chat_messages_async(db, session, build_chat_messages(session, message, response_text, input_tokens, output_tokens))
+
+        if session.plan_type == 'token':
+            return await limiter.token_usage(session)
+        return None
+
+@chat_router.post("/stream")
+async def stream_message(
+    chat_request: ChatRequest,
+    session: ChatSession = Depends(check_rate_limit_async),
+    db: AsyncSession = Depends(get_async_db),
+    token_limiter: AsyncTokenLimiter = Depends(get_async_token_limiter)
+):
+    """
+    Stream the model response as server-sent events.
+    Token-plan sessions are charged in blocks as chunks arrive and the stream ends
+    with a "limit" finish reason once total_limit is reached. The exchange is persisted
+    once, when the stream completes or the client disconnects, by finish_stream. The
+    admission slot, if admission control is on, is held until the stream ends.
+    """
+    ensure_session_active(session)
+
+    start_time = time.time()
+    history_messages = await resolve_history_async(db, session, chat_request)
+    history = build_gemini_history(history_messages)
+    profile = ModelRegistry.resolve_profile(session)
+    generation_config = ModelRegistry.get_generation_config(profile)
+    input_tokens = 0
+    reservation = None
+
+    if session.plan_type == 'token':
+        input_tokens = estimate_prompt_tokens(chat_request.message, history_messages)
+        reservation = await token_limiter.reserve_tokens(
+            session,
+            estimate=input_tokens + STREAM_RESERVATION_BLOCK,
+            min_tokens=input_tokens + 1
+        )
+        remaining = reservation["total_limit"] - reservation["total_usage"] if reservation["total_limit"] is not None else None
+        if remaining is not None:
+            generation_config["max_output_tokens"] = min(
+                generation_config["max_output_tokens"],
+                reservation["reserved"] + remaining - input_tokens
+            )
+
+    try:
+        ticket = await AdmissionControl.acquire_async(session)
+    except HTTPException:
+        if reservation is not None:
+            await token_limiter.release_tokens(session, reservation)
+        raise
+
+    async def event_stream():
+        nonlocal input_tokens, reservation
+        chunks = []
+        output_tokens = 0
+        finish_reason = "stop"
+        provider = get_provider().name
+        call_started = time.perf_counter()
+
+        try:
+            chat = create_chat(profile, history)
+            response = await chat.send_message_async(chat_request.message, generation_config=generation_config, stream=True)
+
+            async for chunk in response:
+                if call_started is not None:
+                    Metrics.observe_stage("model_first_chunk", time.perf_counter() - call_started)
+                    call_started = None
+
+                text = get_chunk_text(chunk)
+                usage_metadata = getattr(chunk, 'usage_metadata', None)
+                chunk_output_tokens = getattr(usage_metadata, 'candidates_token_count', 0) if usage_metadata else 0
+                chunk_output_tokens = max(chunk_output_tokens, output_tokens + Tokenizer.count(text, memoize=False))
+
+                if reservation is not None and input_tokens + chunk_output_tokens > reservation["reserved"]:
+                    needed = input_tokens + chunk_output_tokens - reservation["reserved"]
+                    try:
+                        await token_limiter.extend_reservation(
+                            session,
+                            reservation,
+                            estimate=max(needed, STREAM_RESERVATION_BLOCK),
+                            min_tokens=needed
+                        )
+                    except HTTPException:
+                        finish_reason = "limit"
+                        break
+
+                output_tokens = chunk_output_tokens
+                if text:
+                    chunks.append(text)
+                    yield format_sse({"content": text})
+
+            if finish_reason == "stop":
+                usage_metadata = getattr(response, 'usage_metadata', None)
+                if usage_metadata:
+                    input_tokens = getattr(usage_metadata, 'prompt_token_count', input_tokens)
+                    output_tokens = getattr(usage_metadata, 'candidates_token_count', output_tokens)
+
+        except Exception as e:
+            logger.error(f"Error streaming from Gemini API: {str(e)}")
+            Metrics.upstream_error(provider, type(e).__name__)
+            finish_reason = "error"
+            yield format_sse({"detail": f"Error communicating with Gemini API: {str(e)}"}, event="error")
+
+        finally:
+            response_text = "".join(chunks)
+            total_tokens = input_tokens + output_tokens
+            if chunks:
+                Metrics.record_tokens(session.plan_type, input_tokens, output_tokens)
+
+            finish = asyncio.ensure_future(finish_stream(
+                session, ticket, reservation, chat_request.message, response_text, input_tokens, output_tokens
+            ))
+            stream_finishers.add(finish)
+            finish.add_done_callback(stream_finishers.discard)
+            token_usage = await asyncio.shield(finish)
+
+        if finish_reason != "error":
+            latency_ms = int((time.time() - start_time) * 1000)
+            done = build_chat_response(session, response_text, latency_ms, total_tokens, token_usage)
+            done.pop("content")
+            done["finish_reason"] = finish_reason
+            yield format_sse(done, event="done")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def get_active_session(
+    session_token: str = Depends(get_session_token),
+    db: AsyncSession = Depends(get_async_db),
+    request_cache: dict = Depends(get_request_session_cache)
+):
+    """Look up the caller's active session without counting the request against its limits"""
+    session = await SessionCache.get_async(db, session_token, request_cache)
+
+    if not session or not session.is_active:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Session not found or inactive"
+        )
+
+    return session
+
+def history_page_query(session: ChatSession, before: Optional[int], after: Optional[int], limit: int):
+    query = select(ChatMessage).where(ChatMessage.session_id == session.id)
+
+    if after is not None:
+        return query.where(ChatMessage.id > after).order_by(ChatMessage.id.asc()).limit(limit + 1)
+    if before is not None:
+        query = query.where(ChatMessage.id < before)
+    return query.order_by(ChatMessage.id.desc()).limit(limit + 1)
+
 @chat_router.get("/history", response_model=List[Message])
-def get_chat_history(
-    session: ChatSession = Depends(check_rate_limit),
-    db: Session = Depends(get_db)
+async def get_chat_history(
+    request: Request,
+    response: Response,
+    before: Optional[int] = Query(None, description="Return messages older than this message id"),
+    after: Optional[int] = Query(None, description="Return messages newer than this message id"),
+    limit: int = Query(50, ge=1, le=500),
+    session: ChatSession = Depends(get_active_session),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    messages = db.query(ChatMessage).filter(
-        ChatMessage.session_id == session.id
-    ).order_by(ChatMessage.created_at.asc()).all()
-    
+    """
+    Keyset-paginated chat history, oldest first within a page.
+    Without a cursor the most recent page is returned. History reads are not billed.
+    """
+    if WriteBehind.enabled():
+        await WriteBehind.flush_session_async(db, session)
+
+    result = await db.execute(history_page_query(session, before, after, limit))
+    messages = list(result.scalars().all())
+
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after is None:
+        messages.reverse()
+
+    headers = {"Cache-Control": "private, no-cache"}
+    if messages:
+        headers["ETag"] = f'W/"{session.id}-{messages[0].id}-{messages[-1].id}-{len(messages)}-{int(has_more)}"'
+        headers["Last-Modified"] = format_datetime(messages[-1].created_at.replace(tzinfo=datetime.timezone.utc), usegmt=True)
+        if after is not None or has_more:
+            headers["X-Cursor-Before"] = str(messages[0].id)
+        headers["X-Cursor-After"] = str(messages[-1].id)
+    else:
+        headers["ETag"] = f'W/"{session.id}-empty-{before}-{after}"'
+
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    response.headers.update(headers)
+    return messages
+
+def archive_page(messages: List[dict], before: Optional[int], after: Optional[int], limit: int) -> Tuple[List[dict], bool]:
+    """Apply the /history cursors to an archived conversation, which is loaded whole"""
+    if after is not None:
+        newer = [message for message in messages if message["id"] > after]
+        return newer[:limit], len(newer) > limit
+    if before is not None:
+        messages = [message for message in messages if message["id"] < before]
+    return messages[-limit:], len(messages) > limit
+
+@chat_router.get("/archive", response_model=List[Message])
+async def get_archived_history(
+    response: Response,
+    before: Optional[int] = Query(None, description="Return messages older than this message id"),
+    after: Optional[int] = Query(None, description="Return messages newer than this message id"),
+    limit: int = Query(50, ge=1, le=500),
+    session_token: str = Depends(get_session_token),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    History of a session whose messages were moved to the archive by retention, paginated like
+    /history. Works for inactive sessions; archived segments are read on demand.
+    """
+    session = await SessionCache.get_async(db, session_token)
+    if not session:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Session not found"
+        )
+
+    archived = await Retention.load_archived_async(db, session)
+    if archived is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Session has no archived messages"
+        )
+
+    messages, has_more = archive_page(archived, before, after, limit)
+    response.headers["Cache-Control"] = "private, no-cache"
+    if messages:
+        if after is not None or has_more:
+            response.headers["X-Cursor-Before"] = str(messages[0]["id"])
+        response.headers["X-Cursor-After"] = str(messages[-1]["id"])
     return messages
 
+def ensure_generation_profile(name: Optional[str]):
+    if name is not None and not ModelRegistry.has_profile(name):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown generation profile: {name}"
+        )
+
+def ensure_payment_not_required():
+    if settings.LIGHTNING_REQUIRE_PAYMENT:
+        raise HTTPException(
+            status_code=status.HTTP_402_PAYMENT_REQUIRED,
+            detail="Sessions are created and extended by paying an invoice from POST /payments/invoices"
+        )
+
+def get_user(db: Session, user_id: int) -> User:
+    user = db.get(User, user_id)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    return user
+
+@session_router.get("/profiles", response_model=List[GenerationProfile])
+def list_generation_profiles():
+    return [
+        GenerationProfile(
+            name=name,
+            model=ModelRegistry.get_model_name(name),
+            max_output_tokens=ModelRegistry.get_generation_config(name).get("max_output_tokens")
+        )
+        for name in ModelRegistry.profile_names()
+    ]
+
 @session_router.post("/create", response_model=Session)
 def create_session(
     session_data: SessionCreate,
     db: Session = Depends(get_db)
 ):
+    ensure_payment_not_required()
+    ensure_generation_profile(session_data.generation_profile)
+    if session_data.user_id is not None:
+        get_user(db, session_data.user_id)
     session_token = str(uuid.uuid4())
     
     db_session = ChatSession(
@@ -244,17 +1147,23 @@ def create_session(
         rate_limit_rpm=session_data.rate_limit_rpm,
         rate_limit_rpd=session_data.rate_limit_rpd,
         total_requests_limit=session_data.total_requests_limit,
-        total_token_limit=session_data.total_token_limit
+        total_token_limit=session_data.total_token_limit,
+        generation_profile=session_data.generation_profile,
+        user_id=session_data.user_id
     )
     
     db.add(db_session)
     db.commit()
     db.refresh(db_session)
+    SessionCache.store(db_session)
     
     if session_data.plan_type == 'token':
-        RedisTokenBucket.initialize_token_bucket(
-            session_token=session_token,
-            total_token_limit=session_data.total_token_limit
+        redis_call(
+            lambda: RedisTokenBucket.initialize_token_bucket(
+                session_token=session_token,
+                total_token_limit=session_data.total_token_limit
+            ),
+            lambda: LocalLimiter.defer_initialize_bucket(session_token, session_data.total_token_limit)
         )
     
     return db_session
@@ -264,9 +1173,7 @@ def get_session_status(
     session_token: str = Depends(get_session_token),
     db: Session = Depends(get_db)
 ):
-    session = db.query(ChatSession).filter(
-        ChatSession.session_token == session_token
-    ).first()
+    session = SessionCache.get(db, session_token, use_local=False)
     
     if not session:
         raise HTTPException(
@@ -282,6 +1189,8 @@ def update_session_config(
     session_token: str = Depends(get_session_token),
     db: Session = Depends(get_db)
 ):
+    ensure_payment_not_required()
+
     session = db.query(ChatSession).filter(
         ChatSession.session_token == session_token,
         ChatSession.is_active == True
@@ -296,6 +1205,34 @@ def update_session_config(
     session.total_requests_limit = config.total_requests_limit
     
     db.commit()
+    SessionCache.invalidate(session_token)
+    db.refresh(session)
+    
+    return session
+
+@session_router.put("/profile", response_model=Session)
+def update_generation_profile(
+    config: GenerationProfileConfig,
+    session_token: str = Depends(get_session_token),
+    db: Session = Depends(get_db)
+):
+    ensure_generation_profile(config.generation_profile)
+
+    session = db.query(ChatSession).filter(
+        ChatSession.session_token == session_token,
+        ChatSession.is_active == True
+    ).first()
+    
+    if not session:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Session not found or inactive"
+        )
+    
+    session.generation_profile = config.generation_profile
+    
+    db.commit()
+    SessionCache.invalidate(session_token)
     db.refresh(session)
     
     return session
@@ -306,6 +1243,8 @@ def update_token_config(
     session_token: str = Depends(get_session_token),
     db: Session = Depends(get_db)
 ):
+    ensure_payment_not_required()
+
     try:
         session = db.query(ChatSession).filter(
             ChatSession.session_token == session_token,
@@ -326,16 +1265,23 @@ def update_token_config(
         
         session.total_token_limit = config.total_token_limit
         db.commit()
+        SessionCache.invalidate(session_token)
         
-        RedisTokenBucket.initialize_token_bucket(
-            session_token=session_token,
-            total_token_limit=config.total_token_limit
+        redis_call(
+            lambda: RedisTokenBucket.initialize_token_bucket(
+                session_token=session_token,
+                total_token_limit=config.total_token_limit,
+                token_count=session.token_count or 0
+            ),
+            lambda: LocalLimiter.defer_initialize_bucket(session_token, config.total_token_limit, session.token_count or 0)
         )
         
         db.refresh(session)
         return session
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error setting token limit: {str(e)}")
+        logger.error(f"Error setting token limit: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to set token limit: {str(e)}"
@@ -358,6 +1304,281 @@ def terminate_session(
     
     session.is_active = False
     db.commit()
+    SessionCache.invalidate(session_token)
     db.refresh(session)
     
-    return session
\ No newline at end of file
+    return session
+
+def ensure_batch_size(size: int):
+    if size > settings.SESSION_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {settings.SESSION_BATCH_MAX_SIZE} sessions per batch"
+        )
+
+def initialize_token_buckets(buckets: List[Tuple[str, Optional[int], int]]):
+    """Create or update the token buckets of a batch of sessions in one pipeline"""
+    if not buckets:
+        return
+
+    def defer():
+        for session_token, total_token_limit, token_count in buckets:
+            LocalLimiter.defer_initialize_bucket(session_token, total_token_limit, token_count)
+
+    redis_call(lambda: RedisTokenBucket.initialize_token_buckets(buckets), defer)
+
+def batch_result(rows, session_tokens: List[str]) -> dict:
+    sessions = [dict(row._mapping) for row in rows]
+    found = {session["session_token"] for session in sessions}
+    return {
+        "sessions": sessions,
+        "missing": [session_token for session_token in session_tokens if session_token not in found]
+    }
+
+@session_router.post("/batch", response_model=SessionBatch)
+def create_sessions(
+    batch: SessionBatchCreate,
+    db: Session = Depends(get_db)
+):
+    """
+    Create sessions in bulk, e.g. for a voucher batch.
+    All rows go in with one multi-row INSERT and all token buckets with one Redis pipeline;
+    sessions are not written to the session cache, which fills on their first request.
+    """
+    ensure_batch_size(sum(group.count for group in batch.sessions))
+    for group in batch.sessions:
+        ensure_generation_profile(group.generation_profile)
+    user_ids = {group.user_id for group in batch.sessions if group.user_id is not None}
+    if user_ids and len(db.scalars(select(User.id).where(User.id.in_(user_ids))).all()) < len(user_ids):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+
+    values = [
+        {
+            "session_token": str(uuid.uuid4()),
+            "plan_type": group.plan_type,
+            "rate_limit_rpm": group.rate_limit_rpm,
+            "rate_limit_rpd": group.rate_limit_rpd,
+            "total_requests_limit": group.total_requests_limit,
+            "total_token_limit": group.total_token_limit,
+            "generation_profile": group.generation_profile,
+            "user_id": group.user_id
+        }
+        for group in batch.sessions
+        for _ in range(group.count)
+    ]
+    if not values:
+        return {"sessions": []}
+
+    table = ChatSession.__table__
+    rows = db.execute(insert(table).returning(*table.columns, sort_by_parameter_order=True), values).all()
+    db.commit()
+
+    initialize_token_buckets([
+        (row.session_token, row.total_token_limit, 0)
+        for row in rows
+        if row.plan_type == 'token'
+    ])
+
+    return batch_result(rows, [])
+
+@session_router.post("/batch/terminate", response_model=SessionBatch)
+def terminate_sessions(
+    batch: SessionBatchTokens,
+    db: Session = Depends(get_db)
+):
+    """Deactivate sessions in bulk; unknown tokens are returned as missing"""
+    session_tokens = list(dict.fromkeys(batch.session_tokens))
+    ensure_batch_size(len(session_tokens))
+
+    table = ChatSession.__table__
+    rows = db.execute(
+        update(table).where(table.c.session_token.in_(session_tokens)).values(is_active=False).returning(*table.columns)
+    ).all()
+    db.commit()
+    SessionCache.invalidate_many([row.session_token for row in rows])
+
+    return batch_result(rows, session_tokens)
+
+@session_router.put("/batch/config", response_model=SessionBatch)
+def update_sessions_config(
+    batch: SessionBatchUpdate,
+    db: Session = Depends(get_db)
+):
+    """
+    Set limits of active sessions in bulk; limits left out are kept, and unknown or inactive
+    tokens are returned as missing. total_token_limit is only accepted if every session is on
+    the token plan.
+    """
+    session_tokens = list(dict.fromkeys(batch.session_tokens))
+    ensure_batch_size(len(session_tokens))
+
+    limits = {
+        name: getattr(batch, name)
+        for name in ("rate_limit_rpm", "rate_limit_rpd", "total_requests_limit", "total_token_limit")
+        if getattr(batch, name) is not None
+    }
+    if not limits:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No limits to update"
+        )
+
+    table = ChatSession.__table__
+    active = table.c.session_token.in_(session_tokens) & (table.c.is_active == True)
+    if "total_token_limit" in limits:
+        other_plans = db.scalars(
+            select(table.c.session_token).where(active, table.c.plan_type != 'token')
+        ).all()
+        if other_plans:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Token limit can only be set for token-based plans: {', '.join(other_plans)}"
+            )
+
+    rows = db.execute(update(table).where(active).values(**limits).returning(*table.columns)).all()
+    db.commit()
+    SessionCache.invalidate_many([row.session_token for row in rows])
+
+    if "total_token_limit" in limits:
+        initialize_token_buckets([
+            (row.session_token, row.total_token_limit, row.token_count or 0)
+            for row in rows
+        ])
+
+    return batch_result(rows, session_tokens)
+
+@quota_router.get("/global", response_model=QuotaUsage)
+def get_global_usage(db: Session = Depends(get_db)):
+    """Usage summed over all sessions, against the GLOBAL_* limits"""
+    return Quota.usage(db)
+
+@quota_router.post("/users", response_model=UserQuota)
+def create_user(
+    user_data: UserCreate,
+    db: Session = Depends(get_db)
+):
+    user = User(
+        email=user_data.email,
+        rate_limit_rpm=user_data.rate_limit_rpm,
+        rate_limit_rpd=user_data.rate_limit_rpd,
+        token_limit_tpm=user_data.token_limit_tpm
+    )
+    
+    db.add(user)
+    db.commit()
+    db.refresh(user)
+    
+    return user
+
+@quota_router.put("/users/{user_id}", response_model=UserQuota)
+def update_user_limits(
+    user_id: int,
+    config: UserLimitConfig,
+    db: Session = Depends(get_db)
+):
+    """Replace a user's limits; a limit left out is lifted"""
+    user = get_user(db, user_id)
+    
+    user.rate_limit_rpm = config.rate_limit_rpm
+    user.rate_limit_rpd = config.rate_limit_rpd
+    user.token_limit_tpm = config.token_limit_tpm
+    
+    db.commit()
+    Quota.forget_user(user_id)
+    db.refresh(user)
+    
+    return user
+
+@quota_router.get("/users/{user_id}", response_model=QuotaUsage)
+def get_user_usage(
+    user_id: int,
+    db: Session = Depends(get_db)
+):
+    """Usage summed over a user's sessions, against the user's limits"""
+    get_user(db, user_id)
+    return Quota.usage(db, user_id)
+
+def ensure_lightning_enabled():
+    if not LightningSettlement.enabled():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Lightning payments are not enabled"
+        )
+
+async def get_invoice(db: AsyncSession, payment_hash: str) -> LightningInvoice:
+    invoice = (await db.execute(
+        select(LightningInvoice).where(LightningInvoice.payment_hash == payment_hash)
+    )).scalars().first()
+    if not invoice:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Invoice not found"
+        )
+    return invoice
+
+@payment_router.post("/invoices", response_model=Invoice)
+async def create_invoice(
+    invoice_data: InvoiceCreate,
+    x_session_token: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Create an invoice for a new session, or with X-Session-Token for more requests or tokens
+    on an existing one. The returned session_token becomes usable once the invoice is paid.
+    """
+    ensure_lightning_enabled()
+    ensure_generation_profile(invoice_data.generation_profile)
+    session_token = str(uuid.uuid4())
+
+    if x_session_token is not None:
+        session = await SessionCache.get_async(db, x_session_token)
+        if not session:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Session not found"
+            )
+        if session.plan_type != invoice_data.plan_type:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Session is on the {session.plan_type} plan"
+            )
+        session_token = x_session_token
+
+    return await LightningSettlement.create_invoice(db, invoice_data, session_token)
+
+@payment_router.get("/invoices/{payment_hash}", response_model=InvoiceStatus)
+async def get_invoice_status(
+    payment_hash: str,
+    wait: float = Query(0, ge=0, le=settings.LIGHTNING_MAX_WAIT, description="Seconds to hold the request while the invoice is open"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """State of an invoice; with wait, answers as soon as it is settled or canceled"""
+    invoice = await get_invoice(db, payment_hash)
+    if wait > 0 and invoice.state == "open":
+        await LightningSettlement.wait(payment_hash, wait)
+        await db.refresh(invoice)
+    return invoice
+
+@payment_router.post("/mock/settle/{payment_hash}", response_model=InvoiceStatus)
+async def settle_mock_invoice(
+    payment_hash: str,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Pay an invoice on the mock node; only available with LIGHTNING_BACKEND=mock.
+    The payment is applied here rather than waited for, so this works without a subscriber;
+    the subscription delivering the same event again is a no-op.
+    """
+    backend = get_backend() if LightningSettlement.enabled() else None
+    event = backend.settle(payment_hash) if isinstance(backend, MockLnd) else None
+    if event is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Open mock invoice not found"
+        )
+
+    await LightningSettlement.apply(event)
+    return await get_invoice(db, payment_hash)
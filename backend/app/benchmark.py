@@ -0,0 +1,336 @@
+"""
+Benchmark harness for the session and chat APIs.
+
+    python -m app.benchmark --scenario create,message,history --concurrency 32 --output bench.json
+
+The app is driven in-process through its ASGI interface (--mode inprocess) or over
+HTTP through uvicorn running in a background thread (--mode uvicorn). Redis is either
+the one configured in Settings (--redis local) or an in-memory fakeredis server
+(--redis memory), the database is a fresh SQLite file unless --database is given,
+and the model is always the offline stub provider, so results only reflect the
+overhead of this service. Any other setting can be passed with --env NAME=VALUE.
+
+Results are printed (or written to --output) as JSON: req/s, latency percentiles,
+status codes and DB/Redis round trips per request for each scenario.
+Requires httpx, and fakeredis for --redis memory, which uses the test suite's
+tests/memory_redis.py; run it from backend/.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import functools
+import subprocess
+from collections import Counter
+from typing import Dict, List
+
+SCENARIOS = ("create", "message", "history")
+
+class RoundTripCounter:
+    """Counts SQL statements and Redis round trips (one per command or pipeline sent)"""
+
+    def __init__(self):
+        self.db = 0
+        self.redis = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {"db": self.db, "redis": self.redis}
+
+    def _incr(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def install(self, engines):
+        from sqlalchemy import event
+        import redis.connection
+        import redis.asyncio.connection
+
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", lambda *args: self._incr("db"))
+
+        sync_send = redis.connection.AbstractConnection.send_packed_command
+        async_send = redis.asyncio.connection.AbstractConnection.send_packed_command
+
+        @functools.wraps(sync_send)
+        def counted_send(connection, *args, **kwargs):
+            self._incr("redis")
+            return sync_send(connection, *args, **kwargs)
+
+        @functools.wraps(async_send)
+        async def counted_send_async(connection, *args, **kwargs):
+            self._incr("redis")
+            return await async_send(connection, *args, **kwargs)
+
+        redis.connection.AbstractConnection.send_packed_command = counted_send
+        redis.asyncio.connection.AbstractConnection.send_packed_command = counted_send_async
+
+def configure_environment(args):
+    if args.redis == "memory":
+        from tests.memory_redis import use_memory_redis
+        use_memory_redis()
+
+    database_url = args.database or f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db')}"
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["LLM_PROVIDER"] = "stub"
+    os.environ["STUB_LATENCY_MS"] = str(args.model_latency_ms)
+    os.environ["STUB_LATENCY_DISTRIBUTION"] = "fixed"
+    os.environ["STUB_OUTPUT_TOKENS"] = str(args.output_tokens)
+    os.environ["STUB_ERROR_RATE"] = "0"
+
+    for assignment in args.env:
+        name, _, value = assignment.partition("=")
+        os.environ[name] = value
+
+    return database_url
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(latencies: List[float], statuses: Counter, duration: float, round_trips: Dict[str, int]) -> dict:
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": sum(n for code, n in statuses.items() if code >= 400),
+        "status_codes": {str(code): n for code, n in sorted(statuses.items())},
+        "duration_s": round(duration, 4),
+        "requests_per_second": round(count / duration, 2) if duration else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / count * 1000, 3) if count else 0.0,
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if count else 0.0,
+        },
+        "db_round_trips_per_request": round(round_trips["db"] / count, 3) if count else 0.0,
+        "redis_round_trips_per_request": round(round_trips["redis"] / count, 3) if count else 0.0,
+    }
+
+class Benchmark:
+    def __init__(self, client, counter: RoundTripCounter, args):
+        self.client = client
+        self.counter = counter
+        self.args = args
+        self.prefix = "/api/v1"
+        self.sessions: List[str] = []
+
+    def session_payload(self) -> dict:
+        payload = {
+            "plan_type": self.args.plan,
+            "rate_limit_rpm": 10 ** 9,
+            "rate_limit_rpd": 10 ** 9,
+        }
+        if self.args.plan == "token":
+            payload["total_token_limit"] = 10 ** 12
+        return payload
+
+    async def create_session(self):
+        return await self.client.post(f"{self.prefix}/sessions/create", json=self.session_payload())
+
+    async def send_message(self, index: int):
+        session_token = self.sessions[index % len(self.sessions)]
+        return await self.client.post(
+            f"{self.prefix}/chat/message",
+            json={"message": f"Benchmark message {index}", "server_context": self.args.server_context, "use_cache": False},
+            headers={"X-Session-Token": session_token}
+        )
+
+    async def get_history(self, index: int):
+        session_token = self.sessions[index % len(self.sessions)]
+        return await self.client.get(
+            f"{self.prefix}/chat/history",
+            params={"limit": self.args.history_limit},
+            headers={"X-Session-Token": session_token}
+        )
+
+    async def run_requests(self, total: int, make_request):
+        latencies: List[float] = []
+        statuses: Counter = Counter()
+        next_index = 0
+
+        async def worker():
+            nonlocal next_index
+            while next_index < total:
+                index = next_index
+                next_index += 1
+                started = time.perf_counter()
+                try:
+                    response = await make_request(index)
+                    statuses[response.status_code] += 1
+                except Exception:
+                    statuses[599] += 1
+                latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.args.concurrency, total))))
+        return latencies, statuses
+
+    async def measure(self, make_request) -> dict:
+        if self.args.warmup:
+            await self.run_requests(self.args.warmup, make_request)
+
+        before = self.counter.snapshot()
+        started = time.perf_counter()
+        latencies, statuses = await self.run_requests(self.args.requests, make_request)
+        duration = time.perf_counter() - started
+        after = self.counter.snapshot()
+
+        return summarize(latencies, statuses, duration, {name: after[name] - before[name] for name in after})
+
+    async def setup_sessions(self):
+        while len(self.sessions) < self.args.sessions:
+            response = await self.create_session()
+            response.raise_for_status()
+            self.sessions.append(response.json()["session_token"])
+
+    async def seed_history(self):
+        for index in range(self.args.history_messages * len(self.sessions)):
+            (await self.send_message(index)).raise_for_status()
+
+    async def run(self, scenarios: List[str]) -> Dict[str, dict]:
+        results = {}
+        for scenario in scenarios:
+            if scenario == "create":
+                results[scenario] = await self.measure(lambda index: self.create_session())
+            elif scenario == "message":
+                await self.setup_sessions()
+                results[scenario] = await self.measure(self.send_message)
+            elif scenario == "history":
+                await self.setup_sessions()
+                await self.seed_history()
+                results[scenario] = await self.measure(self.get_history)
+        return results
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+async def run_inprocess(app, counter: RoundTripCounter, args, scenarios: List[str]):
+    import httpx
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            return await Benchmark(client, counter, args).run(scenarios)
+
+async def run_over_http(base_url: str, counter: RoundTripCounter, args, scenarios: List[str]):
+    import httpx
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        return await Benchmark(client, counter, args).run(scenarios)
+
+def run_uvicorn(app, counter: RoundTripCounter, args, scenarios: List[str]):
+    import uvicorn
+
+    port = get_free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("uvicorn failed to start")
+        time.sleep(0.05)
+
+    try:
+        return asyncio.run(run_over_http(f"http://127.0.0.1:{port}", counter, args, scenarios))
+    finally:
+        server.should_exit = True
+        thread.join()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Lightning Model API")
+    parser.add_argument("--mode", choices=("inprocess", "uvicorn"), default="inprocess")
+    parser.add_argument("--scenario", default=",".join(SCENARIOS), help="comma-separated subset of create,message,history")
+    parser.add_argument("--redis", choices=("local", "memory"), default="memory")
+    parser.add_argument("--database", default=None, help="SQLAlchemy URL, a temporary SQLite file by default")
+    parser.add_argument("--plan", choices=("token", "request"), default="token")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--sessions", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--history-messages", type=int, default=10, help="exchanges seeded per session for the history scenario")
+    parser.add_argument("--history-limit", type=int, default=50)
+    parser.add_argument("--server-context", action="store_true", help="send /chat/message with server_context")
+    parser.add_argument("--model-latency-ms", type=float, default=0.0)
+    parser.add_argument("--output-tokens", type=int, default=64)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="extra settings for the app")
+    parser.add_argument("--output", default=None, help="write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [name.strip() for name in args.scenario.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenario: {', '.join(sorted(unknown))}")
+
+    database_url = configure_environment(args)
+
+    from app.migrations import upgrade
+    upgrade()
+
+    from app.main import app
+    from app.data import engine, async_engine
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    counter = RoundTripCounter()
+    counter.install([engine, async_engine.sync_engine])
+
+    if args.mode == "inprocess":
+        results = asyncio.run(run_inprocess(app, counter, args, scenarios))
+    else:
+        results = run_uvicorn(app, counter, args, scenarios)
+
+    report = {
+        "commit": get_git_commit(),
+        "python": platform.python_version(),
+        "config": {
+            "mode": args.mode,
+            "redis": args.redis,
+            "database": database_url.split(":", 1)[0],
+            "plan": args.plan,
+            "concurrency": args.concurrency,
+            "sessions": args.sessions,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "server_context": args.server_context,
+            "model_latency_ms": args.model_latency_ms,
+            "output_tokens": args.output_tokens,
+            "env": args.env,
+        },
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    sys.exit(main())
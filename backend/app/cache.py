@@ -0,0 +1,420 @@
+import time
+import json
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.session import make_transient_to_detached
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import settings, redis_client, async_redis_client, run_pipeline, run_pipeline_async, redis_call, redis_call_async, session_key
+from app.data import ChatSession
+from app.fallback import LocalLimiter
+
+INCR_REQUEST_COUNT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local count = tonumber(redis.call('HGET', KEYS[1], 'request_count') or '0')
+local limit = tonumber(ARGV[1])
+local delta = tonumber(ARGV[2])
+if delta > 0 and limit >= 0 and count >= limit then
+    return -1
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return redis.call('HINCRBY', KEYS[1], 'request_count', delta)
+"""
+
+HSET_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return 1
+"""
+
+RESPONSE_CACHE_SET_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[2]))
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local evicted = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+    redis.call('DEL', unpack(evicted))
+end
+return 1
+"""
+
+class TTLCache:
+    """Thread-safe, size-bounded LRU cache whose entries expire after a fixed TTL"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class SessionCache:
+    """
+    Read-through cache for ChatSession rows.
+    Lookups go request-scoped dict -> process-local TTL/LRU -> Redis hash -> SQL.
+    Counters are only kept in the Redis hash, the local tier holds the row as of the last fill.
+    While Redis is unavailable lookups fall through to SQL and request counts are kept by
+    LocalLimiter; hashes that missed a write are dropped once Redis is back.
+    """
+
+    _local = TTLCache(maxsize=settings.SESSION_CACHE_SIZE, ttl=settings.SESSION_CACHE_TTL)
+
+    _incr_script = redis_client.register_script(INCR_REQUEST_COUNT_SCRIPT)
+    _hset_script = redis_client.register_script(HSET_IF_EXISTS_SCRIPT)
+    _async_incr_script = async_redis_client.register_script(INCR_REQUEST_COUNT_SCRIPT)
+    _async_hset_script = async_redis_client.register_script(HSET_IF_EXISTS_SCRIPT)
+
+    @staticmethod
+    def _get_session_key(session_token: str) -> str:
+        """Generate a key for the cached session hash in Redis"""
+        return session_key("session", session_token)
+
+    @staticmethod
+    def _encode(value) -> str:
+        if value is None:
+            return ""
+        if isinstance(value, bool):
+            return "1" if value else "0"
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        return str(value)
+
+    @staticmethod
+    def _decode(column, value: str):
+        if value == "" and column.nullable:
+            return None
+        python_type = column.type.python_type
+        if python_type is bool:
+            return value == "1"
+        if python_type is datetime.datetime:
+            return datetime.datetime.fromisoformat(value)
+        return python_type(value)
+
+    @classmethod
+    def _to_fields(cls, session: ChatSession) -> Dict[str, str]:
+        return {
+            column.name: cls._encode(getattr(session, column.name))
+            for column in ChatSession.__table__.columns
+        }
+
+    @staticmethod
+    def _is_complete(fields: Optional[Dict[str, str]]) -> bool:
+        return bool(fields) and all(column.name in fields for column in ChatSession.__table__.columns)
+
+    @classmethod
+    def _from_fields(cls, fields: Dict[str, str]) -> ChatSession:
+        """Build a detached ChatSession, so callers can read it like a queried row"""
+        session = ChatSession(**{
+            column.name: cls._decode(column, fields[column.name])
+            for column in ChatSession.__table__.columns
+        })
+        make_transient_to_detached(session)
+        return session
+
+    @classmethod
+    def _remember(cls, session_token: str, fields: Dict[str, str], request_cache: Optional[dict]):
+        cls._local.set(session_token, fields)
+        session = cls._from_fields(fields)
+        if request_cache is not None:
+            request_cache[session_token] = session
+        return session
+
+    @classmethod
+    def get(cls, db: Session, session_token: str, request_cache: Optional[dict] = None, use_local: bool = True) -> Optional[ChatSession]:
+        """
+        Look up a session by token, active or not.
+        Pass use_local=False when the caller needs current counters rather than just the configuration.
+        """
+        if request_cache is not None and session_token in request_cache:
+            return request_cache[session_token]
+
+        fields = cls._local.get(session_token) if use_local else None
+        if fields is None:
+            key = cls._get_session_key(session_token)
+            fields = redis_call(lambda: redis_client.hgetall(key), dict)
+        if not cls._is_complete(fields):
+            session = db.query(ChatSession).filter(
+                ChatSession.session_token == session_token
+            ).first()
+            if not session:
+                return None
+            fields = cls.store(session)
+
+        return cls._remember(session_token, fields, request_cache)
+
+    @classmethod
+    async def get_async(cls, db: AsyncSession, session_token: str, request_cache: Optional[dict] = None, use_local: bool = True) -> Optional[ChatSession]:
+        """Async variant of get"""
+        if request_cache is not None and session_token in request_cache:
+            return request_cache[session_token]
+
+        fields = cls._local.get(session_token) if use_local else None
+        if fields is None:
+            key = cls._get_session_key(session_token)
+            fields = await redis_call_async(lambda: async_redis_client.hgetall(key), dict)
+        if not cls._is_complete(fields):
+            result = await db.execute(
+                select(ChatSession).filter(ChatSession.session_token == session_token)
+            )
+            session = result.scalars().first()
+            if not session:
+                return None
+            fields = await cls.store_async(session)
+
+        return cls._remember(session_token, fields, request_cache)
+
+    @classmethod
+    def _queue_store(cls, pipe, session_token: str, fields: Dict[str, str]):
+        key = cls._get_session_key(session_token)
+        pipe.hset(key, mapping=fields)
+        pipe.expire(key, settings.SESSION_CACHE_REDIS_TTL)
+
+    @classmethod
+    def store(cls, session: ChatSession) -> Dict[str, str]:
+        """Write a freshly loaded or created session into the Redis tier"""
+        fields = cls._to_fields(session)
+        redis_call(lambda: run_pipeline(lambda pipe: cls._queue_store(pipe, session.session_token, fields)), lambda: None)
+        return fields
+
+    @classmethod
+    async def store_async(cls, session: ChatSession) -> Dict[str, str]:
+        """Async variant of store"""
+        fields = cls._to_fields(session)
+        await redis_call_async(lambda: run_pipeline_async(lambda pipe: cls._queue_store(pipe, session.session_token, fields)), lambda: None)
+        return fields
+
+    @classmethod
+    def incr_request_count(cls, db: Session, session: ChatSession, delta: int = 1) -> Optional[int]:
+        """
+        Atomically bump the cached request_count, refusing to go past total_requests_limit.
+        Returns the new count, or None when the limit is already reached.
+        """
+        limit = session.total_requests_limit if session.total_requests_limit is not None else -1
+        key = cls._get_session_key(session.session_token)
+
+        def increment():
+            count = cls._incr_script(keys=[key], args=[limit, delta, settings.SESSION_CACHE_REDIS_TTL])
+            if count is None:
+                fresh = db.query(ChatSession).filter(ChatSession.id == session.id).first()
+                cls.store(fresh)
+                count = cls._incr_script(keys=[key], args=[limit, delta, settings.SESSION_CACHE_REDIS_TTL])
+            return count
+
+        count = int(redis_call(increment, lambda: cls._incr_locally(session, delta)))
+        return None if count < 0 else count
+
+    @classmethod
+    async def incr_request_count_async(cls, db: AsyncSession, session: ChatSession, delta: int = 1) -> Optional[int]:
+        """Async variant of incr_request_count"""
+        limit = session.total_requests_limit if session.total_requests_limit is not None else -1
+        key = cls._get_session_key(session.session_token)
+
+        async def increment():
+            count = await cls._async_incr_script(keys=[key], args=[limit, delta, settings.SESSION_CACHE_REDIS_TTL])
+            if count is None:
+                result = await db.execute(select(ChatSession).filter(ChatSession.id == session.id))
+                await cls.store_async(result.scalars().first())
+                count = await cls._async_incr_script(keys=[key], args=[limit, delta, settings.SESSION_CACHE_REDIS_TTL])
+            return count
+
+        count = int(await redis_call_async(increment, lambda: cls._incr_locally(session, delta)))
+        return None if count < 0 else count
+
+    @classmethod
+    def _incr_locally(cls, session: ChatSession, delta: int) -> int:
+        """Fallback of incr_request_count while Redis is unavailable, with the script's -1 for a reached limit"""
+        LocalLimiter.mark_stale(cls._get_session_key(session.session_token))
+        count = LocalLimiter.incr_request_count(session, delta)
+        return -1 if count is None else count
+
+    @classmethod
+    def _hset_args(cls, fields: Dict[str, Any]):
+        args = []
+        for name, value in fields.items():
+            args.extend([name, cls._encode(value)])
+        return args
+
+    @classmethod
+    def update_fields(cls, session_token: str, **fields):
+        """Update hot counters in the Redis tier if the session is cached there"""
+        key = cls._get_session_key(session_token)
+        redis_call(lambda: cls._hset_script(keys=[key], args=cls._hset_args(fields)), lambda: LocalLimiter.mark_stale(key))
+
+    @classmethod
+    async def update_fields_async(cls, session_token: str, **fields):
+        """Async variant of update_fields"""
+        key = cls._get_session_key(session_token)
+        await redis_call_async(lambda: cls._async_hset_script(keys=[key], args=cls._hset_args(fields)), lambda: LocalLimiter.mark_stale(key))
+
+    @classmethod
+    def invalidate(cls, session_token: str):
+        """Drop a session from every tier after its configuration changed"""
+        cls._local.pop(session_token)
+        key = cls._get_session_key(session_token)
+        redis_call(lambda: redis_client.delete(key), lambda: LocalLimiter.mark_stale(key))
+
+    @classmethod
+    async def invalidate_async(cls, session_token: str):
+        """Async variant of invalidate"""
+        cls._local.pop(session_token)
+        key = cls._get_session_key(session_token)
+        await redis_call_async(lambda: async_redis_client.delete(key), lambda: LocalLimiter.mark_stale(key))
+
+    @classmethod
+    def invalidate_many(cls, session_tokens: List[str]):
+        """invalidate for a batch of sessions, in one round trip"""
+        keys = []
+        for session_token in session_tokens:
+            cls._local.pop(session_token)
+            keys.append(cls._get_session_key(session_token))
+
+        def queue(pipe):
+            for key in keys:
+                pipe.delete(key)
+
+        def mark_stale():
+            for key in keys:
+                LocalLimiter.mark_stale(key)
+
+        redis_call(lambda: run_pipeline(queue, transaction=False), mark_stale)
+
+class ResponseCache:
+    """
+    Exact-match cache of model responses, keyed on a hash of (model, generation_config,
+    history, message); texts only have leading and trailing whitespace stripped, as any
+    other whitespace can change the answer. A process-local LRU sits in front
+    of a Redis tier that expires entries after RESPONSE_CACHE_TTL and evicts the
+    oldest ones beyond RESPONSE_CACHE_MAX_ENTRIES.
+    """
+
+    INDEX_KEY = "{respcache}:index"
+
+    _local = TTLCache(maxsize=settings.RESPONSE_CACHE_LOCAL_SIZE, ttl=settings.RESPONSE_CACHE_TTL)
+
+    _set_script = redis_client.register_script(RESPONSE_CACHE_SET_SCRIPT)
+    _async_set_script = async_redis_client.register_script(RESPONSE_CACHE_SET_SCRIPT)
+
+    @staticmethod
+    def enabled() -> bool:
+        return settings.RESPONSE_CACHE
+
+    @staticmethod
+    def _get_entry_key(cache_key: str) -> str:
+        """Generate a key for a cached response in Redis"""
+        return f"{{respcache}}:entry:{cache_key}"
+
+    @staticmethod
+    def make_key(model_name: str, generation_config: Dict[str, Any], history, message: str) -> str:
+        key = {
+            "model": model_name,
+            "generation_config": generation_config,
+            "history": [[msg.role, msg.content.strip()] for msg in history],
+            "message": message.strip(),
+        }
+        encoded = json.dumps(key, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def get(cls, cache_key: str) -> Optional[dict]:
+        entry = cls._local.get(cache_key)
+        if entry is None:
+            value = redis_call(lambda: redis_client.get(cls._get_entry_key(cache_key)), lambda: None)
+            if value is None:
+                return None
+            entry = json.loads(value)
+            cls._local.set(cache_key, entry)
+        return entry
+
+    @classmethod
+    async def get_async(cls, cache_key: str) -> Optional[dict]:
+        """Async variant of get"""
+        entry = cls._local.get(cache_key)
+        if entry is None:
+            value = await redis_call_async(lambda: async_redis_client.get(cls._get_entry_key(cache_key)), lambda: None)
+            if value is None:
+                return None
+            entry = json.loads(value)
+            cls._local.set(cache_key, entry)
+        return entry
+
+    @classmethod
+    def _set_params(cls, cache_key: str, entry: dict):
+        value = json.dumps(entry)
+        if len(value) > settings.RESPONSE_CACHE_MAX_ENTRY_BYTES:
+            return None
+        keys = [cls._get_entry_key(cache_key), cls.INDEX_KEY]
+        args = [value, settings.RESPONSE_CACHE_TTL, int(time.time()), settings.RESPONSE_CACHE_MAX_ENTRIES]
+        return keys, args
+
+    @classmethod
+    def set(cls, cache_key: str, entry: dict):
+        params = cls._set_params(cache_key, entry)
+        if params is None:
+            return
+        cls._local.set(cache_key, entry)
+        redis_call(lambda: cls._set_script(keys=params[0], args=params[1]), lambda: None)
+
+    @classmethod
+    async def set_async(cls, cache_key: str, entry: dict):
+        """Async variant of set"""
+        params = cls._set_params(cache_key, entry)
+        if params is None:
+            return
+        cls._local.set(cache_key, entry)
+        await redis_call_async(lambda: cls._async_set_script(keys=params[0], args=params[1]), lambda: None)
+
+    @staticmethod
+    def billed_tokens(entry: dict) -> int:
+        """Tokens a token-plan session is charged for a hit under RESPONSE_CACHE_BILLING"""
+        if settings.RESPONSE_CACHE_BILLING == "none":
+            return 0
+        return entry["total_tokens"]
+
+    @staticmethod
+    def bills_request() -> bool:
+        """Whether a hit counts against a request-plan session's total_requests_limit and rate limits, per RESPONSE_CACHE_REQUEST_BILLING"""
+        return settings.RESPONSE_CACHE_REQUEST_BILLING != "none"
+
+def get_request_session_cache() -> dict:
+    """Request-scoped identity cache, shared by every dependency of one request"""
+    return {}
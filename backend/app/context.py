@@ -0,0 +1,129 @@
+import json
+from typing import List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import settings, redis_client, async_redis_client, run_pipeline, run_pipeline_async, redis_call, redis_call_async, session_key
+from app.data import ChatSession, ChatMessage, MessageBase
+from app.fallback import LocalLimiter
+from app.persistence import WriteBehind
+from app.tokenizer import Tokenizer
+
+class ConversationContext:
+    """
+    Server-side conversation state.
+    The most recent messages of a session are cached in a Redis list and rebuilt from
+    chat_messages on a miss; each turn is then fitted to CONTEXT_TOKEN_BUDGET by
+    dropping the oldest messages. While Redis is unavailable the context is read from SQL.
+    """
+
+    @staticmethod
+    def _get_context_key(session_token: str) -> str:
+        """Generate a key for the cached conversation of a session"""
+        return session_key("context", session_token)
+
+    @staticmethod
+    def count_tokens(content: str) -> int:
+        return max(Tokenizer.count(content), 1)
+
+    @staticmethod
+    def _encode_many(messages) -> List[str]:
+        """Encode (role, content) pairs with their token counts, counted in one batch"""
+        counts = Tokenizer.count_many([content for _, content in messages])
+        return [
+            json.dumps({"role": role, "content": content, "tokens": max(tokens, 1)})
+            for (role, content), tokens in zip(messages, counts)
+        ]
+
+    @staticmethod
+    def _recent_messages_query(session: ChatSession):
+        return select(ChatMessage.role, ChatMessage.content).where(
+            ChatMessage.session_id == session.id
+        ).order_by(ChatMessage.id.desc()).limit(settings.CONTEXT_MAX_MESSAGES)
+
+    @classmethod
+    def fit_to_budget(cls, entries: List[dict], message: str, budget: Optional[int] = None) -> List[MessageBase]:
+        """Keep the newest messages that fit the budget alongside the new message, starting on a user turn"""
+        budget = settings.CONTEXT_TOKEN_BUDGET if budget is None else budget
+        remaining = budget - cls.count_tokens(message)
+
+        kept = []
+        for entry in reversed(entries):
+            remaining -= entry["tokens"]
+            if remaining < 0:
+                break
+            kept.append(entry)
+        kept.reverse()
+
+        while kept and kept[0]["role"] != "user":
+            kept.pop(0)
+
+        return [MessageBase(role=entry["role"], content=entry["content"]) for entry in kept]
+
+    @classmethod
+    def _queue_fill(cls, pipe, session: ChatSession, entries: List[str]):
+        key = cls._get_context_key(session.session_token)
+        pipe.delete(key)
+        if entries:
+            pipe.rpush(key, *entries)
+        pipe.expire(key, settings.CONTEXT_CACHE_TTL)
+
+    @classmethod
+    def get_history(cls, db: Session, session: ChatSession, message: str) -> List[MessageBase]:
+        """Rebuild the context for a new message from the cached or stored conversation"""
+        key = cls._get_context_key(session.session_token)
+        cached = redis_call(lambda: redis_client.lrange(key, 0, -1), list)
+
+        if cached:
+            entries = [json.loads(entry) for entry in cached]
+        else:
+            if WriteBehind.enabled():
+                WriteBehind.flush_session(db, session)
+            rows = db.execute(cls._recent_messages_query(session)).all()
+            encoded = cls._encode_many(list(reversed(rows)))
+            redis_call(lambda: run_pipeline(lambda pipe: cls._queue_fill(pipe, session, encoded)), lambda: None)
+            entries = [json.loads(entry) for entry in encoded]
+
+        return cls.fit_to_budget(entries, message)
+
+    @classmethod
+    async def get_history_async(cls, db: AsyncSession, session: ChatSession, message: str) -> List[MessageBase]:
+        """Async variant of get_history"""
+        key = cls._get_context_key(session.session_token)
+        cached = await redis_call_async(lambda: async_redis_client.lrange(key, 0, -1), list)
+
+        if cached:
+            entries = [json.loads(entry) for entry in cached]
+        else:
+            if WriteBehind.enabled():
+                await WriteBehind.flush_session_async(db, session)
+            rows = (await db.execute(cls._recent_messages_query(session))).all()
+            encoded = cls._encode_many(list(reversed(rows)))
+            await redis_call_async(lambda: run_pipeline_async(lambda pipe: cls._queue_fill(pipe, session, encoded)), lambda: None)
+            entries = [json.loads(entry) for entry in encoded]
+
+        return cls.fit_to_budget(entries, message)
+
+    @classmethod
+    def _queue_append(cls, pipe, session: ChatSession, messages: List[ChatMessage]):
+        key = cls._get_context_key(session.session_token)
+        pipe.rpushx(key, *cls._encode_many([(message.role, message.content) for message in messages]))
+        pipe.ltrim(key, -settings.CONTEXT_MAX_MESSAGES, -1)
+
+    @classmethod
+    def append(cls, session: ChatSession, messages: List[ChatMessage]):
+        """Extend a cached conversation with a finished exchange; a missing cache is left to be rebuilt"""
+        redis_call(
+            lambda: run_pipeline(lambda pipe: cls._queue_append(pipe, session, messages), transaction=False),
+            lambda: LocalLimiter.mark_stale(cls._get_context_key(session.session_token))
+        )
+
+    @classmethod
+    async def append_async(cls, session: ChatSession, messages: List[ChatMessage]):
+        """Async variant of append"""
+        await redis_call_async(
+            lambda: run_pipeline_async(lambda pipe: cls._queue_append(pipe, session, messages), transaction=False),
+            lambda: LocalLimiter.mark_stale(cls._get_context_key(session.session_token))
+        )
@@ -1,92 +1,391 @@
 import os
 import time
+import asyncio
+import logging
+import threading
 from datetime import datetime
 from fastapi import Depends, HTTPException, status, Header
 from sqlalchemy.orm import Session
-from typing import Optional
+from typing import Any, Callable, Dict, Literal, Optional
 from pydantic_settings import BaseSettings
-from redis import Redis
+from redis import Redis, BlockingConnectionPool
+from redis.asyncio import Redis as AsyncRedis, BlockingConnectionPool as AsyncBlockingConnectionPool
+from redis.cluster import RedisCluster
+from redis.asyncio.cluster import RedisCluster as AsyncRedisCluster
+from redis.backoff import ExponentialWithJitterBackoff
+from redis.retry import Retry
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+from app.metrics import Metrics
 
 class Settings(BaseSettings):
     APP_NAME: str = "Lightning Model API"
     API_V1_STR: str = "/api/v1"
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///./app.db")
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 5.0
+    DB_POOL_RECYCLE: int = 1800
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 500
+    SQLITE_JOURNAL_MODE: Literal["WAL", "DELETE", "TRUNCATE", "MEMORY"] = "WAL"
+    SQLITE_SYNCHRONOUS: Literal["OFF", "NORMAL", "FULL"] = "NORMAL"
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
     DEFAULT_RATE_LIMIT_RPM: int = 15
     DEFAULT_RATE_LIMIT_RPD: int = 1500
+    GLOBAL_RATE_LIMIT_RPM: int = 0
+    GLOBAL_RATE_LIMIT_RPD: int = 0
+    GLOBAL_TOKEN_LIMIT_TPM: int = 0
     SECRET_KEY: str = os.getenv("SECRET_KEY", "your-secret-key-for-development")
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     GEMINI_API_KEY: str = os.getenv("GEMINI_API_KEY", "")
+    GEMINI_MODEL: str = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+    GEMINI_TRANSPORT: Optional[str] = os.getenv("GEMINI_TRANSPORT", None)
+    GENERATION_PROFILES: Dict[str, Dict[str, Any]] = {
+        "default": {"temperature": 0.7, "top_k": 40, "top_p": 0.95, "max_output_tokens": 1024},
+        "concise": {"temperature": 0.5, "top_k": 40, "top_p": 0.95, "max_output_tokens": 256},
+        "extended": {"temperature": 0.7, "top_k": 40, "top_p": 0.95, "max_output_tokens": 4096},
+    }
+    DEFAULT_GENERATION_PROFILE: str = "default"
+    PLAN_GENERATION_PROFILES: Dict[str, str] = {"request": "default", "token": "default"}
     REDIS_HOST: str = os.getenv("REDIS_HOST", "localhost")
     REDIS_PORT: int = int(os.getenv("REDIS_PORT", "6379"))
     REDIS_PASSWORD: Optional[str] = os.getenv("REDIS_PASSWORD", None)
+    REDIS_CLUSTER: bool = os.getenv("REDIS_CLUSTER", "false").lower() == "true"
+    REDIS_MAX_CONNECTIONS: int = 64
+    REDIS_POOL_TIMEOUT: float = 2.0
+    REDIS_SOCKET_TIMEOUT: float = 2.0
+    REDIS_CONNECT_TIMEOUT: float = 1.0
+    REDIS_RETRY_ATTEMPTS: int = 2
+    REDIS_RETRY_BACKOFF_BASE: float = 0.01
+    REDIS_RETRY_BACKOFF_CAP: float = 0.25
+    REDIS_HEALTH_INTERVAL: float = 5.0
+    REDIS_CIRCUIT_FAILURES: int = 3
+    REDIS_CIRCUIT_RESET: float = 5.0
+    FALLBACK_MAX_SESSIONS: int = 10000
+    ADMISSION_CONTROL: bool = os.getenv("ADMISSION_CONTROL", "false").lower() == "true"
+    ADMISSION_MAX_CONCURRENCY: int = 64
+    ADMISSION_MAX_RPS: float = 0.0
+    ADMISSION_BURST: int = 10
+    ADMISSION_QUEUE_SIZE: int = 256
+    ADMISSION_QUEUE_TIMEOUT: float = 10.0
+    ADMISSION_POLL_INTERVAL: float = 0.05
+    ADMISSION_WAITER_TTL: float = 2.0
+    ADMISSION_LEASE: float = 300.0
+    ADMISSION_PLAN_PRIORITY: Dict[str, int] = {"token": 0, "request": 1}
+    SESSION_BATCH_MAX_SIZE: int = 10000
+    TOKEN_RESERVATION_TTL: int = 86400
+    IDEMPOTENCY_TTL: int = 86400
+    IDEMPOTENCY_LOCK_TTL: int = 300
+    IDEMPOTENCY_WAIT_TIMEOUT: float = 60.0
+    IDEMPOTENCY_POLL_INTERVAL: float = 0.05
+    ASYNC_DATABASE_URL: Optional[str] = os.getenv("ASYNC_DATABASE_URL", None)
+    ASYNC_CHAT: bool = os.getenv("ASYNC_CHAT", "true").lower() == "true"
+    SESSION_CACHE_SIZE: int = 10000
+    SESSION_CACHE_TTL: float = 5.0
+    SESSION_CACHE_REDIS_TTL: int = 3600
+    WRITE_BEHIND: bool = os.getenv("WRITE_BEHIND", "false").lower() == "true"
+    WRITE_BEHIND_CONSUMER: bool = os.getenv("WRITE_BEHIND_CONSUMER", "true").lower() == "true"
+    WRITE_BEHIND_BATCH_SIZE: int = 500
+    WRITE_BEHIND_BLOCK_MS: int = 1000
+    WRITE_BEHIND_CLAIM_IDLE_MS: int = 30000
+    WRITE_BEHIND_MAX_DELIVERIES: int = 5
+    USAGE_FLUSH_INTERVAL: float = 5.0
+    USAGE_FLUSH_BATCH_SIZE: int = 500
+    USAGE_SWEEP_INTERVAL: float = 300.0
+    SESSION_TTL: int = 0
+    RETENTION: bool = os.getenv("RETENTION", "false").lower() == "true"
+    RETENTION_ARCHIVE_DIR: str = os.getenv("RETENTION_ARCHIVE_DIR", "./archive")
+    RETENTION_ARCHIVE_AFTER: int = 86400
+    RETENTION_INTERVAL: float = 3600.0
+    RETENTION_BATCH_SIZE: int = 100
+    RETENTION_SEGMENT_MAX_BYTES: int = 64 * 1024 * 1024
+    CONTEXT_TOKEN_BUDGET: int = 8000
+    CONTEXT_MAX_MESSAGES: int = 200
+    CONTEXT_CACHE_TTL: int = 3600
+    RESPONSE_CACHE: bool = os.getenv("RESPONSE_CACHE", "false").lower() == "true"
+    RESPONSE_CACHE_TTL: int = 3600
+    RESPONSE_CACHE_LOCAL_SIZE: int = 1000
+    RESPONSE_CACHE_MAX_ENTRIES: int = 100000
+    RESPONSE_CACHE_MAX_ENTRY_BYTES: int = 64 * 1024
+    RESPONSE_CACHE_BILLING: Literal["full", "none"] = "full"
+    RESPONSE_CACHE_REQUEST_BILLING: Literal["full", "none"] = "full"
+    TOKENIZER_MODEL_PATH: Optional[str] = os.getenv("TOKENIZER_MODEL_PATH", None)
+    TOKENIZER_CACHE_SIZE: int = 50000
+    TOKENIZER_CACHE_TTL: int = 3600
+    TOKENIZER_TOKENS_PER_TURN: int = 5
+    LLM_PROVIDER: Literal["gemini", "stub"] = os.getenv("LLM_PROVIDER", "gemini")
+    STUB_LATENCY_DISTRIBUTION: Literal["fixed", "uniform", "lognormal"] = "lognormal"
+    STUB_LATENCY_MS: float = 200.0
+    STUB_LATENCY_SPREAD: float = 0.25
+    STUB_OUTPUT_TOKENS: int = 256
+    STUB_STREAM_CHUNK_TOKENS: int = 32
+    STUB_ERROR_RATE: float = 0.0
+    STUB_SEED: int = 0
+    LIGHTNING: bool = os.getenv("LIGHTNING", "false").lower() == "true"
+    LIGHTNING_BACKEND: Literal["lnd", "mock"] = os.getenv("LIGHTNING_BACKEND", "lnd")
+    LIGHTNING_SUBSCRIBER: bool = os.getenv("LIGHTNING_SUBSCRIBER", "true").lower() == "true"
+    LIGHTNING_REQUIRE_PAYMENT: bool = os.getenv("LIGHTNING_REQUIRE_PAYMENT", "false").lower() == "true"
+    LND_REST_HOST: str = os.getenv("LND_REST_HOST", "")
+    LND_MACAROON: str = os.getenv("LND_MACAROON", "")
+    LND_TLS_CERT_PATH: Optional[str] = os.getenv("LND_TLS_CERT_PATH", None)
+    LIGHTNING_SATS_PER_TOKEN: float = 10.0
+    LIGHTNING_SATS_PER_REQUEST: float = 500.0
+    LIGHTNING_INVOICE_EXPIRY: int = 900
+    LIGHTNING_MAX_WAIT: float = 60.0
+    LIGHTNING_SETTLED_TTL: int = 86400
+    LIGHTNING_RECONNECT_BACKOFF_CAP: float = 30.0
+    LIGHTNING_MOCK_SETTLE_AFTER: float = 0.0
     
     class Config:
         env_file = ".env"
 
 settings = Settings()
 
-redis_client = Redis(
-    host=settings.REDIS_HOST,
-    port=settings.REDIS_PORT,
-    db=0,
-    decode_responses=True,
-    password=settings.REDIS_PASSWORD
-)
+logger = logging.getLogger(__name__)
 
-def test_redis_connection():
-    try:
-        redis_client.ping()
-        return True
-    except Exception as e:
-        print(f"Redis connection error: {e}")
+def _redis_connection_kwargs(retry) -> Dict[str, Any]:
+    return {
+        "host": settings.REDIS_HOST,
+        "port": settings.REDIS_PORT,
+        "password": settings.REDIS_PASSWORD,
+        "decode_responses": True,
+        "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": settings.REDIS_CONNECT_TIMEOUT,
+        "retry": retry,
+    }
+
+def _redis_backoff():
+    return ExponentialWithJitterBackoff(cap=settings.REDIS_RETRY_BACKOFF_CAP, base=settings.REDIS_RETRY_BACKOFF_BASE)
+
+if settings.REDIS_CLUSTER:
+    # REDIS_HOST:REDIS_PORT is any cluster node; the clients discover the others and keep a pool per node
+    redis_pool = async_redis_pool = None
+    redis_client = RedisCluster(
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        **_redis_connection_kwargs(Retry(_redis_backoff(), settings.REDIS_RETRY_ATTEMPTS))
+    )
+    async_redis_client = AsyncRedisCluster(
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        **_redis_connection_kwargs(AsyncRetry(_redis_backoff(), settings.REDIS_RETRY_ATTEMPTS))
+    )
+else:
+    # One pool per process for sync callers and one for the event loop; every module goes through these clients
+    redis_pool = BlockingConnectionPool(
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+        **_redis_connection_kwargs(Retry(_redis_backoff(), settings.REDIS_RETRY_ATTEMPTS))
+    )
+    redis_client = Redis(
+        connection_pool=redis_pool,
+        retry=Retry(_redis_backoff(), settings.REDIS_RETRY_ATTEMPTS)
+    )
+
+    async_redis_pool = AsyncBlockingConnectionPool(
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+        **_redis_connection_kwargs(AsyncRetry(_redis_backoff(), settings.REDIS_RETRY_ATTEMPTS))
+    )
+    async_redis_client = AsyncRedis(
+        connection_pool=async_redis_pool,
+        retry=AsyncRetry(_redis_backoff(), settings.REDIS_RETRY_ATTEMPTS)
+    )
+
+def session_key(prefix: str, session_token: str, *parts) -> str:
+    """
+    Redis key of per-session state, e.g. token_bucket:{<token>} or ratelimit:{<token>}:rpm.
+    The braced token is a hash tag, so every key of a session maps to the same Redis Cluster
+    slot and the limiter scripts and pipelines touching several of them stay single-slot.
+    """
+    return ":".join([prefix, "{" + session_token + "}", *(str(part) for part in parts)])
+
+def run_pipeline(queue: Callable, transaction: bool = True) -> list:
+    """Let queue(pipe) add commands to a pipeline, then send them in one round trip"""
+    pipe = redis_client.pipeline(transaction=transaction)
+    queue(pipe)
+    return pipe.execute()
+
+async def run_pipeline_async(queue: Callable, transaction: bool = True) -> list:
+    """Async variant of run_pipeline"""
+    pipe = async_redis_client.pipeline(transaction=transaction)
+    queue(pipe)
+    return await pipe.execute()
+
+REDIS_UNAVAILABLE_ERRORS = (RedisConnectionError, RedisTimeoutError)
+
+class RedisCircuit:
+    """
+    Circuit breaker in front of Redis.
+    After REDIS_CIRCUIT_FAILURES consecutive connection errors or timeouts the circuit opens
+    and callers go straight to their fallback; one probe is let through every REDIS_CIRCUIT_RESET seconds.
+    """
+
+    _failures = 0
+    _opened_at: Optional[float] = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def allow(cls) -> bool:
+        if cls._opened_at is None:
+            return True
+        with cls._lock:
+            if cls._opened_at is not None and time.monotonic() - cls._opened_at >= settings.REDIS_CIRCUIT_RESET:
+                cls._opened_at = time.monotonic()
+                return True
         return False
 
+    @classmethod
+    def is_open(cls) -> bool:
+        return cls._opened_at is not None
+
+    @classmethod
+    def record_success(cls):
+        if cls._failures or cls._opened_at is not None:
+            with cls._lock:
+                if cls._opened_at is not None:
+                    logger.info("Redis is reachable again, closing the circuit")
+                cls._failures = 0
+                cls._opened_at = None
+
+    @classmethod
+    def record_failure(cls):
+        with cls._lock:
+            cls._failures += 1
+            if cls._opened_at is None and cls._failures >= settings.REDIS_CIRCUIT_FAILURES:
+                logger.warning("Redis is unavailable, switching to the local fallback")
+                cls._opened_at = time.monotonic()
+
+def redis_call(operation: Callable, fallback: Callable):
+    """Run operation() against Redis, or fallback() when the circuit is open or Redis is unreachable"""
+    if not RedisCircuit.allow():
+        return fallback()
+    try:
+        result = operation()
+    except REDIS_UNAVAILABLE_ERRORS:
+        RedisCircuit.record_failure()
+        return fallback()
+    RedisCircuit.record_success()
+    return result
+
+async def redis_call_async(operation: Callable, fallback: Callable):
+    """Async variant of redis_call; operation returns an awaitable, fallback is a plain callable"""
+    if not RedisCircuit.allow():
+        return fallback()
+    try:
+        result = await operation()
+    except REDIS_UNAVAILABLE_ERRORS:
+        RedisCircuit.record_failure()
+        return fallback()
+    RedisCircuit.record_success()
+    return result
+
+class RedisHealth:
+    """
+    Redis health as last seen by a background monitor.
+    /health reads the cached status instead of sending a PING per probe.
+    """
+
+    _status: Dict[str, Any] = {"connected": False, "latency_ms": None, "checked_at": None, "error": "not checked yet"}
+
+    @classmethod
+    async def check(cls) -> bool:
+        started = time.perf_counter()
+        try:
+            await async_redis_client.ping()
+            RedisCircuit.record_success()
+            cls._status = {
+                "connected": True,
+                "latency_ms": round((time.perf_counter() - started) * 1000, 3),
+                "checked_at": datetime.utcnow().isoformat(),
+                "error": None,
+            }
+        except Exception as e:
+            RedisCircuit.record_failure()
+            if cls._status["connected"]:
+                logger.error(f"Redis connection error: {e}")
+            cls._status = {
+                "connected": False,
+                "latency_ms": None,
+                "checked_at": datetime.utcnow().isoformat(),
+                "error": str(e),
+            }
+        return cls._status["connected"]
+
+    @classmethod
+    async def run(cls, stop_event: asyncio.Event):
+        """Refresh the cached status every REDIS_HEALTH_INTERVAL seconds until stop_event is set"""
+        while not stop_event.is_set():
+            await cls.check()
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=settings.REDIS_HEALTH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    @classmethod
+    def status(cls) -> Dict[str, Any]:
+        return dict(cls._status)
+
+    @classmethod
+    def is_connected(cls) -> bool:
+        return cls._status["connected"]
+
 class RedisRateLimiter:
+    """
+    Keys, windows and result handling of the per-session GCRA limits.
+    The limits themselves are checked and consumed by Quota's script, together with the user and global ones.
+    """
+
+    WINDOWS = (("minute", 60 * 1000), ("day", 24 * 60 * 60 * 1000))
+
     @staticmethod
     def _get_minute_key(session_token: str) -> str:
-        current_minute = int(time.time() / 60)
-        return f"ratelimit:rpm:{session_token}:{current_minute}"
+        return session_key("ratelimit", session_token, "rpm")
     
     @staticmethod
     def _get_day_key(session_token: str) -> str:
-        today = datetime.now().strftime("%Y-%m-%d")
-        return f"ratelimit:rpd:{session_token}:{today}"
+        return session_key("ratelimit", session_token, "rpd")
+
+    @classmethod
+    def _parse_result(cls, result, limits):
+        allowed, remaining, retry_after_ms, reset_after_ms, window = (int(value) for value in result)
+        return {
+            "allowed": bool(allowed),
+            "limit": limits[window - 1],
+            "window": cls.WINDOWS[window - 1][0],
+            "remaining": max(remaining, 0),
+            "retry_after": -(-retry_after_ms // 1000),
+            "reset_after": -(-reset_after_ms // 1000),
+        }
+
+    @staticmethod
+    def get_headers(rate_limit: Optional[dict]) -> dict:
+        """Build the X-RateLimit-* (and Retry-After) headers for a rate limit result"""
+        if not rate_limit:
+            return {}
+
+        headers = {
+            "X-RateLimit-Limit": str(rate_limit["limit"]),
+            "X-RateLimit-Remaining": str(rate_limit["remaining"]),
+            "X-RateLimit-Reset": str(rate_limit["reset_after"]),
+        }
+        if not rate_limit["allowed"]:
+            headers["Retry-After"] = str(max(rate_limit["retry_after"], 1))
+        return headers
     
     @classmethod
-    def check_rate_limit(cls, session_token: str, rpm_limit: int, rpd_limit: int, plan_type: str):
-        if plan_type != "request":
-            return True
-            
-        rpm_key = cls._get_minute_key(session_token)
-        rpd_key = cls._get_day_key(session_token)
-        
-        current_rpm = redis_client.get(rpm_key)
-        current_rpm = int(current_rpm) if current_rpm else 0
-        
-        if current_rpm >= rpm_limit:
-            raise HTTPException(
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail=f"Rate limit exceeded: {rpm_limit} requests per minute"
-            )
-        
-        current_rpd = redis_client.get(rpd_key)
-        current_rpd = int(current_rpd) if current_rpd else 0
-        
-        if current_rpd >= rpd_limit:
+    def _check_result(cls, raw_result, rpm_limit: int, rpd_limit: int):
+        result = cls._parse_result(raw_result, (rpm_limit, rpd_limit))
+
+        if not result["allowed"]:
+            Metrics.rate_limited(f"requests_per_{result['window']}")
             raise HTTPException(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail=f"Rate limit exceeded: {rpd_limit} requests per day"
+                detail=f"Rate limit exceeded: {result['limit']} requests per {result['window']}",
+                headers=cls.get_headers(result)
             )
         
-        pipe = redis_client.pipeline()
-        pipe.incr(rpm_key)
-        pipe.expire(rpm_key, 60)
-        pipe.incr(rpd_key)
-        pipe.expire(rpd_key, 86400)
-        pipe.execute()
-        
-        return True
+        return result
 
 def get_session_token(x_session_token: Optional[str] = Header(None)):
     if x_session_token is None:
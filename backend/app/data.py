@@ -1,19 +1,70 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float, DateTime, Text
+from sqlalchemy import BigInteger, Boolean, Column, ForeignKey, Integer, String, Float, DateTime, Text, Index
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 import datetime
 from pydantic import BaseModel, Field
-from typing import List, Optional, Literal
+from typing import Any, Dict, List, Optional, Literal
 
 from app.core import settings
 
-engine = create_engine(
-    settings.DATABASE_URL, 
-    connect_args={"check_same_thread": False} if settings.DATABASE_URL.startswith("sqlite") else {}
-)
+def get_async_database_url(database_url: str) -> str:
+    """Map a sync DATABASE_URL onto the matching asyncio driver"""
+    if database_url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + database_url[len("sqlite:"):]
+    if database_url.startswith(("postgresql:", "postgres:", "postgresql+psycopg2:")):
+        return "postgresql+asyncpg:" + database_url.split(":", 1)[1]
+    return database_url
+
+def engine_options(database_url: str) -> Dict[str, Any]:
+    """
+    Per-backend engine profile.
+    SQLite gets a busy timeout on top of the PRAGMAs set by tune_sqlite. Postgres gets a sized,
+    pre-pinged pool, and asyncpg caches prepared statements per connection.
+    """
+    if database_url.startswith("sqlite"):
+        return {"connect_args": {"check_same_thread": False, "timeout": settings.SQLITE_BUSY_TIMEOUT_MS / 1000}}
+    if database_url.startswith("postgres"):
+        options = {
+            "pool_size": settings.DB_POOL_SIZE,
+            "max_overflow": settings.DB_MAX_OVERFLOW,
+            "pool_timeout": settings.DB_POOL_TIMEOUT,
+            "pool_recycle": settings.DB_POOL_RECYCLE,
+            "pool_pre_ping": True,
+        }
+        if "+asyncpg" in database_url:
+            options["connect_args"] = {"prepared_statement_cache_size": settings.DB_PREPARED_STATEMENT_CACHE_SIZE}
+        return options
+    return {}
+
+def tune_sqlite(sync_engine):
+    """WAL lets readers run alongside the single writer; NORMAL sync is durable across app crashes in WAL mode"""
+    if sync_engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+engine = create_engine(settings.DATABASE_URL, **engine_options(settings.DATABASE_URL))
+tune_sqlite(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_database_url = settings.ASYNC_DATABASE_URL or get_async_database_url(settings.DATABASE_URL)
+async_engine = create_async_engine(async_database_url, **engine_options(async_database_url))
+tune_sqlite(async_engine.sync_engine)
+AsyncSessionLocal = sessionmaker(
+    bind=async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
+
 Base = declarative_base()
 
 def get_db():
@@ -23,6 +74,10 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
 class User(Base):
     __tablename__ = "users"
 
@@ -30,6 +85,10 @@ class User(Base):
     email = Column(String, unique=True, index=True, nullable=True)
     hashed_password = Column(String, nullable=True)
     is_active = Column(Boolean, default=True)
+
+    rate_limit_rpm = Column(Integer, nullable=True)
+    rate_limit_rpd = Column(Integer, nullable=True)
+    token_limit_tpm = Column(Integer, nullable=True)
     
     sessions = relationship("ChatSession", back_populates="user")
 
@@ -50,6 +109,7 @@ class ChatSession(Base):
     total_token_limit = Column(Integer, nullable=True)
     
     plan_type = Column(String)
+    generation_profile = Column(String, nullable=True)
     
     request_count = Column(Integer, default=0)
     token_count = Column(Integer, default=0)
@@ -66,9 +126,45 @@ class ChatMessage(Base):
     content = Column(Text)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     token_count = Column(Integer, nullable=True)
+    event_id = Column(String, unique=True, index=True, nullable=True)
     
     session = relationship("ChatSession", back_populates="messages")
 
+    __table_args__ = (
+        Index("ix_chat_messages_session_id_id", "session_id", "id"),
+    )
+
+class ArchivedSession(Base):
+    __tablename__ = "archived_sessions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(Integer, ForeignKey("chat_sessions.id"), index=True)
+    segment = Column(String)
+    offset = Column(BigInteger)
+    length = Column(Integer)
+    checksum = Column(BigInteger)
+    message_count = Column(Integer)
+    last_message_id = Column(Integer)
+    archived_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class LightningInvoice(Base):
+    __tablename__ = "lightning_invoices"
+
+    id = Column(Integer, primary_key=True, index=True)
+    payment_hash = Column(String, unique=True, index=True)
+    payment_request = Column(Text)
+    session_token = Column(String, index=True)
+    plan_type = Column(String)
+    quantity = Column(Integer)
+    amount_sats = Column(Integer)
+    generation_profile = Column(String, nullable=True)
+    state = Column(String, default="open")
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime)
+    settled_at = Column(DateTime, nullable=True)
+    settle_index = Column(BigInteger, nullable=True)
+    amount_paid_sats = Column(Integer, nullable=True)
+
 class MessageBase(BaseModel):
     role: Literal["user", "assistant"]
     content: str
@@ -93,6 +189,8 @@ class SessionCreate(SessionBase):
     rate_limit_rpd: Optional[int] = 1500
     total_requests_limit: Optional[int] = None
     total_token_limit: Optional[int] = None
+    generation_profile: Optional[str] = None
+    user_id: Optional[int] = None
 
 class SessionUpdate(BaseModel):
     rate_limit_rpm: Optional[int] = None
@@ -111,21 +209,104 @@ class Session(SessionBase):
     rate_limit_rpd: int
     total_requests_limit: Optional[int]
     total_token_limit: Optional[int]
+    generation_profile: Optional[str] = None
+    user_id: Optional[int] = None
     request_count: int
     token_count: int
 
     class Config:
         orm_mode = True
 
+class SessionBatchGroup(SessionCreate):
+    count: int = Field(1, gt=0, description="Number of sessions to create with these settings")
+
+class SessionBatchCreate(BaseModel):
+    sessions: List[SessionBatchGroup]
+
+class SessionBatchTokens(BaseModel):
+    session_tokens: List[str]
+
+class SessionBatchUpdate(SessionBatchTokens):
+    rate_limit_rpm: Optional[int] = Field(None, gt=0)
+    rate_limit_rpd: Optional[int] = Field(None, gt=0)
+    total_requests_limit: Optional[int] = Field(None, gt=0)
+    total_token_limit: Optional[int] = Field(None, gt=0)
+
+class SessionBatch(BaseModel):
+    sessions: List[Session]
+    missing: List[str] = []
+
+class UserLimitConfig(BaseModel):
+    rate_limit_rpm: Optional[int] = Field(None, gt=0, description="Requests per minute across all of the user's sessions")
+    rate_limit_rpd: Optional[int] = Field(None, gt=0, description="Requests per day across all of the user's sessions")
+    token_limit_tpm: Optional[int] = Field(None, gt=0, description="Tokens per minute across all of the user's sessions")
+
+class UserCreate(UserLimitConfig):
+    email: Optional[str] = None
+
+class UserQuota(BaseModel):
+    id: int
+    email: Optional[str] = None
+    is_active: bool
+    rate_limit_rpm: Optional[int] = None
+    rate_limit_rpd: Optional[int] = None
+    token_limit_tpm: Optional[int] = None
+
+    class Config:
+        orm_mode = True
+
+class QuotaUsage(BaseModel):
+    scope: Literal["global", "user"]
+    user_id: Optional[int] = None
+    limits: Dict[str, int]
+    sessions: int
+    active_sessions: int
+    request_count: int
+    token_count: int
+    minute_requests: Optional[int] = None
+    day_requests: Optional[int] = None
+    minute_tokens: Optional[int] = None
+
+class InvoiceCreate(SessionBase):
+    quantity: int = Field(..., gt=0, description="Number of requests or tokens to buy")
+    generation_profile: Optional[str] = None
+
+class InvoiceStatus(BaseModel):
+    payment_hash: str
+    payment_request: str
+    plan_type: str
+    quantity: int
+    amount_sats: int
+    state: Literal["open", "settled", "canceled"]
+    created_at: datetime.datetime
+    expires_at: datetime.datetime
+    settled_at: Optional[datetime.datetime] = None
+
+    class Config:
+        orm_mode = True
+
+class Invoice(InvoiceStatus):
+    session_token: str
+
 class ApiLimitConfig(BaseModel):
     total_requests_limit: int = Field(..., gt=0, description="Total number of API requests allowed")
 
+class GenerationProfileConfig(BaseModel):
+    generation_profile: str = Field(..., description="Name of a configured generation profile")
+
+class GenerationProfile(BaseModel):
+    name: str
+    model: str
+    max_output_tokens: Optional[int] = None
+
 class TokenLimitConfig(BaseModel):
     total_token_limit: int = Field(..., gt=0, description="Total number of tokens allowed")
 
 class ChatRequest(BaseModel):
     message: str
     history: Optional[List[MessageBase]] = []
+    server_context: bool = False
+    use_cache: bool = True
 
 class ChatResponse(BaseModel):
     content: str
@@ -133,4 +314,5 @@ class ChatResponse(BaseModel):
     requests_remaining: Optional[int] = None
     tokens_remaining: Optional[int] = None
     token_usage: Optional[int] = None
-    session_active: bool = True
\ No newline at end of file
+    session_active: bool = True
+    cached: bool = False
\ No newline at end of file
@@ -0,0 +1,305 @@
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from app.core import settings, RedisRateLimiter, RedisCircuit, REDIS_UNAVAILABLE_ERRORS, async_redis_client
+from app.data import ChatSession
+from app.redis import RedisTokenBucket
+from app.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+class LocalSessionState:
+    __slots__ = ("session_token", "tats", "request_count", "request_limit", "token_base", "token_pending", "token_reserved", "token_deferred", "total_limit")
+
+    def __init__(self, session: ChatSession):
+        self.session_token = session.session_token
+        self.tats: Dict[str, float] = {}
+        self.request_count = session.request_count or 0
+        self.request_limit = session.total_requests_limit
+        self.token_base = session.token_count or 0
+        self.token_pending = 0
+        self.token_reserved = 0
+        self.token_deferred = 0
+        self.total_limit = session.total_token_limit
+
+    @property
+    def token_usage(self) -> int:
+        return self.token_base + self.token_pending + self.token_reserved + self.token_deferred
+
+class LocalLimiter:
+    """
+    Degraded-mode limiter used while Redis is unreachable.
+    Per-session request counts, RPM/RPD (GCRA) and token budgets are kept in a bounded LRU
+    of active sessions, seeded from the session row, so limits stay approximately enforced
+    by each process on its own. Token usage settled meanwhile, Redis settles that could not
+    be sent and cache keys whose writes were skipped are reconciled back into Redis by
+    run_reconciler once the circuit closes again. A session evicted from the LRU before that
+    leaves its unreconciled usage in _replay_usage, so it is replayed all the same.
+    """
+
+    _sessions: "OrderedDict[str, LocalSessionState]" = OrderedDict()
+    _deferred_settles: List[Tuple[str, dict, int]] = []
+    _deferred_buckets: Dict[str, Tuple[Optional[int], int]] = {}
+    _stale_keys: set = set()
+    _replay_usage: Dict[str, Tuple[int, int]] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _state(cls, session: ChatSession) -> LocalSessionState:
+        """Get or create the state of a session; the caller holds the lock"""
+        state = cls._sessions.get(session.session_token)
+        if state is None:
+            Metrics.redis_fallback("session")
+            state = cls._sessions[session.session_token] = LocalSessionState(session)
+            while len(cls._sessions) > settings.FALLBACK_MAX_SESSIONS:
+                _, evicted = cls._sessions.popitem(last=False)
+                cls._evict(evicted)
+        else:
+            cls._sessions.move_to_end(session.session_token)
+        return state
+
+    @classmethod
+    def _keep_usage(cls, session_token: str, token_base: int, tokens: int):
+        """Add usage to replay for a session without local state; the caller holds the lock"""
+        previous = cls._replay_usage.get(session_token)
+        if previous is not None:
+            token_base, tokens = previous[0], previous[1] + tokens
+        cls._replay_usage[session_token] = (token_base, tokens)
+
+    @classmethod
+    def _evict(cls, state: LocalSessionState):
+        """Keep what an evicted session still has to replay; the caller holds the lock"""
+        if state.token_pending or state.token_deferred:
+            # Deferred tokens are replayed with their settles, which only need the counter seeded
+            cls._keep_usage(state.session_token, state.token_base, state.token_pending)
+        if state.token_reserved:
+            logger.warning(
+                f"Evicted session {state.session_token[:8]} with {state.token_reserved} tokens reserved locally; "
+                f"they are not enforced until settled"
+            )
+
+    @classmethod
+    def mark_stale(cls, key: str):
+        """Remember a Redis key that missed a write, so it is dropped once Redis is back"""
+        with cls._lock:
+            cls._stale_keys.add(key)
+
+    @classmethod
+    def has_pending(cls) -> bool:
+        return bool(cls._sessions or cls._deferred_settles or cls._deferred_buckets or cls._stale_keys or cls._replay_usage)
+
+    @classmethod
+    def check_rate_limit(cls, session: ChatSession):
+        """GCRA over the minute and day windows, with the same result and 429 as RedisRateLimiter"""
+        now = time.time() * 1000
+        limits = (session.rate_limit_rpm, session.rate_limit_rpd)
+        allowed, remaining, retry_after, reset_after, window = 1, -1, 0, 0, 1
+        new_tats = {}
+
+        with cls._lock:
+            state = cls._state(session)
+            for index, ((name, period), limit) in enumerate(zip(RedisRateLimiter.WINDOWS, limits), start=1):
+                interval = period / limit
+                tat = max(state.tats.get(name, now), now)
+                new_tat = tat + interval
+                allow_at = new_tat - period
+                new_tats[name] = new_tat
+
+                if now < allow_at:
+                    if allowed or allow_at - now > retry_after:
+                        retry_after, reset_after, window = allow_at - now, tat - now, index
+                    allowed, remaining = 0, 0
+                elif allowed:
+                    left = int((now - allow_at) // interval)
+                    if remaining < 0 or left < remaining:
+                        remaining, reset_after, window = left, new_tat - now, index
+
+            if allowed:
+                state.tats.update(new_tats)
+
+        raw_result = (allowed, remaining, -(-int(retry_after) // 1), -(-int(reset_after) // 1), window)
+        return RedisRateLimiter._check_result(raw_result, *limits)
+
+    @classmethod
+    def refund_request(cls, session: ChatSession):
+        """Give back the request check_rate_limit consumed in both windows"""
+        limits = (session.rate_limit_rpm, session.rate_limit_rpd)
+        with cls._lock:
+            state = cls._state(session)
+            for (name, period), limit in zip(RedisRateLimiter.WINDOWS, limits):
+                if name in state.tats:
+                    state.tats[name] -= period / limit
+
+    @classmethod
+    def incr_request_count(cls, session: ChatSession, delta: int = 1) -> Optional[int]:
+        """Mirror of SessionCache.incr_request_count: None once the total request limit is reached"""
+        with cls._lock:
+            state = cls._state(session)
+            if delta > 0 and state.request_limit is not None and state.request_count >= state.request_limit:
+                return None
+            state.request_count += delta
+            return state.request_count
+
+    @staticmethod
+    def _raise_if_exhausted(state: LocalSessionState, min_tokens: int):
+        if state.total_limit is not None and state.total_limit - state.token_usage < min_tokens:
+            RedisTokenBucket._raise_for_reserve_result((-2, state.token_usage, state.total_limit))
+
+    @classmethod
+    def reserve_tokens(cls, session: ChatSession, estimate: int, min_tokens: int) -> dict:
+        with cls._lock:
+            state = cls._state(session)
+            cls._raise_if_exhausted(state, min_tokens)
+            reserved = estimate
+            if state.total_limit is not None:
+                reserved = min(estimate, state.total_limit - state.token_usage)
+            state.token_reserved += reserved
+            return {
+                "reservation_id": uuid.uuid4().hex,
+                "reserved": reserved,
+                "total_usage": state.token_usage,
+                "total_limit": state.total_limit,
+                "local": True,
+            }
+
+    @classmethod
+    def extend_reservation(cls, session: ChatSession, reservation: dict, estimate: int, min_tokens: int) -> dict:
+        extension = cls.reserve_tokens(session, estimate, min_tokens)
+        reservation["reserved"] += extension["reserved"]
+        reservation["total_usage"] = extension["total_usage"]
+        return reservation
+
+    @classmethod
+    def settle_tokens(cls, session: ChatSession, reservation: dict, actual_tokens: int) -> int:
+        """Settle a local reservation; settling twice is a no-op like in Redis"""
+        with cls._lock:
+            state = cls._state(session)
+            if reservation.get("settled"):
+                return state.token_usage
+            reservation["settled"] = True
+            state.token_reserved = max(state.token_reserved - reservation["reserved"], 0)
+            state.token_pending += actual_tokens
+            return state.token_usage
+
+    @classmethod
+    def charge_tokens(cls, session: ChatSession, tokens: int) -> int:
+        with cls._lock:
+            state = cls._state(session)
+            cls._raise_if_exhausted(state, tokens)
+            state.token_pending += tokens
+            return state.token_usage
+
+    @classmethod
+    def defer_settle(cls, session: ChatSession, reservation: dict, actual_tokens: int) -> int:
+        """Queue the settle of a Redis reservation for replay; returns the approximate usage meanwhile"""
+        with cls._lock:
+            cls._deferred_settles.append((session.session_token, reservation, actual_tokens))
+            state = cls._state(session)
+            state.token_base = max(state.token_base, reservation["total_usage"] - reservation["reserved"])
+            state.token_deferred += actual_tokens
+            return state.token_usage
+
+    @classmethod
+    def defer_initialize_bucket(cls, session_token: str, total_token_limit: Optional[int], token_count: int = 0):
+        with cls._lock:
+            cls._deferred_buckets[session_token] = (total_token_limit, token_count)
+
+    @classmethod
+    def get_token_usage(cls, session: ChatSession) -> dict:
+        with cls._lock:
+            state = cls._state(session)
+            usage = state.token_usage
+        return {
+            "total_usage": usage,
+            "total_limit": state.total_limit,
+            "minute_usage": 0,
+            "day_usage": 0,
+            "tokens_remaining": state.total_limit - usage if state.total_limit else None,
+        }
+
+    @classmethod
+    def _take_pending(cls):
+        """
+        Detach everything that has to be replayed, keeping sessions with open local reservations.
+        usage maps each session with tokens to replay to (usage before them, tokens used locally).
+        """
+        with cls._lock:
+            settles, cls._deferred_settles = cls._deferred_settles, []
+            buckets, cls._deferred_buckets = cls._deferred_buckets, {}
+            stale_keys, cls._stale_keys = cls._stale_keys, set()
+            usage, cls._replay_usage = cls._replay_usage, {}
+            settled_sessions = {session_token for session_token, _, _ in settles}
+            for session_token, state in list(cls._sessions.items()):
+                if state.token_pending or session_token in settled_sessions or session_token in usage:
+                    token_base, tokens = usage.get(session_token, (state.token_base, 0))
+                    usage[session_token] = (token_base, tokens + state.token_pending)
+                state.token_base += state.token_pending + state.token_deferred
+                state.token_pending = state.token_deferred = 0
+                if not state.token_reserved:
+                    del cls._sessions[session_token]
+            return settles, buckets, stale_keys, usage
+
+    @classmethod
+    def _restore_pending(cls, settles, buckets, stale_keys, usage):
+        with cls._lock:
+            cls._deferred_settles[:0] = settles
+            for session_token, bucket in buckets.items():
+                cls._deferred_buckets.setdefault(session_token, bucket)
+            cls._stale_keys |= stale_keys
+            # Live states already count these tokens in token_base, so they only go back to the replay
+            for session_token, (token_base, tokens) in usage.items():
+                _, added = cls._replay_usage.get(session_token, (token_base, 0))
+                cls._replay_usage[session_token] = (token_base, tokens + added)
+
+    @classmethod
+    async def reconcile_async(cls):
+        """
+        Push the degraded-mode state back into Redis. Usage counters are replayed first, so
+        that one Redis lost meanwhile is seeded with the usage from before the outage instead
+        of being recreated from the outage's tokens, or from zero by a bucket initialization.
+        """
+        settles, buckets, stale_keys, usage = cls._take_pending()
+        if not (settles or buckets or stale_keys or usage):
+            return
+        sessions = len(usage)
+
+        try:
+            for session_token in list(usage):
+                token_count, tokens = usage[session_token]
+                await RedisTokenBucket.replay_usage_async(session_token, token_count, tokens)
+                del usage[session_token]
+            for session_token, (total_token_limit, token_count) in buckets.items():
+                await RedisTokenBucket.initialize_token_bucket_async(session_token, total_token_limit, token_count)
+            for session_token, reservation, actual_tokens in settles:
+                await RedisTokenBucket.settle_tokens_async(session_token, reservation, actual_tokens)
+
+            pipe = async_redis_client.pipeline(transaction=False)
+            for key in stale_keys:
+                pipe.delete(key)
+            await pipe.execute()
+        except REDIS_UNAVAILABLE_ERRORS:
+            cls._restore_pending(settles, buckets, stale_keys, usage)
+            raise
+
+        logger.info(f"Reconciled degraded-mode state into Redis: {sessions} sessions, {len(settles)} settles, {len(stale_keys)} stale keys")
+
+    @classmethod
+    async def run_reconciler(cls, stop_event: asyncio.Event):
+        """Reconcile every REDIS_HEALTH_INTERVAL seconds while there is state to push and Redis is reachable"""
+        while not stop_event.is_set():
+            if cls.has_pending() and not RedisCircuit.is_open():
+                try:
+                    await cls.reconcile_async()
+                except REDIS_UNAVAILABLE_ERRORS:
+                    RedisCircuit.record_failure()
+                except Exception as e:
+                    logger.error(f"Degraded-mode reconcile error: {str(e)}")
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=settings.REDIS_HEALTH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
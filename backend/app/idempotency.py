@@ -0,0 +1,180 @@
+import json
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+from typing import Optional
+
+from fastapi import Depends, Header, HTTPException, Request, status
+from fastapi.responses import JSONResponse
+
+from app.core import settings, get_session_token, redis_client, async_redis_client, redis_call, redis_call_async, session_key
+from app.metrics import Metrics
+
+CLAIM_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return false
+end
+return redis.call('GET', KEYS[1])
+"""
+
+COMPLETE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+class IdempotentReplay(Exception):
+    """Raised by the idempotency dependency to answer a retry with the stored response"""
+
+    def __init__(self, response: dict):
+        self.response = response
+
+async def replay_idempotent_response(request: Request, replay: IdempotentReplay) -> JSONResponse:
+    return JSONResponse(replay.response, headers={"Idempotent-Replayed": "true"})
+
+class Idempotency:
+    """
+    Deduplication of retried POST /chat/message calls carrying an Idempotency-Key header.
+    The first request claims the key in Redis with a pending record, scoped to the session
+    and fingerprinted with the request body. A retry that arrives while it runs polls until
+    the record is completed and is answered with the stored response, without touching rate
+    limits, tokens or chat_messages; later retries are replayed for IDEMPOTENCY_TTL seconds.
+    Only successful responses are stored: if the original fails the claim is released and the
+    next retry runs the request again. Pending claims expire after IDEMPOTENCY_LOCK_TTL, so a
+    crashed worker cannot block a key. While Redis is unavailable keys are ignored.
+    """
+
+    _claim_script = redis_client.register_script(CLAIM_SCRIPT)
+    _complete_script = redis_client.register_script(COMPLETE_SCRIPT)
+    _async_claim_script = async_redis_client.register_script(CLAIM_SCRIPT)
+    _async_complete_script = async_redis_client.register_script(COMPLETE_SCRIPT)
+    _async_release_script = async_redis_client.register_script(RELEASE_SCRIPT)
+
+    @staticmethod
+    def _get_key(session_token: str, idempotency_key: str) -> str:
+        """Generate a key for the idempotency record in Redis"""
+        return session_key("idempotency", session_token, hashlib.sha256(idempotency_key.encode("utf-8")).hexdigest())
+
+    @staticmethod
+    def _poll_delay(attempt: int, remaining: float) -> float:
+        delay = min(settings.IDEMPOTENCY_POLL_INTERVAL * 2 ** attempt, 0.5) * random.uniform(0.8, 1.2)
+        return min(delay, remaining)
+
+    @staticmethod
+    def _mismatch() -> HTTPException:
+        Metrics.idempotency("mismatch")
+        return HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Idempotency-Key was already used for a different request"
+        )
+
+    @classmethod
+    async def claim_async(cls, session_token: str, idempotency_key: str, body: bytes) -> Optional[dict]:
+        """
+        Claim a key for this request, waiting out an in-flight original.
+        Returns the claim to complete, None when Redis is unavailable, and raises
+        IdempotentReplay when the original already finished.
+        """
+        key = cls._get_key(session_token, idempotency_key)
+        fingerprint = hashlib.sha256(body).hexdigest()
+        pending = json.dumps({"state": "pending", "owner": uuid.uuid4().hex, "fingerprint": fingerprint})
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+        attempt = 0
+
+        while True:
+            existing = await redis_call_async(
+                lambda: cls._async_claim_script(keys=[key], args=[pending, settings.IDEMPOTENCY_LOCK_TTL]),
+                lambda: False
+            )
+            if existing is None:
+                Metrics.idempotency("claimed")
+                return {"key": key, "pending": pending}
+            if existing is False:
+                return None
+
+            record = json.loads(existing)
+            if record["fingerprint"] != fingerprint:
+                raise cls._mismatch()
+            if record["state"] == "done":
+                Metrics.idempotency("replayed")
+                raise IdempotentReplay(record["response"])
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                Metrics.idempotency("in_progress")
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail="A request with this Idempotency-Key is still in progress",
+                    headers={"Retry-After": "1"}
+                )
+            await asyncio.sleep(cls._poll_delay(attempt, remaining))
+            attempt += 1
+
+    @staticmethod
+    def _done(claim: dict, response: dict) -> str:
+        return json.dumps({
+            "state": "done",
+            "fingerprint": json.loads(claim["pending"])["fingerprint"],
+            "response": response,
+        })
+
+    @classmethod
+    def complete(cls, claim: Optional[dict], response: dict) -> dict:
+        """Store the response for replay; returns it unchanged"""
+        if claim is not None:
+            args = [claim["pending"], cls._done(claim, response), settings.IDEMPOTENCY_TTL]
+            redis_call(lambda: cls._complete_script(keys=[claim["key"]], args=args), lambda: None)
+        return response
+
+    @classmethod
+    async def complete_async(cls, claim: Optional[dict], response: dict) -> dict:
+        """Async variant of complete"""
+        if claim is not None:
+            args = [claim["pending"], cls._done(claim, response), settings.IDEMPOTENCY_TTL]
+            await redis_call_async(lambda: cls._async_complete_script(keys=[claim["key"]], args=args), lambda: None)
+        return response
+
+    @classmethod
+    async def release_async(cls, claim: Optional[dict]):
+        """Drop a claim that was not completed, so that the next retry runs the request"""
+        if claim is None:
+            return
+        await redis_call_async(lambda: cls._async_release_script(keys=[claim["key"]], args=[claim["pending"]]), lambda: None)
+
+async def claim_idempotency_key(
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    session_token: str = Depends(get_session_token)
+):
+    """
+    Claim the request's Idempotency-Key, if it has one, for the duration of the request.
+    Must come before the rate limit dependency so that replays are not counted. Async for
+    both chat handlers, as the fingerprint needs the raw body.
+    """
+    if idempotency_key is None:
+        yield None
+        return
+    if not idempotency_key or len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters"
+        )
+
+    claim = await Idempotency.claim_async(session_token, idempotency_key, await request.body())
+    try:
+        yield claim
+    finally:
+        await Idempotency.release_async(claim)
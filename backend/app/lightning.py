@@ -0,0 +1,429 @@
+"""
+Lightning payments for sessions.
+
+Invoices are created by the backend, and each process keeps one streaming invoice
+subscription to the node (LIGHTNING_BACKEND: LND's REST API, or an in-process mock for
+development and tests). A session is only created, or extended, once the node reports its
+invoice settled; clients wait for that with GET /payments/invoices/{payment_hash}?wait=N
+instead of polling the node.
+"""
+import os
+import json
+import base64
+import asyncio
+import hashlib
+import logging
+import datetime
+import weakref
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+from fastapi import HTTPException, status
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import settings, async_redis_client, redis_call_async
+from app.data import ChatSession, LightningInvoice, InvoiceCreate, AsyncSessionLocal
+from app.redis import RedisTokenBucket
+from app.cache import SessionCache
+from app.fallback import LocalLimiter
+from app.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+WAIT_RECHECK_INTERVAL = 1.0
+
+class LightningError(Exception):
+    """Raised by a backend when the node rejects a call"""
+
+class LightningBackend:
+    """
+    Interface of the Lightning node.
+    subscribe yields invoice updates as dicts with payment_hash (hex), state (OPEN, SETTLED,
+    CANCELED, ACCEPTED), amount_paid_sats and settle_index, starting with the invoices
+    settled after settle_index.
+    """
+
+    name = "base"
+
+    async def create_invoice(self, preimage: bytes, amount_sats: int, memo: str, expiry: int) -> str:
+        """Add an invoice for sha256(preimage); returns its payment request"""
+        raise NotImplementedError
+
+    def subscribe(self, settle_index: int) -> AsyncIterator[dict]:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class LndBackend(LightningBackend):
+    """LND through its REST gateway, authenticated with an admin or invoice macaroon"""
+
+    name = "lnd"
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=f"https://{settings.LND_REST_HOST}",
+                headers={"Grpc-Metadata-macaroon": settings.LND_MACAROON},
+                verify=settings.LND_TLS_CERT_PATH or True,
+                timeout=httpx.Timeout(10.0, read=None)
+            )
+        return self._client
+
+    @staticmethod
+    def _event(invoice: dict) -> dict:
+        return {
+            "payment_hash": base64.b64decode(invoice["r_hash"]).hex(),
+            "state": invoice.get("state", "OPEN"),
+            "amount_paid_sats": int(invoice.get("amt_paid_sat") or 0),
+            "settle_index": int(invoice.get("settle_index") or 0),
+        }
+
+    async def create_invoice(self, preimage: bytes, amount_sats: int, memo: str, expiry: int) -> str:
+        response = await self.client().post("/v1/invoices", json={
+            "value": amount_sats,
+            "memo": memo,
+            "expiry": expiry,
+            "r_preimage": base64.b64encode(preimage).decode(),
+        })
+        if response.status_code != 200:
+            raise LightningError(f"{response.status_code} - {response.text}")
+        return response.json()["payment_request"]
+
+    async def subscribe(self, settle_index: int) -> AsyncIterator[dict]:
+        params = {"settle_index": settle_index} if settle_index else {}
+        async with self.client().stream("GET", "/v1/invoices/subscribe", params=params) as response:
+            if response.status_code != 200:
+                raise LightningError(f"{response.status_code} - {(await response.aread()).decode()}")
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                if "error" in message:
+                    raise LightningError(str(message["error"]))
+                yield self._event(message.get("result", message))
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+class MockLnd(LightningBackend):
+    """
+    In-process stand-in for LND, for development and tests.
+    Invoices live in memory and are settled by settle(), or on their own after
+    LIGHTNING_MOCK_SETTLE_AFTER seconds when that is set; like on LND, an invoice still open
+    after its expiry is canceled. Only the process that created an invoice knows it, so run a
+    single worker against it.
+    """
+
+    name = "mock"
+
+    def __init__(self):
+        self.invoices: Dict[str, dict] = {}
+        self.settled = []
+        self.subscribers = set()
+
+    async def create_invoice(self, preimage: bytes, amount_sats: int, memo: str, expiry: int) -> str:
+        payment_hash = hashlib.sha256(preimage).hexdigest()
+        self.invoices[payment_hash] = {"payment_hash": payment_hash, "state": "OPEN", "amount_sats": amount_sats}
+        loop = asyncio.get_running_loop()
+        loop.call_later(expiry, self.cancel, payment_hash)
+        if settings.LIGHTNING_MOCK_SETTLE_AFTER > 0:
+            loop.call_later(settings.LIGHTNING_MOCK_SETTLE_AFTER, self.settle, payment_hash)
+        return f"lnmock{amount_sats}n1{payment_hash}"
+
+    def _publish(self, event: dict):
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+    def settle(self, payment_hash: str) -> Optional[dict]:
+        """Mark an open invoice as paid in full and notify subscribers; returns the event, None if not open"""
+        invoice = self.invoices.get(payment_hash)
+        if invoice is None or invoice["state"] != "OPEN":
+            return None
+
+        invoice["state"] = "SETTLED"
+        event = {
+            "payment_hash": payment_hash,
+            "state": "SETTLED",
+            "amount_paid_sats": invoice["amount_sats"],
+            "settle_index": len(self.settled) + 1,
+        }
+        self.settled.append(event)
+        self._publish(event)
+        return event
+
+    def cancel(self, payment_hash: str) -> Optional[dict]:
+        """Cancel an open invoice and notify subscribers; returns the event, None if not open"""
+        invoice = self.invoices.get(payment_hash)
+        if invoice is None or invoice["state"] != "OPEN":
+            return None
+
+        invoice["state"] = "CANCELED"
+        event = {"payment_hash": payment_hash, "state": "CANCELED", "amount_paid_sats": 0, "settle_index": 0}
+        self._publish(event)
+        return event
+
+    async def subscribe(self, settle_index: int) -> AsyncIterator[dict]:
+        queue = asyncio.Queue()
+        self.subscribers.add(queue)
+        try:
+            for event in self.settled[settle_index:]:
+                yield event
+            while True:
+                yield await queue.get()
+        finally:
+            self.subscribers.discard(queue)
+
+BACKENDS = {
+    "lnd": LndBackend,
+    "mock": MockLnd,
+}
+
+_backend: Optional[LightningBackend] = None
+
+def get_backend() -> LightningBackend:
+    """The backend selected by settings.LIGHTNING_BACKEND, built once per process"""
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[settings.LIGHTNING_BACKEND]()
+    return _backend
+
+class LightningSettlement:
+    """
+    Turns settled invoices into sessions.
+    Settlement is a conditional update of the invoice row from open to settled, made in the
+    same transaction as the session change, so replayed events and several processes holding
+    subscriptions apply each payment exactly once. Settled payment hashes are cached in Redis
+    for LIGHTNING_SETTLED_TTL, which lets duplicates skip SQL and waiters check cheaply.
+    After a reconnect the subscription resumes from the highest settle_index recorded.
+    """
+
+    _waiters = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def enabled() -> bool:
+        return settings.LIGHTNING
+
+    @staticmethod
+    def _settled_key(payment_hash: str) -> str:
+        return f"lightning:settled:{payment_hash}"
+
+    @staticmethod
+    def price(plan_type: str, quantity: int) -> int:
+        """Invoice amount in sats, at the same rates as the frontend's calculatePaymentAmount"""
+        rate = settings.LIGHTNING_SATS_PER_TOKEN if plan_type == 'token' else settings.LIGHTNING_SATS_PER_REQUEST
+        return max(round(quantity * rate), 1)
+
+    @staticmethod
+    def _memo(plan_type: str, quantity: int) -> str:
+        unit = "tokens" if plan_type == 'token' else "requests"
+        return f"Lightning Model API - {plan_type.capitalize()} Plan ({quantity} {unit})"
+
+    @classmethod
+    async def create_invoice(cls, db: AsyncSession, invoice_data: InvoiceCreate, session_token: str) -> LightningInvoice:
+        """
+        Create an invoice that, once paid, creates the session session_token or extends it.
+        The preimage is generated here, so the row exists before the node can report a payment.
+        """
+        preimage = os.urandom(32)
+        now = datetime.datetime.utcnow()
+        invoice = LightningInvoice(
+            payment_hash=hashlib.sha256(preimage).hexdigest(),
+            payment_request="",
+            session_token=session_token,
+            plan_type=invoice_data.plan_type,
+            quantity=invoice_data.quantity,
+            amount_sats=cls.price(invoice_data.plan_type, invoice_data.quantity),
+            generation_profile=invoice_data.generation_profile,
+            state="open",
+            created_at=now,
+            expires_at=now + datetime.timedelta(seconds=settings.LIGHTNING_INVOICE_EXPIRY)
+        )
+        db.add(invoice)
+        await db.commit()
+
+        try:
+            invoice.payment_request = await get_backend().create_invoice(
+                preimage,
+                invoice.amount_sats,
+                cls._memo(invoice.plan_type, invoice.quantity),
+                settings.LIGHTNING_INVOICE_EXPIRY
+            )
+        except (LightningError, httpx.HTTPError) as e:
+            invoice.state = "canceled"
+            await db.commit()
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail=f"Error creating Lightning invoice: {str(e)}"
+            )
+        await db.commit()
+
+        Metrics.lightning("created")
+        return invoice
+
+    @classmethod
+    async def is_settled(cls, payment_hash: str) -> bool:
+        return bool(await redis_call_async(
+            lambda: async_redis_client.exists(cls._settled_key(payment_hash)),
+            lambda: 0
+        ))
+
+    @staticmethod
+    def _session_values(plan_type: str, quantity: int) -> dict:
+        if plan_type == 'token':
+            return {"total_token_limit": ChatSession.total_token_limit + quantity}
+        return {"total_requests_limit": ChatSession.total_requests_limit + quantity}
+
+    @classmethod
+    async def settle(cls, payment_hash: str, amount_paid_sats: int, settle_index: int) -> bool:
+        """Apply a settled invoice; returns False if it is not ours, underpaid or already applied"""
+        if await cls.is_settled(payment_hash):
+            return False
+
+        table = LightningInvoice.__table__
+        async with AsyncSessionLocal() as db:
+            invoice = (await db.execute(
+                update(table).where(
+                    table.c.payment_hash == payment_hash,
+                    table.c.state == "open",
+                    table.c.amount_sats <= amount_paid_sats
+                ).values(
+                    state="settled",
+                    settled_at=datetime.datetime.utcnow(),
+                    settle_index=settle_index,
+                    amount_paid_sats=amount_paid_sats
+                ).returning(table.c.session_token, table.c.plan_type, table.c.quantity, table.c.generation_profile)
+            )).first()
+            if invoice is None:
+                return False
+
+            # Unlimited (NULL) totals stay unlimited
+            session = (await db.execute(
+                update(ChatSession).where(ChatSession.session_token == invoice.session_token).values(
+                    is_active=True, **cls._session_values(invoice.plan_type, invoice.quantity)
+                ).returning(ChatSession.total_token_limit, ChatSession.token_count)
+            )).first()
+            if session is None:
+                db.add(ChatSession(
+                    session_token=invoice.session_token,
+                    plan_type=invoice.plan_type,
+                    total_requests_limit=invoice.quantity if invoice.plan_type == 'request' else None,
+                    total_token_limit=invoice.quantity if invoice.plan_type == 'token' else None,
+                    generation_profile=invoice.generation_profile
+                ))
+                total_token_limit, token_count = (invoice.quantity, 0)
+            else:
+                total_token_limit, token_count = session.total_token_limit, session.token_count or 0
+            await db.commit()
+
+        await SessionCache.invalidate_async(invoice.session_token)
+        if invoice.plan_type == 'token':
+            await redis_call_async(
+                lambda: RedisTokenBucket.initialize_token_bucket_async(invoice.session_token, total_token_limit, token_count),
+                lambda: LocalLimiter.defer_initialize_bucket(invoice.session_token, total_token_limit, token_count)
+            )
+        await redis_call_async(
+            lambda: async_redis_client.set(cls._settled_key(payment_hash), 1, ex=settings.LIGHTNING_SETTLED_TTL),
+            lambda: None
+        )
+
+        Metrics.lightning("settled")
+        logger.info(f"Invoice {payment_hash} settled for {invoice.quantity} {invoice.plan_type}s")
+        return True
+
+    @staticmethod
+    async def cancel(payment_hash: str) -> bool:
+        table = LightningInvoice.__table__
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(table).where(table.c.payment_hash == payment_hash, table.c.state == "open").values(state="canceled")
+            )
+            await db.commit()
+        if result.rowcount:
+            Metrics.lightning("canceled")
+        return bool(result.rowcount)
+
+    @classmethod
+    async def apply(cls, event: dict):
+        """Apply one invoice update from the subscription and wake up its waiters"""
+        if event["state"] == "SETTLED":
+            await cls.settle(event["payment_hash"], event["amount_paid_sats"], event["settle_index"])
+        elif event["state"] == "CANCELED":
+            await cls.cancel(event["payment_hash"])
+        else:
+            return
+
+        waiter = cls._waiters.pop(event["payment_hash"], None)
+        if waiter is not None:
+            waiter.set()
+
+    @classmethod
+    async def wait(cls, payment_hash: str, timeout: float):
+        """
+        Return once the invoice was settled, or was updated by this process's subscription,
+        or after timeout. Invoices settled by another process are seen through the Redis
+        cache within WAIT_RECHECK_INTERVAL.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        while not await cls.is_settled(payment_hash):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            waiter = cls._waiters.get(payment_hash)
+            if waiter is None:
+                waiter = asyncio.Event()
+                cls._waiters[payment_hash] = waiter
+            try:
+                await asyncio.wait_for(waiter.wait(), timeout=min(remaining, WAIT_RECHECK_INTERVAL))
+                return
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    async def _last_settle_index() -> int:
+        async with AsyncSessionLocal() as db:
+            return (await db.execute(select(func.max(LightningInvoice.settle_index)))).scalar() or 0
+
+    @classmethod
+    async def _consume(cls):
+        settle_index = await cls._last_settle_index()
+        logger.info(f"Subscribing to {get_backend().name} invoices from settle index {settle_index}")
+        async for event in get_backend().subscribe(settle_index):
+            await cls.apply(event)
+
+    @classmethod
+    async def run(cls, stop_event: asyncio.Event):
+        """Hold the invoice subscription until stop_event is set, reconnecting with backoff"""
+        loop = asyncio.get_running_loop()
+        backoff = 1.0
+        try:
+            while not stop_event.is_set():
+                connected_at = loop.time()
+                consumer = asyncio.create_task(cls._consume())
+                stopping = asyncio.create_task(stop_event.wait())
+                await asyncio.wait({consumer, stopping}, return_when=asyncio.FIRST_COMPLETED)
+                if stopping.done():
+                    consumer.cancel()
+                    await asyncio.gather(consumer, return_exceptions=True)
+                    return
+                stopping.cancel()
+
+                error = consumer.exception()
+                logger.error(f"Invoice subscription ended: {str(error) if error else 'stream closed'}")
+                if loop.time() - connected_at > settings.LIGHTNING_RECONNECT_BACKOFF_CAP:
+                    backoff = 1.0
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=backoff)
+                except asyncio.TimeoutError:
+                    pass
+                backoff = min(backoff * 2, settings.LIGHTNING_RECONNECT_BACKOFF_CAP)
+        finally:
+            await get_backend().close()
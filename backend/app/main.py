@@ -1,18 +1,22 @@
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from app.api import chat_router, session_router
-from app.data import Base, engine
-from app.core import settings, test_redis_connection
-from app.db_migration import add_total_token_limit_column
+from app.api import chat_router, session_router, quota_router, payment_router
+from app.core import settings, RedisHealth
+from app.idempotency import IdempotentReplay, replay_idempotent_response
+from app.persistence import WriteBehind
+from app.fallback import LocalLimiter
+from app.usage import UsageReconciler
+from app.retention import Retention
+from app.lightning import LightningSettlement
+from app.providers import get_provider
+from app.metrics import Metrics
+import asyncio
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-Base.metadata.create_all(bind=engine)
-2
-add_total_token_limit_column()
-
 app = FastAPI(title=settings.APP_NAME)
 
 app.add_middleware(
@@ -21,10 +25,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[
+        "X-RateLimit-Limit", "X-RateLimit-Remaining", "X-RateLimit-Reset", "Retry-After",
+        "ETag", "Last-Modified", "X-Cursor-Before", "X-Cursor-After", "Idempotent-Replayed"
+    ],
 )
 
+app.add_exception_handler(IdempotentReplay, replay_idempotent_response)
+
 app.include_router(session_router, prefix=f"{settings.API_V1_STR}")
 app.include_router(chat_router, prefix=f"{settings.API_V1_STR}")
+app.include_router(quota_router, prefix=f"{settings.API_V1_STR}")
+app.include_router(payment_router, prefix=f"{settings.API_V1_STR}")
 
 @app.get("/")
 def read_root():
@@ -32,20 +44,49 @@ def read_root():
 
 @app.get("/health")
 def health_check():
-    redis_status = "connected" if test_redis_connection() else "disconnected"
+    redis_health = RedisHealth.status()
+    redis_status = "connected" if redis_health["connected"] else "disconnected"
     
     return {
         "status": "healthy",
         "services": {
             "api": "running",
             "redis": redis_status
-        }
+        },
+        "redis": redis_health
     }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(Metrics.render(), media_type="text/plain; version=0.0.4")
+
+background_stop = asyncio.Event()
+background_tasks = []
+
 @app.on_event("startup")
 async def startup_event():
-    if not test_redis_connection():
-        logger.warning("Redis connection failed. Rate limiting will not work properly.")
+    if not await RedisHealth.check():
+        logger.warning("Redis connection failed. Limits are enforced per process until it is reachable again.")
+
+    get_provider().warm_up()
+
+    background_tasks.append(asyncio.create_task(RedisHealth.run(background_stop)))
+    background_tasks.append(asyncio.create_task(LocalLimiter.run_reconciler(background_stop)))
+    background_tasks.append(asyncio.create_task(UsageReconciler.run(background_stop)))
+
+    if Retention.enabled():
+        background_tasks.append(asyncio.create_task(Retention.run(background_stop)))
+
+    if LightningSettlement.enabled() and settings.LIGHTNING_SUBSCRIBER:
+        background_tasks.append(asyncio.create_task(LightningSettlement.run(background_stop)))
+
+    if settings.WRITE_BEHIND and settings.WRITE_BEHIND_CONSUMER:
+        background_tasks.append(asyncio.create_task(WriteBehind.run_consumer(background_stop)))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    background_stop.set()
+    await asyncio.gather(*background_tasks)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,204 @@
+import time
+import bisect
+import threading
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple[str, ...] = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: Tuple[str, ...] = ()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class StageTimer:
+    """Context manager observing the duration of one request stage"""
+
+    __slots__ = ("stage", "upstream", "started")
+
+    def __init__(self, stage: str, upstream: Optional[str] = None):
+        self.stage = stage
+        self.upstream = upstream
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        Metrics.STAGE_SECONDS.observe(time.perf_counter() - self.started, (self.stage,))
+        if exc_type is not None and self.upstream is not None:
+            Metrics.upstream_error(self.upstream, exc_type.__name__)
+        return False
+
+class Metrics:
+    """
+    Process-local request metrics exposed in the Prometheus text format.
+    Each worker process keeps its own values; scrape every worker or aggregate in Prometheus.
+    """
+
+    STAGE_SECONDS = Histogram(
+        "lightning_stage_duration_seconds",
+        "Duration of request stages: session_lookup, rate_limit, token_reserve, admission, model_call, model_first_chunk, token_settle, db_commit, persist",
+        ("stage",)
+    )
+    RATE_LIMITED = Counter(
+        "lightning_rate_limited_total",
+        "Requests rejected with 429 by reason",
+        ("reason",)
+    )
+    UPSTREAM_ERRORS = Counter(
+        "lightning_upstream_errors_total",
+        "Failed calls to the model provider",
+        ("provider", "error")
+    )
+    TOKENS = Counter(
+        "lightning_tokens_total",
+        "Tokens consumed by model calls per plan",
+        ("plan", "direction")
+    )
+    RESPONSE_CACHE = Counter(
+        "lightning_response_cache_total",
+        "Response cache lookups by result",
+        ("result",)
+    )
+    REDIS_FALLBACK = Counter(
+        "lightning_redis_fallback_total",
+        "Operations served by the local fallback while Redis was unavailable",
+        ("operation",)
+    )
+    ADMISSION = Counter(
+        "lightning_admission_total",
+        "Model calls by admission result: admitted, queue_full, timeout",
+        ("plan", "result")
+    )
+    IDEMPOTENCY = Counter(
+        "lightning_idempotency_total",
+        "Requests with an Idempotency-Key by result: claimed, replayed, in_progress, mismatch",
+        ("result",)
+    )
+    LIGHTNING = Counter(
+        "lightning_invoices_total",
+        "Lightning invoices by event: created, settled, canceled",
+        ("event",)
+    )
+    WRITE_BEHIND = Counter(
+        "lightning_write_behind_entries_total",
+        "Write-behind stream entries by result: applied, failed, dead_lettered",
+        ("result",)
+    )
+
+    REGISTRY = (STAGE_SECONDS, RATE_LIMITED, UPSTREAM_ERRORS, TOKENS, RESPONSE_CACHE, REDIS_FALLBACK, ADMISSION, IDEMPOTENCY, LIGHTNING, WRITE_BEHIND)
+
+    @staticmethod
+    def stage(name: str) -> StageTimer:
+        return StageTimer(name)
+
+    @staticmethod
+    def model_call(provider: str) -> StageTimer:
+        """Time a model call, counting exceptions raised inside it as upstream errors"""
+        return StageTimer("model_call", upstream=provider)
+
+    @classmethod
+    def observe_stage(cls, name: str, seconds: float):
+        cls.STAGE_SECONDS.observe(seconds, (name,))
+
+    @classmethod
+    def rate_limited(cls, reason: str):
+        cls.RATE_LIMITED.inc((reason,))
+
+    @classmethod
+    def upstream_error(cls, provider: str, error: str):
+        cls.UPSTREAM_ERRORS.inc((provider, error))
+
+    @classmethod
+    def record_tokens(cls, plan: str, input_tokens: int, output_tokens: int):
+        cls.TOKENS.inc((plan, "input"), input_tokens)
+        cls.TOKENS.inc((plan, "output"), output_tokens)
+
+    @classmethod
+    def response_cache(cls, hit: bool):
+        cls.RESPONSE_CACHE.inc(("hit" if hit else "miss",))
+
+    @classmethod
+    def redis_fallback(cls, operation: str):
+        cls.REDIS_FALLBACK.inc((operation,))
+
+    @classmethod
+    def admission(cls, plan: str, result: str):
+        cls.ADMISSION.inc((plan, result))
+
+    @classmethod
+    def idempotency(cls, result: str):
+        cls.IDEMPOTENCY.inc((result,))
+
+    @classmethod
+    def lightning(cls, event: str):
+        cls.LIGHTNING.inc((event,))
+
+    @classmethod
+    def write_behind(cls, result: str, count: int = 1):
+        cls.WRITE_BEHIND.inc((result,), count)
+
+    @classmethod
+    def render(cls) -> str:
+        lines = []
+        for metric in cls.REGISTRY:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,35 @@
+"""
+Versioned schema migrations (Alembic, scripts under backend/alembic).
+
+    python -m app.migrations               upgrade the database to the latest revision
+    python -m app.migrations --sql         print the upgrade SQL instead of running it
+
+Run this before starting the API; the app no longer creates or alters tables on startup.
+"""
+import os
+import argparse
+import logging
+
+from alembic import command
+from alembic.config import Config
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def alembic_config() -> Config:
+    config = Config(os.path.join(BACKEND_DIR, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(BACKEND_DIR, "alembic"))
+    return config
+
+def upgrade(revision: str = "head", sql: bool = False):
+    command.upgrade(alembic_config(), revision, sql=sql)
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Apply database migrations")
+    parser.add_argument("revision", nargs="?", default="head", help="target revision (default: head)")
+    parser.add_argument("--sql", action="store_true", help="print the SQL instead of running it")
+    args = parser.parse_args(argv)
+    upgrade(args.revision, sql=args.sql)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import threading
+from typing import Any, Dict, List, Optional
+
+import google.generativeai as genai
+
+from app.core import settings
+from app.data import ChatSession
+
+class ModelRegistry:
+    """
+    Process-wide registry of generative model clients.
+    genai is configured once and one GenerativeModel is built per generation profile,
+    so every request reuses the same client and its pooled connections.
+    Profiles come from settings.GENERATION_PROFILES; a profile may override the model.
+    """
+
+    _models: Dict[str, genai.GenerativeModel] = {}
+    _lock = threading.Lock()
+    _configured = False
+
+    @classmethod
+    def _configure(cls):
+        if not cls._configured:
+            genai.configure(api_key=settings.GEMINI_API_KEY, transport=settings.GEMINI_TRANSPORT)
+            cls._configured = True
+
+    @staticmethod
+    def profile_names() -> List[str]:
+        return list(settings.GENERATION_PROFILES)
+
+    @staticmethod
+    def has_profile(name: str) -> bool:
+        return name in settings.GENERATION_PROFILES
+
+    @staticmethod
+    def resolve_profile(session: ChatSession) -> str:
+        """The session's own profile, else the default profile of its plan"""
+        if session.generation_profile and session.generation_profile in settings.GENERATION_PROFILES:
+            return session.generation_profile
+        return settings.PLAN_GENERATION_PROFILES.get(session.plan_type, settings.DEFAULT_GENERATION_PROFILE)
+
+    @staticmethod
+    def get_model_name(profile: str) -> str:
+        return settings.GENERATION_PROFILES[profile].get("model", settings.GEMINI_MODEL)
+
+    @staticmethod
+    def get_generation_config(profile: str) -> Dict[str, Any]:
+        """A copy of the profile's generation config that callers may adjust per request"""
+        return {key: value for key, value in settings.GENERATION_PROFILES[profile].items() if key != "model"}
+
+    @classmethod
+    def get_model(cls, profile: str) -> genai.GenerativeModel:
+        model = cls._models.get(profile)
+        if model is None:
+            with cls._lock:
+                model = cls._models.get(profile)
+                if model is None:
+                    cls._configure()
+                    model = genai.GenerativeModel(
+                        model_name=cls.get_model_name(profile),
+                        generation_config=cls.get_generation_config(profile)
+                    )
+                    cls._models[profile] = model
+        return model
+
+    @classmethod
+    def start_chat(cls, profile: str, history: List[Dict[str, Any]]):
+        return cls.get_model(profile).start_chat(history=history)
+
+    @classmethod
+    def warm_up(cls, profiles: Optional[List[str]] = None):
+        """Build the clients ahead of the first request"""
+        for profile in profiles or cls.profile_names():
+            cls.get_model(profile)
@@ -0,0 +1,412 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import datetime
+from typing import Dict, List, Optional, Sequence
+
+from redis.exceptions import ResponseError
+from sqlalchemy import bindparam, case, insert, select
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import settings, redis_client, async_redis_client, run_pipeline, run_pipeline_async, redis_call, redis_call_async, RedisCircuit, session_key
+from app.data import ChatSession, ChatMessage, AsyncSessionLocal
+from app.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+chat_messages_table = ChatMessage.__table__
+chat_sessions_table = ChatSession.__table__
+
+# Errors caused by the content of an entry, which retrying the same entry cannot fix
+POISON_ERRORS = (ValueError, KeyError, TypeError, IntegrityError, DataError)
+
+class WriteBehind:
+    """
+    Write-behind persistence of chat messages and session counters.
+    The request path appends events to a Redis Stream and a background consumer
+    batch-applies them to SQL. Delivery is at-least-once: messages are deduplicated
+    by event_id and counters carry absolute values that are applied with max(). A refund carries
+    the count after it and is applied as a decrement floored at that count, so it survives the
+    max() of the events before it and stays idempotent when redelivered.
+    Entries that keep failing are moved to a dead-letter stream after WRITE_BEHIND_MAX_DELIVERIES
+    deliveries. The stream and the per-session pending hashes live in different cluster slots,
+    so the pipelines writing both are not transactions.
+    """
+
+    STREAM_KEY = "chat:write_behind"
+    DEAD_LETTER_KEY = "chat:write_behind:dead"
+    GROUP = "chat-persisters"
+    PENDING_TTL = 86400
+
+    @staticmethod
+    def enabled() -> bool:
+        return settings.WRITE_BEHIND
+
+    @staticmethod
+    def _get_pending_key(session_token: str) -> str:
+        """Generate a key for the messages of a session that are not in SQL yet"""
+        return session_key("chat:pending", session_token)
+
+    @staticmethod
+    def _message_rows(session: ChatSession, messages: List[ChatMessage]) -> List[dict]:
+        now = datetime.datetime.utcnow()
+        rows = []
+        for index, message in enumerate(messages):
+            created_at = message.created_at or now + datetime.timedelta(microseconds=index)
+            rows.append({
+                "event_id": message.event_id or uuid.uuid4().hex,
+                "session_id": session.id,
+                "role": message.role,
+                "content": message.content,
+                "token_count": message.token_count,
+                "created_at": created_at.isoformat(),
+            })
+        return rows
+
+    @classmethod
+    def _queue_messages(cls, pipe, session: ChatSession, messages: List[ChatMessage]):
+        rows = cls._message_rows(session, messages)
+        pending_key = cls._get_pending_key(session.session_token)
+
+        pipe.xadd(cls.STREAM_KEY, {
+            "type": "messages",
+            "session_token": session.session_token,
+            "payload": json.dumps(rows),
+        })
+        pipe.hset(pending_key, mapping={row["event_id"]: json.dumps(row) for row in rows})
+        pipe.expire(pending_key, cls.PENDING_TTL)
+
+    @classmethod
+    def _queue_usage(cls, pipe, session: ChatSession, counters: Dict):
+        pipe.xadd(cls.STREAM_KEY, {
+            "type": "usage",
+            "session_token": session.session_token,
+            "payload": json.dumps({"session_id": session.id, **counters}),
+        })
+
+    @classmethod
+    def append_messages(cls, session: ChatSession, messages: List[ChatMessage]) -> bool:
+        """
+        Queue ChatMessage rows for insertion; visible to /chat/history immediately.
+        Returns False when Redis is unavailable, in which case the caller writes to SQL itself.
+        """
+        return redis_call(
+            lambda: cls._run(lambda pipe: cls._queue_messages(pipe, session, messages), transaction=False),
+            lambda: False
+        )
+
+    @classmethod
+    async def append_messages_async(cls, session: ChatSession, messages: List[ChatMessage]) -> bool:
+        """Async variant of append_messages"""
+        return await redis_call_async(
+            lambda: cls._run_async(lambda pipe: cls._queue_messages(pipe, session, messages), transaction=False),
+            lambda: False
+        )
+
+    @classmethod
+    def append_usage(cls, session: ChatSession, **counters: int) -> bool:
+        """Queue absolute request_count/token_count values for a session; False like append_messages"""
+        return redis_call(
+            lambda: cls._run(lambda pipe: cls._queue_usage(pipe, session, counters), transaction=False),
+            lambda: False
+        )
+
+    @classmethod
+    async def append_usage_async(cls, session: ChatSession, **counters: int) -> bool:
+        """Async variant of append_usage"""
+        return await redis_call_async(
+            lambda: cls._run_async(lambda pipe: cls._queue_usage(pipe, session, counters), transaction=False),
+            lambda: False
+        )
+
+    @classmethod
+    def append_refund(cls, session: ChatSession, request_count: int) -> bool:
+        """Queue a request given back, with the request_count after it; False like append_messages"""
+        counters = {"request_count": request_count, "refunded": True}
+        return redis_call(
+            lambda: cls._run(lambda pipe: cls._queue_usage(pipe, session, counters), transaction=False),
+            lambda: False
+        )
+
+    @classmethod
+    async def append_refund_async(cls, session: ChatSession, request_count: int) -> bool:
+        """Async variant of append_refund"""
+        counters = {"request_count": request_count, "refunded": True}
+        return await redis_call_async(
+            lambda: cls._run_async(lambda pipe: cls._queue_usage(pipe, session, counters), transaction=False),
+            lambda: False
+        )
+
+    @staticmethod
+    def _run(queue, transaction: bool = True) -> bool:
+        run_pipeline(queue, transaction=transaction)
+        return True
+
+    @staticmethod
+    async def _run_async(queue, transaction: bool = True) -> bool:
+        await run_pipeline_async(queue, transaction=transaction)
+        return True
+
+    @staticmethod
+    def _decode_row(row: dict) -> dict:
+        row = dict(row)
+        row["created_at"] = datetime.datetime.fromisoformat(row["created_at"])
+        return row
+
+    @staticmethod
+    def _existing_event_ids_query(rows: List[dict]):
+        return select(ChatMessage.event_id).where(
+            ChatMessage.event_id.in_([row["event_id"] for row in rows])
+        )
+
+    @classmethod
+    def _insert_messages(cls, db: Session, rows: List[dict]):
+        if not rows:
+            return
+        existing = set(db.execute(cls._existing_event_ids_query(rows)).scalars())
+        missing = [cls._decode_row(row) for row in rows if row["event_id"] not in existing]
+        if missing:
+            db.execute(insert(chat_messages_table), missing)
+
+    @classmethod
+    async def _insert_messages_async(cls, db: AsyncSession, rows: List[dict]):
+        if not rows:
+            return
+        existing = set((await db.execute(cls._existing_event_ids_query(rows))).scalars())
+        missing = [cls._decode_row(row) for row in rows if row["event_id"] not in existing]
+        if missing:
+            await db.execute(insert(chat_messages_table), missing)
+
+    @staticmethod
+    def _counter_update(column_name: str):
+        """column = max(column, floor) - refunds"""
+        column = chat_sessions_table.c[column_name]
+        return chat_sessions_table.update().where(
+            chat_sessions_table.c.id == bindparam("session_id")
+        ).values({
+            column_name: case((column < bindparam("floor"), bindparam("floor")), else_=column) - bindparam("refunds")
+        })
+
+    @staticmethod
+    def _fold_counter(counter: Optional[List[int]], value: int, refunded: bool) -> List[int]:
+        """
+        Fold one event, in stream order, into the [floor, refunds] pair of _counter_update.
+        Both kinds of event keep the form max(column, floor) - refunds, so a batch is one update.
+        """
+        floor, refunds = counter or (0, 0)
+        if refunded:
+            refunds += 1
+        return [max(floor, value + refunds), refunds]
+
+    @classmethod
+    def flush_session(cls, db: Session, session: ChatSession):
+        """Persist a session's queued messages inline, so a read sees everything acknowledged so far"""
+        pending_key = cls._get_pending_key(session.session_token)
+        pending = redis_call(lambda: redis_client.hgetall(pending_key), dict)
+        if not pending:
+            return
+
+        rows = sorted((json.loads(value) for value in pending.values()), key=lambda row: row["created_at"])
+        try:
+            cls._insert_messages(db, rows)
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            cls._insert_messages(db, rows)
+            db.commit()
+
+        redis_call(lambda: redis_client.hdel(pending_key, *pending.keys()), lambda: None)
+
+    @classmethod
+    async def flush_session_async(cls, db: AsyncSession, session: ChatSession):
+        """Async variant of flush_session"""
+        pending_key = cls._get_pending_key(session.session_token)
+        pending = await redis_call_async(lambda: async_redis_client.hgetall(pending_key), dict)
+        if not pending:
+            return
+
+        rows = sorted((json.loads(value) for value in pending.values()), key=lambda row: row["created_at"])
+        try:
+            await cls._insert_messages_async(db, rows)
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            await cls._insert_messages_async(db, rows)
+            await db.commit()
+
+        await redis_call_async(lambda: async_redis_client.hdel(pending_key, *pending.keys()), lambda: None)
+
+    @classmethod
+    def _parse(cls, entries):
+        """Rows, pending hash fields and counters of a batch; raises on a malformed entry"""
+        rows = []
+        pending_fields = {}
+        counters: Dict[str, Dict[int, List[int]]] = {"request_count": {}, "token_count": {}}
+
+        for _, fields in entries:
+            payload = json.loads(fields["payload"])
+            if fields["type"] == "messages":
+                rows.extend(payload)
+                pending_key = cls._get_pending_key(fields["session_token"])
+                pending_fields.setdefault(pending_key, []).extend(row["event_id"] for row in payload)
+            elif fields["type"] == "usage":
+                for name, values in counters.items():
+                    if payload.get(name) is not None:
+                        session_id = payload["session_id"]
+                        values[session_id] = cls._fold_counter(values.get(session_id), int(payload[name]), bool(payload.get("refunded")))
+            else:
+                raise ValueError(f"Unknown write-behind entry type {fields['type']!r}")
+
+        return rows, pending_fields, counters
+
+    @classmethod
+    async def _apply(cls, entries):
+        """Write a batch in a single transaction and ack it"""
+        rows, pending_fields, counters = cls._parse(entries)
+
+        for attempt in range(2):
+            try:
+                async with AsyncSessionLocal() as db:
+                    await cls._insert_messages_async(db, rows)
+                    for name, values in counters.items():
+                        if values:
+                            await db.execute(
+                                cls._counter_update(name),
+                                [
+                                    {"session_id": session_id, "floor": floor, "refunds": refunds}
+                                    for session_id, (floor, refunds) in values.items()
+                                ]
+                            )
+                    await db.commit()
+                break
+            except IntegrityError:
+                if attempt:
+                    raise
+
+        await cls._ack(entries, pending_fields)
+
+    @classmethod
+    async def _ack(cls, entries, pending_fields: Dict[str, List[str]], dead_letters: Sequence[dict] = ()):
+        entry_ids = [entry_id for entry_id, _ in entries]
+        pipe = async_redis_client.pipeline(transaction=False)
+        for dead_letter in dead_letters:
+            pipe.xadd(cls.DEAD_LETTER_KEY, dead_letter)
+        pipe.xack(cls.STREAM_KEY, cls.GROUP, *entry_ids)
+        pipe.xdel(cls.STREAM_KEY, *entry_ids)
+        for pending_key, event_ids in pending_fields.items():
+            pipe.hdel(pending_key, *event_ids)
+        await pipe.execute()
+
+    @classmethod
+    async def _reject(cls, entry, error: Exception):
+        """
+        Leave an entry that cannot be applied pending, so it is reclaimed and retried, until it
+        was delivered WRITE_BEHIND_MAX_DELIVERIES times; then move it to the dead-letter stream.
+        """
+        entry_id, fields = entry
+        pending = await async_redis_client.xpending_range(cls.STREAM_KEY, cls.GROUP, min=entry_id, max=entry_id, count=1)
+        deliveries = pending[0]["times_delivered"] if pending else 1
+
+        if deliveries < settings.WRITE_BEHIND_MAX_DELIVERIES:
+            Metrics.write_behind("failed")
+            logger.warning(f"Write-behind entry {entry_id} failed on delivery {deliveries}: {str(error)}")
+            return
+
+        try:
+            _, pending_fields, _ = cls._parse([entry])
+        except POISON_ERRORS:
+            pending_fields = {}
+        dead_letter = {**fields, "entry_id": entry_id, "deliveries": deliveries, "error": str(error)[:1000]}
+        await cls._ack([entry], pending_fields, [dead_letter])
+        Metrics.write_behind("dead_lettered")
+        logger.error(f"Moved write-behind entry {entry_id} to {cls.DEAD_LETTER_KEY} after {deliveries} deliveries: {str(error)}")
+
+    @classmethod
+    async def apply_batch(cls, entries) -> int:
+        """
+        Apply one batch of stream entries in a single transaction, then ack them.
+        When the batch fails on bad data its entries are applied one at a time, so a single
+        malformed entry cannot hold back the others. Returns the number of entries applied.
+        """
+        try:
+            await cls._apply(entries)
+            Metrics.write_behind("applied", len(entries))
+            return len(entries)
+        except POISON_ERRORS as e:
+            if len(entries) == 1:
+                await cls._reject(entries[0], e)
+                return 0
+            logger.warning(f"Write-behind batch of {len(entries)} entries failed, applying them one at a time: {str(e)}")
+
+        applied = 0
+        for entry in entries:
+            try:
+                await cls._apply([entry])
+            except POISON_ERRORS as e:
+                await cls._reject(entry, e)
+                continue
+            Metrics.write_behind("applied")
+            applied += 1
+        return applied
+
+    @classmethod
+    async def ensure_group(cls):
+        try:
+            await async_redis_client.xgroup_create(cls.STREAM_KEY, cls.GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    @classmethod
+    async def run_consumer(cls, stop_event: asyncio.Event, consumer_name: Optional[str] = None):
+        """
+        Consume the stream until stop_event is set.
+        Entries left unacknowledged by a crashed consumer are reclaimed after WRITE_BEHIND_CLAIM_IDLE_MS.
+        """
+        consumer_name = consumer_name or f"{socket.gethostname()}-{os.getpid()}"
+        await cls.ensure_group()
+        last_claim = 0.0
+
+        while not stop_event.is_set():
+            if RedisCircuit.is_open():
+                await asyncio.sleep(1)
+                continue
+            try:
+                entries = []
+                if time.monotonic() - last_claim > settings.WRITE_BEHIND_CLAIM_IDLE_MS / 1000:
+                    last_claim = time.monotonic()
+                    claimed = await async_redis_client.xautoclaim(
+                        cls.STREAM_KEY, cls.GROUP, consumer_name,
+                        min_idle_time=settings.WRITE_BEHIND_CLAIM_IDLE_MS,
+                        count=settings.WRITE_BEHIND_BATCH_SIZE
+                    )
+                    entries = claimed[1]
+
+                if not entries:
+                    response = await async_redis_client.xreadgroup(
+                        cls.GROUP, consumer_name, {cls.STREAM_KEY: ">"},
+                        count=settings.WRITE_BEHIND_BATCH_SIZE,
+                        block=settings.WRITE_BEHIND_BLOCK_MS
+                    )
+                    entries = response[0][1] if response else []
+
+                if entries:
+                    await cls.apply_batch(entries)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Write-behind consumer error: {str(e)}")
+                await asyncio.sleep(1)
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    await WriteBehind.run_consumer(asyncio.Event())
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,158 @@
+import time
+import random
+import asyncio
+import threading
+from typing import Any, Dict, List, Optional
+
+from app.core import settings
+from app.models import ModelRegistry
+from app.tokenizer import Tokenizer
+
+class ProviderError(Exception):
+    """Raised by a provider when the upstream call fails"""
+
+class LLMProvider:
+    """
+    Interface of the upstream model.
+    start_chat returns a chat object with send_message(message, generation_config=None)
+    and send_message_async(message, generation_config=None, stream=False) whose results
+    expose .text and .usage_metadata (prompt_token_count, candidates_token_count) like
+    the google.generativeai responses do.
+    """
+
+    name = "base"
+
+    def start_chat(self, profile: str, history: List[Dict[str, Any]]):
+        raise NotImplementedError
+
+    def warm_up(self):
+        pass
+
+class GeminiProvider(LLMProvider):
+    """Gemini through the process-wide ModelRegistry clients"""
+
+    name = "gemini"
+
+    def start_chat(self, profile: str, history: List[Dict[str, Any]]):
+        return ModelRegistry.start_chat(profile, history)
+
+    def warm_up(self):
+        ModelRegistry.warm_up()
+
+class StubUsage:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+class StubResponse:
+    def __init__(self, text: str, usage_metadata: Optional[StubUsage]):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+class StubStream:
+    """Async iterator over response chunks; usage_metadata is set once the last chunk was read"""
+
+    def __init__(self, pieces: List[str], prompt_tokens: int, delays: List[float]):
+        self.pieces = pieces
+        self.prompt_tokens = prompt_tokens
+        self.delays = delays
+        self.usage_metadata = None
+
+    async def __aiter__(self):
+        output_tokens = 0
+        for piece, delay in zip(self.pieces, self.delays):
+            await asyncio.sleep(delay)
+            output_tokens += settings.STUB_STREAM_CHUNK_TOKENS
+            yield StubResponse(piece, StubUsage(self.prompt_tokens, output_tokens))
+        self.usage_metadata = StubUsage(self.prompt_tokens, output_tokens)
+
+class StubChat:
+    def __init__(self, provider: "StubProvider", profile: str, history: List[Dict[str, Any]]):
+        self.provider = provider
+        self.profile = profile
+        self.history = history
+
+    def _plan(self, message: str, generation_config: Optional[Dict[str, Any]]):
+        generation_config = generation_config or ModelRegistry.get_generation_config(self.profile)
+        texts = [part["text"] for entry in self.history for part in entry["parts"]] + [message]
+        prompt_tokens = sum(Tokenizer.count_many(texts))
+        output_tokens = min(settings.STUB_OUTPUT_TOKENS, generation_config.get("max_output_tokens", settings.STUB_OUTPUT_TOKENS))
+        latency, failed = self.provider.draw()
+        return prompt_tokens, max(output_tokens, 1), latency, failed
+
+    def send_message(self, message: str, generation_config: Optional[Dict[str, Any]] = None, **kwargs):
+        prompt_tokens, output_tokens, latency, failed = self._plan(message, generation_config)
+        time.sleep(latency)
+        if failed:
+            raise ProviderError("Stub provider error")
+        return StubResponse(StubProvider.make_text(output_tokens), StubUsage(prompt_tokens, output_tokens))
+
+    async def send_message_async(self, message: str, generation_config: Optional[Dict[str, Any]] = None, stream: bool = False, **kwargs):
+        prompt_tokens, output_tokens, latency, failed = self._plan(message, generation_config)
+
+        if not stream:
+            await asyncio.sleep(latency)
+            if failed:
+                raise ProviderError("Stub provider error")
+            return StubResponse(StubProvider.make_text(output_tokens), StubUsage(prompt_tokens, output_tokens))
+
+        if failed:
+            await asyncio.sleep(latency)
+            raise ProviderError("Stub provider error")
+
+        chunk_tokens = settings.STUB_STREAM_CHUNK_TOKENS
+        pieces = [StubProvider.make_text(chunk_tokens) + " " for _ in range(max(output_tokens // chunk_tokens, 1))]
+        return StubStream(pieces, prompt_tokens, [latency / len(pieces)] * len(pieces))
+
+class StubProvider(LLMProvider):
+    """
+    Offline, deterministic stand-in for load tests and CI.
+    Latencies and failures are drawn from one random sequence seeded with STUB_SEED,
+    so the same request order reproduces the same run.
+    """
+
+    name = "stub"
+    WORD = "lorem"
+
+    def __init__(self):
+        self._random = random.Random(settings.STUB_SEED)
+        self._lock = threading.Lock()
+
+    def draw(self):
+        """Return (latency in seconds, whether the call fails)"""
+        median = settings.STUB_LATENCY_MS / 1000
+        spread = settings.STUB_LATENCY_SPREAD
+
+        with self._lock:
+            if settings.STUB_LATENCY_DISTRIBUTION == "uniform":
+                latency = self._random.uniform(median * (1 - spread), median * (1 + spread))
+            elif settings.STUB_LATENCY_DISTRIBUTION == "lognormal":
+                latency = median * self._random.lognormvariate(0, spread)
+            else:
+                latency = median
+            failed = self._random.random() < settings.STUB_ERROR_RATE
+
+        return max(latency, 0), failed
+
+    @classmethod
+    def make_text(cls, tokens: int) -> str:
+        """Text the local tokenizer counts as roughly the given number of tokens"""
+        return " ".join([cls.WORD] * tokens)
+
+    def start_chat(self, profile: str, history: List[Dict[str, Any]]):
+        return StubChat(self, profile, history)
+
+PROVIDERS = {
+    GeminiProvider.name: GeminiProvider,
+    StubProvider.name: StubProvider,
+}
+
+_provider: Optional[LLMProvider] = None
+
+def get_provider() -> LLMProvider:
+    """The provider selected by settings.LLM_PROVIDER, built once per process"""
+    global _provider
+    if _provider is None:
+        _provider = PROVIDERS[settings.LLM_PROVIDER]()
+    return _provider
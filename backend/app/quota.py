@@ -0,0 +1,424 @@
+import math
+import time
+from typing import List, Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import case, func, select
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import settings, redis_client, async_redis_client, run_pipeline, run_pipeline_async, redis_call, RedisRateLimiter
+from app.data import ChatSession, User
+from app.cache import TTLCache
+from app.metrics import Metrics
+
+QUOTA_SCRIPT = """
+local now_t = redis.call('TIME')
+local now = tonumber(now_t[1]) * 1000 + math.floor(tonumber(now_t[2]) / 1000)
+local windows = tonumber(ARGV[1])
+local allowed = 1
+local remaining = -1
+local retry_after = 0
+local reset_after = 0
+local window = 0
+local new_tats = {}
+
+for i = 1, windows do
+    local limit = tonumber(ARGV[2 * i])
+    local period = tonumber(ARGV[2 * i + 1])
+    local interval = period / limit
+    local tat = tonumber(redis.call('GET', KEYS[i]))
+    if tat == nil or tat < now then
+        tat = now
+    end
+    local new_tat = tat + interval
+    local allow_at = new_tat - period
+    new_tats[i] = new_tat
+
+    if now < allow_at then
+        if allowed == 1 or allow_at - now > retry_after then
+            retry_after = allow_at - now
+            reset_after = tat - now
+            window = i
+        end
+        allowed = 0
+        remaining = 0
+    elseif allowed == 1 then
+        local left = math.floor((now - allow_at) / interval)
+        if remaining < 0 or left < remaining then
+            remaining = left
+            reset_after = new_tat - now
+            window = i
+        end
+    end
+end
+
+for i = windows + 1, #KEYS do
+    local limit = tonumber(ARGV[windows + 1 + i])
+    if tonumber(redis.call('GET', KEYS[i]) or '0') >= limit then
+        local reset = 60000 - now % 60000
+        if allowed == 1 or reset > retry_after then
+            retry_after = reset
+            reset_after = reset
+            window = i
+        end
+        allowed = 0
+        remaining = 0
+    end
+end
+
+if allowed == 1 then
+    for i = 1, windows do
+        redis.call('SET', KEYS[i], tostring(new_tats[i]), 'PX', math.ceil(new_tats[i] - now))
+    end
+end
+
+return {allowed, remaining, retry_after, reset_after, window}
+"""
+
+QUOTA_REFUND_SCRIPT = """
+local now_t = redis.call('TIME')
+local now = tonumber(now_t[1]) * 1000 + math.floor(tonumber(now_t[2]) / 1000)
+
+for i = 1, #KEYS do
+    local tat = tonumber(redis.call('GET', KEYS[i]))
+    if tat ~= nil then
+        local new_tat = tat - tonumber(ARGV[2 * i - 1]) / tonumber(ARGV[2 * i])
+        if new_tat > now then
+            redis.call('SET', KEYS[i], tostring(new_tat), 'PX', math.ceil(new_tat - now))
+        else
+            redis.call('DEL', KEYS[i])
+        end
+    end
+end
+
+return 1
+"""
+
+REQUEST_WINDOWS = dict(RedisRateLimiter.WINDOWS)
+
+class Quota:
+    """
+    Hierarchical limits: global -> user -> session.
+    Request rates (per minute and day) are GCRA windows at every level; tokens per minute are
+    counters charged with the actual usage when a reservation settles and checked before the next
+    request. All windows of a request are checked and consumed together in one script call, which
+    replaces the per-session rate limit call, so the extra levels cost no extra round trip.
+    Quota keys share the {quota} hash tag. On Redis Cluster a script cannot span slots, so there
+    the session windows and the quota windows are two calls, and token counters a pipeline of their own;
+    when the second call refuses, the windows consumed by the first are given back.
+    While Redis is unavailable only the per-session limits are enforced, by LocalLimiter.
+    """
+
+    _quota_script = redis_client.register_script(QUOTA_SCRIPT)
+    _async_quota_script = async_redis_client.register_script(QUOTA_SCRIPT)
+    _refund_script = redis_client.register_script(QUOTA_REFUND_SCRIPT)
+    _async_refund_script = async_redis_client.register_script(QUOTA_REFUND_SCRIPT)
+
+    _limits = TTLCache(maxsize=settings.SESSION_CACHE_SIZE, ttl=settings.SESSION_CACHE_TTL)
+
+    TOKEN_WINDOW_TTL = 120
+
+    @staticmethod
+    def _key(*parts) -> str:
+        return ":".join(["quota", "{quota}", *map(str, parts)])
+
+    @classmethod
+    def _scope_key(cls, user_id: Optional[int], *parts) -> str:
+        """Generate a key for a window of the global scope, or of a user's"""
+        if user_id is None:
+            return cls._key("global", *parts)
+        return cls._key("user", user_id, *parts)
+
+    @classmethod
+    def _token_key(cls, user_id: Optional[int]) -> str:
+        current_minute = int(time.time() / 60)
+        return cls._scope_key(user_id, "tpm", current_minute)
+
+    @staticmethod
+    def colocated() -> bool:
+        """Whether quota keys can share a script call with per-session keys"""
+        return not settings.REDIS_CLUSTER
+
+    @staticmethod
+    def global_limits() -> dict:
+        limits = {
+            "rpm": settings.GLOBAL_RATE_LIMIT_RPM,
+            "rpd": settings.GLOBAL_RATE_LIMIT_RPD,
+            "tpm": settings.GLOBAL_TOKEN_LIMIT_TPM,
+        }
+        return {name: limit for name, limit in limits.items() if limit}
+
+    @staticmethod
+    def _limits_of(user: Optional[User]) -> dict:
+        if user is None or not user.is_active:
+            return {}
+        limits = {"rpm": user.rate_limit_rpm, "rpd": user.rate_limit_rpd, "tpm": user.token_limit_tpm}
+        return {name: limit for name, limit in limits.items() if limit}
+
+    @classmethod
+    def user_limits(cls, db: Session, user_id: Optional[int]) -> dict:
+        """Limits of the account a session belongs to, cached per process like session rows"""
+        if user_id is None:
+            return {}
+        limits = cls._limits.get(user_id)
+        if limits is None:
+            limits = cls._limits_of(db.get(User, user_id))
+            cls._limits.set(user_id, limits)
+        return limits
+
+    @classmethod
+    async def user_limits_async(cls, db: AsyncSession, user_id: Optional[int]) -> dict:
+        """Async variant of user_limits"""
+        if user_id is None:
+            return {}
+        limits = cls._limits.get(user_id)
+        if limits is None:
+            limits = cls._limits_of(await db.get(User, user_id))
+            cls._limits.set(user_id, limits)
+        return limits
+
+    @classmethod
+    def forget_user(cls, user_id: int):
+        cls._limits.pop(user_id)
+
+    @classmethod
+    def applies(cls, session: ChatSession, user_limits: dict) -> bool:
+        """Whether a request of this session has to go through the rate limit script at all"""
+        return session.plan_type == "request" or bool(user_limits) or bool(cls.global_limits())
+
+    @classmethod
+    def _session_scopes(cls, session: ChatSession) -> List[tuple]:
+        if session.plan_type != "request":
+            return []
+        return [
+            ("session", "requests", RedisRateLimiter._get_minute_key(session.session_token), session.rate_limit_rpm, "minute"),
+            ("session", "requests", RedisRateLimiter._get_day_key(session.session_token), session.rate_limit_rpd, "day"),
+        ]
+
+    @classmethod
+    def _quota_scopes(cls, session: ChatSession, user_limits: dict) -> List[tuple]:
+        scopes = []
+        levels = (("global", None, cls.global_limits()), ("user", session.user_id, user_limits))
+        for scope, user_id, limits in levels:
+            if limits.get("rpm"):
+                scopes.append((scope, "requests", cls._scope_key(user_id, "rpm"), limits["rpm"], "minute"))
+            if limits.get("rpd"):
+                scopes.append((scope, "requests", cls._scope_key(user_id, "rpd"), limits["rpd"], "day"))
+            if limits.get("tpm"):
+                scopes.append((scope, "tokens", cls._token_key(user_id), limits["tpm"], "minute"))
+        return scopes
+
+    @classmethod
+    def _calls(cls, session: ChatSession, user_limits: dict) -> List[List[tuple]]:
+        session_scopes = cls._session_scopes(session)
+        quota_scopes = cls._quota_scopes(session, user_limits)
+        if cls.colocated():
+            calls = [session_scopes + quota_scopes]
+        else:
+            calls = [quota_scopes, session_scopes]
+        return [
+            sorted(scopes, key=lambda scope: scope[1] == "tokens")
+            for scopes in calls if scopes
+        ]
+
+    @staticmethod
+    def _script_params(scopes: List[tuple]):
+        windows = [scope for scope in scopes if scope[1] == "requests"]
+        counters = [scope for scope in scopes if scope[1] == "tokens"]
+        args = [len(windows)]
+        for _, _, _, limit, unit in windows:
+            args.extend([limit, REQUEST_WINDOWS[unit]])
+        args.extend(limit for _, _, _, limit, _ in counters)
+        return [scope[2] for scope in scopes], args
+
+    @staticmethod
+    def _refund_params(scopes: List[tuple]):
+        """Keys and (period, limit) pairs of the request windows an earlier call of the same request consumed"""
+        windows = [scope for scope in scopes if scope[1] == "requests"]
+        args = []
+        for _, _, _, limit, unit in windows:
+            args.extend([REQUEST_WINDOWS[unit], limit])
+        return [scope[2] for scope in windows], args
+
+    @staticmethod
+    def _limited_detail(scope: str, kind: str, limit: int, unit: str) -> str:
+        if scope == "session":
+            return f"Rate limit exceeded: {limit} {kind} per {unit}"
+        if scope == "user":
+            return f"Account rate limit exceeded: {limit} {kind} per {unit}"
+        return f"Service is at capacity: {limit} {kind} per {unit}"
+
+    @classmethod
+    def _check_result(cls, raw_result, scopes: List[tuple]) -> Optional[dict]:
+        allowed, remaining, retry_after_ms, reset_after_ms, window = (int(value) for value in raw_result)
+        if window == 0:
+            return None
+
+        scope, kind, _, limit, unit = scopes[window - 1]
+        result = {
+            "allowed": bool(allowed),
+            "limit": limit,
+            "window": unit,
+            "scope": scope,
+            "remaining": max(remaining, 0),
+            "retry_after": -(-retry_after_ms // 1000),
+            "reset_after": -(-reset_after_ms // 1000),
+        }
+
+        if not allowed:
+            reason = f"{kind}_per_{unit}" if scope == "session" else f"{scope}_{kind}_per_{unit}"
+            Metrics.rate_limited(reason)
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=cls._limited_detail(scope, kind, limit, unit),
+                headers=RedisRateLimiter.get_headers(result)
+            )
+
+        return result
+
+    @classmethod
+    def check_rate_limit(cls, session: ChatSession, user_limits: dict) -> Optional[dict]:
+        """
+        Atomically check and consume one request from every window the session is subject to.
+        Returns the remaining quota of the tightest window, raises 429 with Retry-After when limited.
+        """
+        result = None
+        consumed = []
+        for scopes in cls._calls(session, user_limits):
+            keys, args = cls._script_params(scopes)
+            raw_result = cls._quota_script(keys=keys, args=args)
+            if consumed and not int(raw_result[0]):
+                keys, args = cls._refund_params(consumed)
+                cls._refund_script(keys=keys, args=args)
+            result = cls._check_result(raw_result, scopes) or result
+            consumed.extend(scopes)
+        return result
+
+    @classmethod
+    async def check_rate_limit_async(cls, session: ChatSession, user_limits: dict) -> Optional[dict]:
+        """Async variant of check_rate_limit"""
+        result = None
+        consumed = []
+        for scopes in cls._calls(session, user_limits):
+            keys, args = cls._script_params(scopes)
+            raw_result = await cls._async_quota_script(keys=keys, args=args)
+            if consumed and not int(raw_result[0]):
+                keys, args = cls._refund_params(consumed)
+                await cls._async_refund_script(keys=keys, args=args)
+            result = cls._check_result(raw_result, scopes) or result
+            consumed.extend(scopes)
+        return result
+
+    @classmethod
+    def refund_request(cls, session: ChatSession, user_limits: dict):
+        """Give back the request check_rate_limit consumed in every window, e.g. for an unbilled cache hit"""
+        for scopes in cls._calls(session, user_limits):
+            keys, args = cls._refund_params(scopes)
+            if keys:
+                cls._refund_script(keys=keys, args=args)
+
+    @classmethod
+    async def refund_request_async(cls, session: ChatSession, user_limits: dict):
+        """Async variant of refund_request"""
+        for scopes in cls._calls(session, user_limits):
+            keys, args = cls._refund_params(scopes)
+            if keys:
+                await cls._async_refund_script(keys=keys, args=args)
+
+    @classmethod
+    def _charged_keys(cls, session: ChatSession, user_limits: dict) -> List[str]:
+        keys = []
+        if cls.global_limits():
+            keys.append(cls._token_key(None))
+        if session.user_id is not None and user_limits:
+            keys.append(cls._token_key(session.user_id))
+        return keys
+
+    @classmethod
+    def token_keys(cls, session: ChatSession, user_limits: dict) -> List[str]:
+        """Token counters to charge inside the session's own token script; empty on Redis Cluster"""
+        return cls._charged_keys(session, user_limits) if cls.colocated() else []
+
+    @classmethod
+    def _queue_charge(cls, pipe, keys: List[str], tokens: int):
+        for key in keys:
+            pipe.incrby(key, tokens)
+            pipe.expire(key, cls.TOKEN_WINDOW_TTL)
+
+    @classmethod
+    def charge_tokens(cls, session: ChatSession, user_limits: dict, tokens: int):
+        """Charge the token counters that token_keys could not hand to the session's script"""
+        if cls.colocated() or tokens <= 0:
+            return
+        keys = cls._charged_keys(session, user_limits)
+        if keys:
+            run_pipeline(lambda pipe: cls._queue_charge(pipe, keys, tokens), transaction=False)
+
+    @classmethod
+    async def charge_tokens_async(cls, session: ChatSession, user_limits: dict, tokens: int):
+        """Async variant of charge_tokens"""
+        if cls.colocated() or tokens <= 0:
+            return
+        keys = cls._charged_keys(session, user_limits)
+        if keys:
+            await run_pipeline_async(lambda pipe: cls._queue_charge(pipe, keys, tokens), transaction=False)
+
+    @staticmethod
+    def _usage_query(user_id: Optional[int]):
+        query = select(
+            func.count(ChatSession.id),
+            func.sum(case((ChatSession.is_active == True, 1), else_=0)),
+            func.sum(ChatSession.request_count),
+            func.sum(ChatSession.token_count),
+        )
+        if user_id is not None:
+            query = query.where(ChatSession.user_id == user_id)
+        return query
+
+    @classmethod
+    def _queue_window_reads(cls, pipe, user_id: Optional[int]):
+        pipe.get(cls._scope_key(user_id, "rpm"))
+        pipe.get(cls._scope_key(user_id, "rpd"))
+        pipe.get(cls._token_key(user_id))
+
+    @staticmethod
+    def _used_requests(tat, limit: Optional[int], unit: str) -> Optional[int]:
+        """Requests counted against a GCRA window, read back from its theoretical arrival time"""
+        if not limit:
+            return None
+        if tat is None:
+            return 0
+        interval = REQUEST_WINDOWS[unit] / limit
+        return math.ceil(max(float(tat) - time.time() * 1000, 0) / interval)
+
+    @classmethod
+    def _usage(cls, user_id: Optional[int], limits: dict, row, windows) -> dict:
+        sessions, active_sessions, request_count, token_count = row
+        minute_tat, day_tat, minute_tokens = windows if windows else (None, None, None)
+        return {
+            "scope": "global" if user_id is None else "user",
+            "user_id": user_id,
+            "limits": limits,
+            "sessions": sessions or 0,
+            "active_sessions": active_sessions or 0,
+            "request_count": request_count or 0,
+            "token_count": token_count or 0,
+            "minute_requests": cls._used_requests(minute_tat, limits.get("rpm"), "minute"),
+            "day_requests": cls._used_requests(day_tat, limits.get("rpd"), "day"),
+            "minute_tokens": int(minute_tokens or 0) if windows and limits else None,
+        }
+
+    @classmethod
+    def usage(cls, db: Session, user_id: Optional[int] = None) -> dict:
+        """
+        Aggregated usage of a user's sessions, or of all sessions.
+        Totals come from chat_sessions; current window usage from Redis, None while it is unreachable.
+        """
+        limits = cls.global_limits() if user_id is None else cls.user_limits(db, user_id)
+        row = db.execute(cls._usage_query(user_id)).one()
+        windows = redis_call(
+            lambda: run_pipeline(lambda pipe: cls._queue_window_reads(pipe, user_id), transaction=False),
+            lambda: None
+        )
+        return cls._usage(user_id, limits, row, windows)
@@ -1,150 +1,409 @@
-from redis import Redis
 from datetime import datetime
 import time
+import logging
 from fastapi import HTTPException, status
-from typing import Optional
-
-from app.core import settings
-
-redis_client = Redis(
-    host=settings.REDIS_HOST,
-    port=settings.REDIS_PORT,
-    db=0,
-    decode_responses=True,
-    password=settings.REDIS_PASSWORD
-)
-
-def test_redis_connection():
-    try:
-        redis_client.ping()
-        return True
-    except Exception as e:
-        print(f"Redis connection error: {e}")
-        return False
+from typing import Optional, Sequence, Tuple
+import uuid
+
+from app.core import settings, redis_client, async_redis_client, run_pipeline, run_pipeline_async, session_key
+from app.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RESERVE_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'capacity', 'tokens', 'last_refill', 'total_limit')
+if not bucket[1] then
+    return {-1, 0, 0}
+end
+
+local capacity = tonumber(bucket[1])
+local tokens = tonumber(bucket[2]) or 0
+local last_refill = tonumber(bucket[3]) or 0
+local total_limit = tonumber(bucket[4])
+local usage = tonumber(redis.call('GET', KEYS[2]) or '0')
+local requested = tonumber(ARGV[1])
+local min_tokens = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+
+if total_limit then
+    local left = total_limit - usage
+    if left < min_tokens then
+        return {-2, usage, total_limit}
+    end
+    if requested > left then
+        requested = left
+    end
+end
+
+local now_t = redis.call('TIME')
+local now = tonumber(now_t[1]) + tonumber(now_t[2]) / 1000000
+local available = math.min(capacity, tokens + (now - last_refill) * (capacity / 60))
+if available < requested then
+    return {-3, math.floor(available), requested}
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(available - requested), 'last_refill', tostring(now))
+usage = redis.call('INCRBY', KEYS[2], requested)
+
+if ttl > 0 then
+    redis.call('INCRBY', KEYS[3], requested)
+    redis.call('EXPIRE', KEYS[3], ttl)
+else
+    redis.call('INCRBY', KEYS[4], requested)
+    redis.call('EXPIRE', KEYS[4], 120)
+    redis.call('INCRBY', KEYS[5], requested)
+    redis.call('EXPIRE', KEYS[5], 86400 + 3600)
+    for i = 6, #KEYS do
+        redis.call('INCRBY', KEYS[i], requested)
+        redis.call('EXPIRE', KEYS[i], 120)
+    end
+end
+
+return {requested, usage, total_limit or -1}
+"""
+
+TOKEN_SETTLE_SCRIPT = """
+local reservation = redis.call('GET', KEYS[3])
+if reservation == 'settled' then
+    return {0, tonumber(redis.call('GET', KEYS[2]) or '0')}
+end
+
+local status = 1
+local reserved = tonumber(reservation)
+if not reserved then
+    status = 2
+    reserved = 0
+end
+redis.call('SET', KEYS[3], 'settled', 'EX', ARGV[2])
+
+local actual = tonumber(ARGV[1])
+local delta = actual - reserved
+local usage = redis.call('INCRBY', KEYS[2], delta)
+
+local bucket = redis.call('HMGET', KEYS[1], 'capacity', 'tokens')
+if bucket[1] then
+    local tokens = math.min(tonumber(bucket[1]), (tonumber(bucket[2]) or 0) - delta)
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens))
+end
+
+if actual > 0 then
+    redis.call('INCRBY', KEYS[4], actual)
+    redis.call('EXPIRE', KEYS[4], 120)
+    redis.call('INCRBY', KEYS[5], actual)
+    redis.call('EXPIRE', KEYS[5], 86400 + 3600)
+    for i = 6, #KEYS do
+        redis.call('INCRBY', KEYS[i], actual)
+        redis.call('EXPIRE', KEYS[i], 120)
+    end
+end
+
+return {status, usage}
+"""
+
+TOKEN_USAGE_REPLAY_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1], 'NX')
+return redis.call('INCRBY', KEYS[1], ARGV[2])
+"""
+
+class TokenBucketMissing(HTTPException):
+    """The session has no token bucket in Redis, e.g. after Redis lost its data"""
+
+    def __init__(self):
+        super().__init__(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Token bucket not initialized"
+        )
 
 class RedisTokenBucket:
+    # A settled reservation is kept as a marker for this long, so that replaying a settle is a no-op
+    SETTLED_TTL = 600
+
+    _reserve_script = redis_client.register_script(TOKEN_RESERVE_SCRIPT)
+    _settle_script = redis_client.register_script(TOKEN_SETTLE_SCRIPT)
+    _async_reserve_script = async_redis_client.register_script(TOKEN_RESERVE_SCRIPT)
+    _async_settle_script = async_redis_client.register_script(TOKEN_SETTLE_SCRIPT)
+    _async_replay_usage_script = async_redis_client.register_script(TOKEN_USAGE_REPLAY_SCRIPT)
+
     @staticmethod
     def _get_token_bucket_key(session_token: str) -> str:
         """Generate a key for token bucket in Redis"""
-        return f"token_bucket:{session_token}"
+        return session_key("token_bucket", session_token)
     
     @staticmethod
     def _get_token_usage_key(session_token: str) -> str:
         """Generate a key for total token usage in Redis"""
-        return f"token_usage:{session_token}"
+        return session_key("token_usage", session_token)
+
+    @staticmethod
+    def _get_reservation_key(session_token: str, reservation_id: str) -> str:
+        """Generate a key for an outstanding token reservation"""
+        return session_key("token_reservation", session_token, reservation_id)
     
     @staticmethod
     def _get_minute_key(session_token: str) -> str:
         """Generate a key for per minute token tracking"""
         current_minute = int(time.time() / 60)
-        return f"tokenrate:tpm:{session_token}:{current_minute}"
+        return session_key("tokenrate", session_token, "tpm", current_minute)
     
     @staticmethod
     def _get_day_key(session_token: str) -> str:
         """Generate a key for per day token tracking"""
         today = datetime.now().strftime("%Y-%m-%d")
-        return f"tokenrate:tpd:{session_token}:{today}"
+        return session_key("tokenrate", session_token, "tpd", today)
     
     @classmethod
-    def initialize_token_bucket(cls, session_token: str, total_token_limit: Optional[int] = None):
-        """Initialize a token bucket for a session"""
+    def _queue_initialize(cls, pipe, session_token: str, total_token_limit: Optional[int], token_count: int = 0):
         bucket_key = cls._get_token_bucket_key(session_token)
         usage_key = cls._get_token_usage_key(session_token)
         
-        pipe = redis_client.pipeline()
-        pipe.hset(bucket_key, "capacity", 1000000)  
-        pipe.hset(bucket_key, "tokens", 1000000)    
-        pipe.hset(bucket_key, "last_refill", time.time())
+        pipe.hsetnx(bucket_key, "capacity", 1000000)
+        pipe.hsetnx(bucket_key, "tokens", 1000000)
+        pipe.hsetnx(bucket_key, "last_refill", time.time())
         
         if total_token_limit is not None:
             pipe.hset(bucket_key, "total_limit", total_token_limit)
+        else:
+            pipe.hdel(bucket_key, "total_limit")
+
+        pipe.set(usage_key, token_count, nx=True)
 
-        pipe.set(usage_key, 0)
-        
-        pipe.execute()
-    
     @classmethod
-    def check_token_limit(cls, session_token: str, tokens_to_use: int):
+    def initialize_token_bucket(cls, session_token: str, total_token_limit: Optional[int] = None, token_count: int = 0):
         """
-        Check if token usage is within limits and consume tokens
-        Returns the total tokens used so far
+        Create a session's token bucket, or update the total limit of an existing one.
+        Usage is authoritative in Redis, so an existing counter is kept; token_count only
+        seeds a missing one, e.g. from chat_sessions after Redis lost its data.
         """
-        bucket_key = cls._get_token_bucket_key(session_token)
-        usage_key = cls._get_token_usage_key(session_token)
-        
-        bucket = redis_client.hgetall(bucket_key)
-        
-        if not bucket:
+        run_pipeline(lambda pipe: cls._queue_initialize(pipe, session_token, total_token_limit, token_count))
+
+    @classmethod
+    async def initialize_token_bucket_async(cls, session_token: str, total_token_limit: Optional[int] = None, token_count: int = 0):
+        """Async variant of initialize_token_bucket"""
+        await run_pipeline_async(lambda pipe: cls._queue_initialize(pipe, session_token, total_token_limit, token_count))
+
+    @classmethod
+    def initialize_token_buckets(cls, buckets: Sequence[Tuple[str, Optional[int], int]]):
+        """initialize_token_bucket for many (session_token, total_token_limit, token_count) in one round trip"""
+        def queue(pipe):
+            for session_token, total_token_limit, token_count in buckets:
+                cls._queue_initialize(pipe, session_token, total_token_limit, token_count)
+
+        run_pipeline(queue, transaction=False)
+    
+    @classmethod
+    def _keys(cls, session_token: str, reservation_id: str = "", quota_keys: Sequence[str] = ()):
+        """The session's keys, followed by any quota counters charged alongside its per-minute usage"""
+        return [
+            cls._get_token_bucket_key(session_token),
+            cls._get_token_usage_key(session_token),
+            cls._get_reservation_key(session_token, reservation_id),
+            cls._get_minute_key(session_token),
+            cls._get_day_key(session_token),
+            *quota_keys,
+        ]
+
+    @staticmethod
+    def _raise_for_reserve_result(result):
+        code = int(result[0])
+        if code == -1:
+            raise TokenBucketMissing()
+        if code == -2:
+            usage, total_limit = int(result[1]), int(result[2])
+            if usage >= total_limit:
+                detail = f"Total token limit of {total_limit} exceeded"
+            else:
+                detail = f"Insufficient tokens remaining: {total_limit - usage} of {total_limit} left"
+            Metrics.rate_limited("total_tokens")
             raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Token bucket not initialized"
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=detail
             )
-        
-        capacity = int(bucket.get("capacity", 1000000))
-        current_tokens = float(bucket.get("tokens", 0))
-        last_refill = float(bucket.get("last_refill", 0))
-        total_limit = int(bucket.get("total_limit", 0)) if "total_limit" in bucket else None
-        
-        current_usage = int(redis_client.get(usage_key) or 0)
-        
-        if total_limit is not None and current_usage + tokens_to_use > total_limit:
+        if code == -3:
+            Metrics.rate_limited("tokens_rate")
             raise HTTPException(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail=f"Total token limit of {total_limit} exceeded"
+                detail=f"Token rate limit exceeded. Available: {int(result[1])}, Requested: {int(result[2])}"
             )
-        
-        now = time.time()
-        time_elapsed = now - last_refill
-        tokens_to_add = (time_elapsed * (capacity / 60))
-        
-        new_tokens = min(capacity, current_tokens + tokens_to_add)
 
-        if new_tokens < tokens_to_use:
-            raise HTTPException(
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail=f"Token rate limit exceeded. Available: {int(new_tokens)}, Requested: {tokens_to_use}"
+    @classmethod
+    def check_token_limit(cls, session_token: str, tokens_to_use: int, quota_keys: Sequence[str] = ()):
+        """
+        Check if token usage is within limits and consume tokens
+        Returns the total tokens used so far
+        """
+        result = cls._reserve_script(
+            keys=cls._keys(session_token, quota_keys=quota_keys),
+            args=[tokens_to_use, tokens_to_use, 0]
+        )
+        cls._raise_for_reserve_result(result)
+
+        return int(result[1])
+
+    @staticmethod
+    def _reservation_from_result(reservation_id: str, result):
+        total_limit = int(result[2])
+        return {
+            "reservation_id": reservation_id,
+            "reserved": int(result[0]),
+            "total_usage": int(result[1]),
+            "total_limit": total_limit if total_limit >= 0 else None,
+        }
+
+    @classmethod
+    async def check_token_limit_async(cls, session_token: str, tokens_to_use: int, quota_keys: Sequence[str] = ()):
+        """Async variant of check_token_limit"""
+        result = await cls._async_reserve_script(
+            keys=cls._keys(session_token, quota_keys=quota_keys),
+            args=[tokens_to_use, tokens_to_use, 0]
+        )
+        cls._raise_for_reserve_result(result)
+
+        return int(result[1])
+
+    @classmethod
+    def reserve_tokens(cls, session_token: str, estimate: int, min_tokens: Optional[int] = None):
+        """
+        Atomically reserve an estimated token count before calling the model.
+        When the estimate does not fit the remaining total limit, the reservation is
+        clamped to what is left as long as at least min_tokens fit.
+        """
+        min_tokens = estimate if min_tokens is None else min(min_tokens, estimate)
+        reservation_id = uuid.uuid4().hex
+
+        result = cls._reserve_script(
+            keys=cls._keys(session_token, reservation_id),
+            args=[estimate, min_tokens, settings.TOKEN_RESERVATION_TTL]
+        )
+        cls._raise_for_reserve_result(result)
+
+        return cls._reservation_from_result(reservation_id, result)
+
+    @classmethod
+    async def reserve_tokens_async(cls, session_token: str, estimate: int, min_tokens: Optional[int] = None):
+        """Async variant of reserve_tokens"""
+        min_tokens = estimate if min_tokens is None else min(min_tokens, estimate)
+        reservation_id = uuid.uuid4().hex
+
+        result = await cls._async_reserve_script(
+            keys=cls._keys(session_token, reservation_id),
+            args=[estimate, min_tokens, settings.TOKEN_RESERVATION_TTL]
+        )
+        cls._raise_for_reserve_result(result)
+
+        return cls._reservation_from_result(reservation_id, result)
+
+    @classmethod
+    async def extend_reservation_async(cls, session_token: str, reservation: dict, estimate: int, min_tokens: Optional[int] = None):
+        """
+        Atomically grow an outstanding reservation, e.g. while a streamed response is still generating,
+        and refresh its TTL. Updates and returns the reservation; raises 429 like reserve_tokens when
+        nothing more fits.
+        """
+        min_tokens = estimate if min_tokens is None else min(min_tokens, estimate)
+
+        result = await cls._async_reserve_script(
+            keys=cls._keys(session_token, reservation["reservation_id"]),
+            args=[estimate, min_tokens, settings.TOKEN_RESERVATION_TTL]
+        )
+        cls._raise_for_reserve_result(result)
+
+        extension = cls._reservation_from_result(reservation["reservation_id"], result)
+        reservation["reserved"] += extension["reserved"]
+        reservation["total_usage"] = extension["total_usage"]
+        return reservation
+
+    @staticmethod
+    def _usage_from_settle_result(session_token: str, actual_tokens: int, result) -> int:
+        if int(result[0]) == 2:
+            logger.warning(
+                f"Reservation of session {session_token[:8]} was missing in Redis, e.g. after a failover; "
+                f"charged the actual {actual_tokens} tokens"
             )
-        
-        pipe = redis_client.pipeline()
-        pipe.hset(bucket_key, "tokens", new_tokens - tokens_to_use)
-        pipe.hset(bucket_key, "last_refill", now)
-        
-        pipe.incrby(usage_key, tokens_to_use)
-        
-        minute_key = cls._get_minute_key(session_token)
-        day_key = cls._get_day_key(session_token)
-        
-        pipe.incrby(minute_key, tokens_to_use)
-        pipe.expire(minute_key, 120)  
-        
-        pipe.incrby(day_key, tokens_to_use)
-        pipe.expire(day_key, 86400 + 3600)  
-        
-        pipe.execute()
+        return int(result[1])
 
-        return current_usage + tokens_to_use
-    
     @classmethod
-    def get_token_usage(cls, session_token: str):
-        """Get current token usage statistics"""
-        usage_key = cls._get_token_usage_key(session_token)
-        bucket_key = cls._get_token_bucket_key(session_token)
-        
-        total_usage = int(redis_client.get(usage_key) or 0)
+    def settle_tokens(cls, session_token: str, reservation: dict, actual_tokens: int, quota_keys: Sequence[str] = ()):
+        """
+        Atomically replace a reservation with the actual token count, refunding the difference.
+        A reservation Redis no longer has is still billed the actual count, while settling the
+        same reservation twice is a no-op. Returns the total tokens used so far.
+        """
+        result = cls._settle_script(
+            keys=cls._keys(session_token, reservation["reservation_id"], quota_keys),
+            args=[actual_tokens, cls.SETTLED_TTL]
+        )
+        return cls._usage_from_settle_result(session_token, actual_tokens, result)
 
-        bucket = redis_client.hgetall(bucket_key)
-        total_limit = int(bucket.get("total_limit", 0)) if "total_limit" in bucket else None
+    @classmethod
+    async def settle_tokens_async(cls, session_token: str, reservation: dict, actual_tokens: int, quota_keys: Sequence[str] = ()):
+        """Async variant of settle_tokens"""
+        result = await cls._async_settle_script(
+            keys=cls._keys(session_token, reservation["reservation_id"], quota_keys),
+            args=[actual_tokens, cls.SETTLED_TTL]
+        )
+        return cls._usage_from_settle_result(session_token, actual_tokens, result)
 
-        minute_key = cls._get_minute_key(session_token)
-        minute_usage = int(redis_client.get(minute_key) or 0)
+    @classmethod
+    def release_tokens(cls, session_token: str, reservation: dict):
+        """Refund a whole reservation, e.g. when the model call failed"""
+        return cls.settle_tokens(session_token, reservation, 0)
+
+    @classmethod
+    async def release_tokens_async(cls, session_token: str, reservation: dict):
+        """Async variant of release_tokens"""
+        return await cls.settle_tokens_async(session_token, reservation, 0)
+
+    @classmethod
+    async def replay_usage_async(cls, session_token: str, token_count: int, tokens: int) -> int:
+        """
+        Add tokens that were used while Redis was unreachable. If Redis lost the usage counter
+        meanwhile it is first seeded with token_count, the usage from before those tokens, rather
+        than recreated from them alone. Returns the total tokens used so far.
+        """
+        result = await cls._async_replay_usage_script(
+            keys=[cls._get_token_usage_key(session_token)],
+            args=[token_count, tokens]
+        )
+        return int(result)
+
+    @classmethod
+    def _usage_keys(cls, session_token: str):
+        return [
+            cls._get_token_usage_key(session_token),
+            cls._get_token_bucket_key(session_token),
+            cls._get_minute_key(session_token),
+            cls._get_day_key(session_token),
+        ]
+
+    @staticmethod
+    def _usage_from_values(total_usage, total_limit, minute_usage, day_usage):
+        total_usage = int(total_usage or 0)
+        total_limit = int(total_limit) if total_limit is not None else None
 
-        day_key = cls._get_day_key(session_token)
-        day_usage = int(redis_client.get(day_key) or 0)
-        
         return {
             "total_usage": total_usage,
             "total_limit": total_limit,
-            "minute_usage": minute_usage,
-            "day_usage": day_usage,
+            "minute_usage": int(minute_usage or 0),
+            "day_usage": int(day_usage or 0),
             "tokens_remaining": total_limit - total_usage if total_limit else None
-        }
\ No newline at end of file
+        }
+    
+    @classmethod
+    def _queue_usage(cls, pipe, session_token: str):
+        usage_key, bucket_key, minute_key, day_key = cls._usage_keys(session_token)
+        pipe.get(usage_key)
+        pipe.hget(bucket_key, "total_limit")
+        pipe.get(minute_key)
+        pipe.get(day_key)
+
+    @classmethod
+    def get_token_usage(cls, session_token: str):
+        """Get current token usage statistics"""
+        values = run_pipeline(lambda pipe: cls._queue_usage(pipe, session_token), transaction=False)
+        return cls._usage_from_values(*values)
+
+    @classmethod
+    async def get_token_usage_async(cls, session_token: str):
+        """Async variant of get_token_usage"""
+        values = await run_pipeline_async(lambda pipe: cls._queue_usage(pipe, session_token), transaction=False)
+        return cls._usage_from_values(*values)
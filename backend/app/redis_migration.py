@@ -0,0 +1,128 @@
+"""
+Move live Redis keys from the flat per-session layout (token_bucket:<token>,
+ratelimit:rpm:<token>, ...) to the hash-tagged one built by core.session_key.
+
+    python -m app.redis_migration [--dry-run] [--keep-old] [--batch-size 500]
+
+Run it right after deploying the hash-tagged layout. Keys are copied with DUMP/RESTORE
+so values and remaining TTLs are kept, which also works across cluster nodes. A key that
+already exists in the new layout was written since the deploy and is left as is. Cached
+state (session hashes, contexts) would be rebuilt from SQL anyway; the token buckets,
+usage counters and limiter state are what must not be lost.
+"""
+import re
+import logging
+import argparse
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+from redis import Redis
+from redis.cluster import RedisCluster
+from redis.exceptions import ResponseError
+
+from app.core import settings, session_key, _redis_connection_kwargs
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TOKEN = r"([^:{}]+)"
+
+# (SCAN pattern, legacy key pattern, builder of the new key)
+LEGACY_KEYS = (
+    ("ratelimit:*", re.compile(rf"^ratelimit:(rpm|rpd):{TOKEN}$"), lambda m: session_key("ratelimit", m[2], m[1])),
+    ("token_bucket:*", re.compile(rf"^token_bucket:{TOKEN}$"), lambda m: session_key("token_bucket", m[1])),
+    ("token_usage:*", re.compile(rf"^token_usage:{TOKEN}$"), lambda m: session_key("token_usage", m[1])),
+    ("token_reservation:*", re.compile(rf"^token_reservation:{TOKEN}:{TOKEN}$"), lambda m: session_key("token_reservation", m[1], m[2])),
+    ("tokenrate:*", re.compile(rf"^tokenrate:(tpm|tpd):{TOKEN}:{TOKEN}$"), lambda m: session_key("tokenrate", m[2], m[1], m[3])),
+    ("session:*", re.compile(rf"^session:{TOKEN}$"), lambda m: session_key("session", m[1])),
+    ("context:*", re.compile(rf"^context:{TOKEN}$"), lambda m: session_key("context", m[1])),
+    ("chat:pending:*", re.compile(rf"^chat:pending:{TOKEN}$"), lambda m: session_key("chat:pending", m[1])),
+)
+
+def get_client():
+    """A client returning raw bytes, as DUMP payloads are binary"""
+    kwargs = _redis_connection_kwargs(None)
+    kwargs["decode_responses"] = False
+    return RedisCluster(**kwargs) if settings.REDIS_CLUSTER else Redis(**kwargs)
+
+def new_key_for(key: str) -> Optional[str]:
+    """The hash-tagged name of a legacy key, or None for keys already migrated or not ours"""
+    for _, pattern, build in LEGACY_KEYS:
+        match = pattern.match(key)
+        if match:
+            return build(match)
+    return None
+
+def scan_legacy_keys(client, batch_size: int) -> Iterable[List[Tuple[str, str]]]:
+    """Yield batches of (legacy key, new key)"""
+    batch = []
+    for match, _, _ in LEGACY_KEYS:
+        for raw_key in client.scan_iter(match=match, count=batch_size):
+            key = raw_key.decode()
+            new_key = new_key_for(key)
+            if new_key is None:
+                continue
+            batch.append((key, new_key))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def migrate_batch(client, batch: List[Tuple[str, str]], keep_old: bool, stats: Counter):
+    pipe = client.pipeline(transaction=False)
+    for key, _ in batch:
+        pipe.dump(key)
+        pipe.pttl(key)
+    dumped = pipe.execute()
+
+    pipe = client.pipeline(transaction=False)
+    restored = []
+    for (key, new_key), value, pttl in zip(batch, dumped[::2], dumped[1::2]):
+        if value is None or pttl == -2:
+            stats["expired"] += 1
+            continue
+        pipe.restore(new_key, max(pttl, 0), value)
+        restored.append(key)
+    results = pipe.execute(raise_on_error=False)
+
+    moved = []
+    for key, result in zip(restored, results):
+        if isinstance(result, ResponseError):
+            if "BUSYKEY" not in str(result):
+                raise result
+            stats["exists"] += 1
+        else:
+            stats["moved"] += 1
+        moved.append(key)
+
+    if moved and not keep_old:
+        pipe = client.pipeline(transaction=False)
+        for key in moved:
+            pipe.delete(key)
+        pipe.execute()
+
+def migrate_keys(dry_run: bool = False, keep_old: bool = False, batch_size: int = 500, client=None) -> Counter:
+    client = client or get_client()
+    stats = Counter()
+
+    for batch in scan_legacy_keys(client, batch_size):
+        if dry_run:
+            stats["found"] += len(batch)
+            continue
+        migrate_batch(client, batch, keep_old, stats)
+        logger.info(f"Migrated {stats['moved']} keys so far")
+
+    logger.info(f"Redis key migration finished: {dict(stats)}")
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move per-session Redis keys to the hash-tagged layout")
+    parser.add_argument("--dry-run", action="store_true", help="only count the legacy keys")
+    parser.add_argument("--keep-old", action="store_true", help="do not delete the legacy keys after copying them")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args(argv)
+    migrate_keys(dry_run=args.dry_run, keep_old=args.keep_old, batch_size=args.batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Retention of chat history.
+
+Sessions idle for longer than SESSION_TTL are deactivated. With RETENTION on, the messages of
+sessions that have been inactive for RETENTION_ARCHIVE_AFTER are moved out of chat_messages
+into compressed, append-only segment files under RETENTION_ARCHIVE_DIR and indexed in
+archived_sessions, from where /chat/archive reads them back.
+
+    python -m app.retention    run one expiry and archiving pass
+"""
+import os
+import json
+import zlib
+import fcntl
+import asyncio
+import logging
+import datetime
+import threading
+from typing import List, Optional, Tuple
+
+from sqlalchemy import delete, exists, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import settings
+from app.data import ChatSession, ChatMessage, ArchivedSession, SessionLocal
+from app.cache import SessionCache
+from app.persistence import WriteBehind
+
+logger = logging.getLogger(__name__)
+
+class ArchiveStore:
+    """
+    Append-only segment files holding one zlib-compressed JSON record per archived batch.
+    Records are located by (segment, offset, length) from archived_sessions; a new segment is
+    started once the current one reaches max_bytes. Appends take an exclusive file lock, so
+    several processes can archive into the same directory.
+    """
+
+    SEGMENT_PREFIX = "segment-"
+    SEGMENT_SUFFIX = ".zlog"
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _segment_name(self, number: int) -> str:
+        return f"{self.SEGMENT_PREFIX}{number:06d}{self.SEGMENT_SUFFIX}"
+
+    def _current_segment(self) -> str:
+        numbers = [
+            int(name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX)
+        ]
+        if not numbers:
+            return self._segment_name(1)
+        current = max(numbers)
+        if os.path.getsize(os.path.join(self.directory, self._segment_name(current))) >= self.max_bytes:
+            return self._segment_name(current + 1)
+        return self._segment_name(current)
+
+    def append(self, record: bytes) -> Tuple[str, int]:
+        """Durably append a record; returns its segment and offset"""
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            segment = self._current_segment()
+            with open(os.path.join(self.directory, segment), "ab") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    offset = f.seek(0, os.SEEK_END)
+                    f.write(record)
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        return segment, offset
+
+    def read(self, segment: str, offset: int, length: int) -> bytes:
+        with open(os.path.join(self.directory, os.path.basename(segment)), "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+class Retention:
+    """Session expiry and archiving of the messages of inactive sessions"""
+
+    store = ArchiveStore(settings.RETENTION_ARCHIVE_DIR, settings.RETENTION_SEGMENT_MAX_BYTES)
+
+    @staticmethod
+    def enabled() -> bool:
+        return settings.RETENTION or settings.SESSION_TTL > 0
+
+    @staticmethod
+    def _cutoff(seconds: int) -> datetime.datetime:
+        return datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds)
+
+    @classmethod
+    def expire_sessions(cls, db: Session) -> int:
+        """Deactivate sessions that have not been used for SESSION_TTL seconds"""
+        if settings.SESSION_TTL <= 0:
+            return 0
+
+        expired = db.execute(
+            select(ChatSession.id, ChatSession.session_token).where(
+                ChatSession.is_active == True,
+                ChatSession.updated_at < cls._cutoff(settings.SESSION_TTL)
+            ).limit(settings.RETENTION_BATCH_SIZE)
+        ).all()
+        if not expired:
+            return 0
+
+        db.execute(
+            update(ChatSession).where(ChatSession.id.in_([session_id for session_id, _ in expired])).values(is_active=False)
+        )
+        db.commit()
+        for _, session_token in expired:
+            SessionCache.invalidate(session_token)
+
+        return len(expired)
+
+    @staticmethod
+    def _encode(messages: List[ChatMessage]) -> bytes:
+        return zlib.compress(json.dumps([
+            {
+                "id": message.id,
+                "session_id": message.session_id,
+                "role": message.role,
+                "content": message.content,
+                "created_at": message.created_at.isoformat(),
+                "token_count": message.token_count,
+                "event_id": message.event_id,
+            }
+            for message in messages
+        ]).encode())
+
+    @staticmethod
+    def _decode(record: bytes) -> List[dict]:
+        messages = json.loads(zlib.decompress(record))
+        for message in messages:
+            message["created_at"] = datetime.datetime.fromisoformat(message["created_at"])
+        return messages
+
+    @classmethod
+    def archive_session(cls, db: Session, session: ChatSession) -> int:
+        """
+        Move a session's messages into the archive; returns the number of messages moved.
+        The record is synced to disk before the index row is written and the rows are deleted
+        in one transaction, so a crash in between leaves at most an unreferenced record.
+        """
+        if WriteBehind.enabled():
+            WriteBehind.flush_session(db, session)
+
+        messages = db.execute(
+            select(ChatMessage).where(ChatMessage.session_id == session.id).order_by(ChatMessage.id.asc())
+        ).scalars().all()
+        if not messages:
+            return 0
+
+        record = cls._encode(messages)
+        segment, offset = cls.store.append(record)
+        last_message_id = messages[-1].id
+
+        db.add(ArchivedSession(
+            session_id=session.id,
+            segment=segment,
+            offset=offset,
+            length=len(record),
+            checksum=zlib.crc32(record),
+            message_count=len(messages),
+            last_message_id=last_message_id
+        ))
+        db.execute(
+            delete(ChatMessage).where(
+                ChatMessage.session_id == session.id,
+                ChatMessage.id <= last_message_id
+            )
+        )
+        db.commit()
+
+        return len(messages)
+
+    @classmethod
+    def archive_sessions(cls, db: Session) -> Tuple[int, int]:
+        """Archive one batch of inactive sessions that still have messages in chat_messages"""
+        if not settings.RETENTION:
+            return 0, 0
+
+        sessions = db.execute(
+            select(ChatSession).where(
+                ChatSession.is_active == False,
+                ChatSession.updated_at < cls._cutoff(settings.RETENTION_ARCHIVE_AFTER),
+                exists().where(ChatMessage.session_id == ChatSession.id)
+            ).limit(settings.RETENTION_BATCH_SIZE)
+        ).scalars().all()
+
+        archived = 0
+        for session in sessions:
+            archived += cls.archive_session(db, session)
+
+        return len(sessions), archived
+
+    @classmethod
+    def run_once(cls) -> dict:
+        """One expiry and archiving pass, repeated while full batches come back"""
+        stats = {"expired": 0, "sessions_archived": 0, "messages_archived": 0}
+        with SessionLocal() as db:
+            while True:
+                expired = cls.expire_sessions(db)
+                sessions, messages = cls.archive_sessions(db)
+                stats["expired"] += expired
+                stats["sessions_archived"] += sessions
+                stats["messages_archived"] += messages
+                if expired < settings.RETENTION_BATCH_SIZE and sessions < settings.RETENTION_BATCH_SIZE:
+                    break
+
+        if any(stats.values()):
+            logger.info(f"Retention pass: {stats}")
+        return stats
+
+    @classmethod
+    async def run(cls, stop_event: asyncio.Event):
+        """Run a pass every RETENTION_INTERVAL seconds until stop_event is set"""
+        while not stop_event.is_set():
+            try:
+                await asyncio.to_thread(cls.run_once)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Retention error: {str(e)}")
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=settings.RETENTION_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    @classmethod
+    def _read_records(cls, records: List[ArchivedSession]) -> List[dict]:
+        messages = []
+        for archived in records:
+            record = cls.store.read(archived.segment, archived.offset, archived.length)
+            if zlib.crc32(record) != archived.checksum:
+                raise ValueError(f"Archive record {archived.id} of session {archived.session_id} is corrupt")
+            messages.extend(cls._decode(record))
+        return messages
+
+    @staticmethod
+    def _records_query(session: ChatSession):
+        return select(ArchivedSession).where(ArchivedSession.session_id == session.id).order_by(ArchivedSession.id.asc())
+
+    @classmethod
+    async def load_archived_async(cls, db: AsyncSession, session: ChatSession) -> Optional[List[dict]]:
+        """All archived messages of a session, oldest first, or None if nothing was archived"""
+        records = (await db.execute(cls._records_query(session))).scalars().all()
+        if not records:
+            return None
+        return await asyncio.to_thread(cls._read_records, records)
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    Retention.run_once()
+
+if __name__ == "__main__":
+    main()
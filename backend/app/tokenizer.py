@@ -0,0 +1,98 @@
+import re
+import hashlib
+import logging
+from typing import List, Optional
+
+from app.core import settings
+from app.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Scripts written without spaces, where SentencePiece vocabularies spend about one token per character
+CJK_PATTERN = r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]"
+
+PIECE_PATTERN = re.compile(
+    CJK_PATTERN + r"|[A-Za-z]+|\d|[^\W\d_]+|\n+|[ \t]+|[^\w\s]|_",
+    re.UNICODE
+)
+
+class Tokenizer:
+    """
+    Offline token counter used for pre-flight quota checks and as the billing fallback
+    when the model does not report usage_metadata.
+    Counts come from a local SentencePiece model when TOKENIZER_MODEL_PATH is set and
+    the sentencepiece package is installed, and from a script-aware estimate otherwise.
+    Counts of whole message contents are memoized, keyed by a digest of the content.
+    """
+
+    _memo = TTLCache(maxsize=settings.TOKENIZER_CACHE_SIZE, ttl=settings.TOKENIZER_CACHE_TTL)
+    _processor = None
+    _loaded = False
+
+    @classmethod
+    def _get_processor(cls):
+        if not cls._loaded:
+            cls._loaded = True
+            if settings.TOKENIZER_MODEL_PATH:
+                try:
+                    import sentencepiece
+                    cls._processor = sentencepiece.SentencePieceProcessor(model_file=settings.TOKENIZER_MODEL_PATH)
+                except Exception as e:
+                    logger.warning(f"Falling back to estimated token counts: {str(e)}")
+        return cls._processor
+
+    @staticmethod
+    def _estimate(text: str) -> int:
+        tokens = 0
+        for piece in PIECE_PATTERN.findall(text):
+            first = piece[0]
+            if first.isascii() and first.isalpha():
+                tokens += (len(piece) + 5) // 6
+            elif first == " " or first == "\t":
+                tokens += 0 if len(piece) == 1 else 1
+            elif first.isalpha() and len(piece) > 1:
+                tokens += (len(piece) + 2) // 3
+            else:
+                tokens += 1
+        return tokens
+
+    @staticmethod
+    def _memo_key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    @classmethod
+    def _count_uncached(cls, texts: List[str]) -> List[int]:
+        processor = cls._get_processor()
+        if processor is not None:
+            return [len(ids) for ids in processor.encode(texts)]
+        return [cls._estimate(text) for text in texts]
+
+    @classmethod
+    def count_many(cls, texts: List[str], memoize: bool = True) -> List[int]:
+        """Count tokens for several texts in one batch, encoding only the ones not seen before"""
+        counts: List[Optional[int]] = [None] * len(texts)
+        misses = []
+
+        for index, text in enumerate(texts):
+            if memoize:
+                counts[index] = cls._memo.get(cls._memo_key(text))
+            if counts[index] is None:
+                misses.append(index)
+
+        if misses:
+            for index, count in zip(misses, cls._count_uncached([texts[index] for index in misses])):
+                counts[index] = count
+                if memoize:
+                    cls._memo.set(cls._memo_key(texts[index]), count)
+
+        return counts
+
+    @classmethod
+    def count(cls, text: str, memoize: bool = True) -> int:
+        return cls.count_many([text], memoize=memoize)[0]
+
+    @classmethod
+    def count_prompt(cls, message: str, history: List) -> int:
+        """Tokens of a new message sent along with its history, including per-turn overhead"""
+        counts = cls.count_many([entry.content for entry in history] + [message])
+        return sum(counts) + settings.TOKENIZER_TOKENS_PER_TURN * len(counts)
@@ -0,0 +1,208 @@
+"""
+Redis -> SQL reconciliation of token usage.
+
+Redis holds the authoritative token usage of token-plan sessions; chat_sessions.token_count
+follows it in batches instead of being written on every request.
+
+    python -m app.usage --sweep              copy all usage counters into chat_sessions now
+    python -m app.usage --rebuild [--force]  recreate token buckets from chat_sessions, e.g. after a Redis flush
+"""
+import asyncio
+import logging
+import argparse
+import threading
+from typing import Dict, List, Tuple
+
+from sqlalchemy import select
+
+from app.core import settings, async_redis_client, run_pipeline_async, RedisCircuit, REDIS_UNAVAILABLE_ERRORS
+from app.data import ChatSession, AsyncSessionLocal
+from app.redis import RedisTokenBucket
+from app.persistence import WriteBehind
+
+logger = logging.getLogger(__name__)
+
+USAGE_KEY_PREFIX = "token_usage:{"
+
+class UsageReconciler:
+    """
+    Request handlers only mark a session whose usage changed. Every USAGE_FLUSH_INTERVAL the
+    marked sessions' counters are read from Redis and written to chat_sessions in batches, and
+    every USAGE_SWEEP_INTERVAL all counters are, which picks up marks lost with a restarted
+    process. Values are absolute and applied with max(), so workers flushing the same session
+    concurrently or twice do no harm.
+    """
+
+    _dirty: Dict[str, int] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def mark(cls, session: ChatSession):
+        with cls._lock:
+            cls._dirty[session.session_token] = session.id
+
+    @classmethod
+    def _take(cls) -> Dict[str, int]:
+        with cls._lock:
+            dirty, cls._dirty = cls._dirty, {}
+            return dirty
+
+    @classmethod
+    def _restore(cls, dirty: Dict[str, int]):
+        with cls._lock:
+            for session_token, session_id in dirty.items():
+                cls._dirty.setdefault(session_token, session_id)
+
+    @staticmethod
+    def _batches(items: list) -> List[list]:
+        size = settings.USAGE_FLUSH_BATCH_SIZE
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    @staticmethod
+    async def _read_usage(sessions: List[Tuple[str, int]]) -> Dict[int, int]:
+        def queue(pipe):
+            for session_token, _ in sessions:
+                pipe.get(RedisTokenBucket._get_token_usage_key(session_token))
+
+        values = await run_pipeline_async(queue, transaction=False)
+        return {
+            session_id: int(value)
+            for (_, session_id), value in zip(sessions, values)
+            if value is not None
+        }
+
+    @staticmethod
+    async def _apply(usage: Dict[int, int]):
+        if not usage:
+            return
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                WriteBehind._counter_update("token_count"),
+                [{"session_id": session_id, "floor": value, "refunds": 0} for session_id, value in usage.items()]
+            )
+            await db.commit()
+
+    @classmethod
+    async def flush(cls) -> int:
+        """Write the usage of marked sessions to chat_sessions; returns the number of sessions written"""
+        dirty = cls._take()
+        pending = list(dirty.items())
+        written = 0
+
+        try:
+            while pending:
+                batch = pending[:settings.USAGE_FLUSH_BATCH_SIZE]
+                usage = await cls._read_usage(batch)
+                await cls._apply(usage)
+                pending = pending[len(batch):]
+                written += len(usage)
+        except Exception:
+            cls._restore(dict(pending))
+            raise
+
+        return written
+
+    @staticmethod
+    async def _session_ids(session_tokens: List[str]) -> List[Tuple[str, int]]:
+        async with AsyncSessionLocal() as db:
+            rows = await db.execute(
+                select(ChatSession.session_token, ChatSession.id).where(
+                    ChatSession.session_token.in_(session_tokens)
+                )
+            )
+            return [(session_token, session_id) for session_token, session_id in rows]
+
+    @classmethod
+    async def sweep(cls) -> int:
+        """Write every usage counter in Redis to chat_sessions"""
+        written = 0
+        batch = []
+
+        async def apply(session_tokens):
+            sessions = await cls._session_ids(session_tokens)
+            usage = await cls._read_usage(sessions)
+            await cls._apply(usage)
+            return len(usage)
+
+        async for key in async_redis_client.scan_iter(match=f"{USAGE_KEY_PREFIX}*", count=settings.USAGE_FLUSH_BATCH_SIZE):
+            batch.append(key[len(USAGE_KEY_PREFIX):-1])
+            if len(batch) >= settings.USAGE_FLUSH_BATCH_SIZE:
+                written += await apply(batch)
+                batch = []
+        if batch:
+            written += await apply(batch)
+
+        logger.info(f"Usage sweep wrote {written} sessions")
+        return written
+
+    @classmethod
+    async def rebuild_buckets(cls, force: bool = False) -> int:
+        """
+        Recreate the token buckets of active token-plan sessions from chat_sessions.
+        Existing usage counters are kept unless force is set, as they are ahead of SQL.
+        """
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(ChatSession.session_token, ChatSession.total_token_limit, ChatSession.token_count).where(
+                    ChatSession.plan_type == "token",
+                    ChatSession.is_active == True
+                )
+            )).all()
+
+        for batch in cls._batches(rows):
+            def queue(pipe):
+                for session_token, total_token_limit, token_count in batch:
+                    if force:
+                        pipe.delete(RedisTokenBucket._get_token_usage_key(session_token))
+                    RedisTokenBucket._queue_initialize(pipe, session_token, total_token_limit, token_count or 0)
+
+            await run_pipeline_async(queue, transaction=False)
+
+        logger.info(f"Rebuilt {len(rows)} token buckets from chat_sessions")
+        return len(rows)
+
+    @classmethod
+    async def run(cls, stop_event: asyncio.Event):
+        """Flush every USAGE_FLUSH_INTERVAL and sweep every USAGE_SWEEP_INTERVAL until stop_event is set, then flush once more"""
+        loop = asyncio.get_running_loop()
+        last_sweep = loop.time()
+
+        while True:
+            stopping = stop_event.is_set()
+            if not RedisCircuit.is_open():
+                try:
+                    if loop.time() - last_sweep > settings.USAGE_SWEEP_INTERVAL:
+                        last_sweep = loop.time()
+                        await cls.sweep()
+                    await cls.flush()
+                except asyncio.CancelledError:
+                    raise
+                except REDIS_UNAVAILABLE_ERRORS:
+                    RedisCircuit.record_failure()
+                except Exception as e:
+                    logger.error(f"Usage reconciler error: {str(e)}")
+            if stopping:
+                return
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=settings.USAGE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Reconcile token usage between Redis and chat_sessions")
+    parser.add_argument("--sweep", action="store_true", help="copy all usage counters from Redis into chat_sessions")
+    parser.add_argument("--rebuild", action="store_true", help="recreate token buckets in Redis from chat_sessions")
+    parser.add_argument("--force", action="store_true", help="with --rebuild, also overwrite existing usage counters")
+    args = parser.parse_args(argv)
+
+    async def run():
+        if args.rebuild:
+            await UsageReconciler.rebuild_buckets(force=args.force)
+        if args.sweep or not args.rebuild:
+            await UsageReconciler.sweep()
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
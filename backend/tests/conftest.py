@@ -0,0 +1,62 @@
+"""
+Test setup: every Redis client the app creates talks to an in-memory fakeredis server,
+the database is a migrated SQLite file in a temporary directory, and the model is the
+offline stub provider. Both are emptied before each test.
+"""
+import os
+import tempfile
+
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='tests-'), 'app.db')}"
+os.environ["LLM_PROVIDER"] = "stub"
+os.environ["STUB_LATENCY_MS"] = "1"
+os.environ["STUB_LATENCY_DISTRIBUTION"] = "fixed"
+os.environ["STUB_OUTPUT_TOKENS"] = "64"
+os.environ["STUB_ERROR_RATE"] = "0"
+
+from tests.memory_redis import use_memory_redis
+
+redis_server = use_memory_redis()
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import delete
+
+from app.migrations import upgrade
+
+upgrade()
+
+from app.main import app
+from app.core import settings, redis_client
+from app.data import Base, SessionLocal
+from app.cache import SessionCache, ResponseCache
+from app.quota import Quota
+
+API = settings.API_V1_STR
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    redis_client.flushall()
+    with SessionLocal() as db:
+        for table in reversed(Base.metadata.sorted_tables):
+            db.execute(delete(table))
+        db.commit()
+    for cache in (SessionCache._local, ResponseCache._local, Quota._limits):
+        cache.clear()
+    yield
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture
+def client():
+    return TestClient(app)
+
+@pytest.fixture
+def create_session(client):
+    """Create sessions through the API; returns the headers authenticating as the new session"""
+    def create(**fields) -> dict:
+        response = client.post(f"{API}/sessions/create", json={"plan_type": "request", **fields})
+        assert response.status_code == 200, response.text
+        return {"X-Session-Token": response.json()["session_token"]}
+    return create
@@ -0,0 +1,20 @@
+"""
+In-memory Redis for the test suite, also used by the benchmark's --redis memory mode.
+Must be called before app.core is imported, as the clients are created at import time.
+"""
+import functools
+
+import redis
+import redis.asyncio
+import fakeredis
+
+def use_memory_redis() -> fakeredis.FakeServer:
+    """Point every Redis client the app creates at one shared in-memory server, and return it"""
+    server = fakeredis.FakeServer()
+    redis.BlockingConnectionPool = functools.partial(
+        redis.BlockingConnectionPool, connection_class=fakeredis.FakeRedisConnection, server=server
+    )
+    redis.asyncio.BlockingConnectionPool = functools.partial(
+        redis.asyncio.BlockingConnectionPool, connection_class=fakeredis.FakeAsyncRedisConnection, server=server
+    )
+    return server
@@ -0,0 +1,110 @@
+import time
+
+import pytest
+from redis.exceptions import ConnectionError
+
+from app.cache import SessionCache
+from app.core import settings, redis_client, RedisCircuit
+from app.fallback import LocalLimiter
+from app.redis import RedisTokenBucket
+from app.usage import UsageReconciler
+
+API = settings.API_V1_STR
+
+@pytest.fixture
+def outage(monkeypatch):
+    """Opens the Redis circuit when called, so every Redis call goes to its local fallback until it is closed again"""
+    monkeypatch.setattr(settings, "REDIS_CIRCUIT_RESET", 3600.0)
+
+    def start():
+        RedisCircuit._opened_at = time.monotonic()
+        SessionCache._local.clear()
+
+    yield start
+    RedisCircuit.record_success()
+    LocalLimiter._sessions.clear()
+    LocalLimiter._deferred_settles.clear()
+    LocalLimiter._deferred_buckets.clear()
+    LocalLimiter._stale_keys.clear()
+    LocalLimiter._replay_usage.clear()
+
+def send(client, headers):
+    response = client.post(f"{API}/chat/message", json={"message": "hello"}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def usage(session_token: str) -> int:
+    return int(redis_client.get(RedisTokenBucket._get_token_usage_key(session_token)) or 0)
+
+def start_session(client, create_session):
+    headers = create_session(plan_type="token", total_token_limit=100000)
+    send(client, headers)
+    return headers, headers["X-Session-Token"]
+
+@pytest.mark.anyio
+async def test_outage_usage_is_added_to_surviving_counter(client, create_session, outage):
+    headers, session_token = start_session(client, create_session)
+    before = usage(session_token)
+    await UsageReconciler.flush()
+
+    outage()
+    during = send(client, headers)["token_usage"]
+
+    RedisCircuit.record_success()
+    await LocalLimiter.reconcile_async()
+    assert usage(session_token) == before + during
+
+@pytest.mark.anyio
+async def test_counter_lost_during_outage_is_seeded_before_replay(client, create_session, outage):
+    headers, session_token = start_session(client, create_session)
+    before = usage(session_token)
+    await UsageReconciler.flush()
+
+    outage()
+    during = send(client, headers)["token_usage"]
+    redis_client.flushall()
+
+    RedisCircuit.record_success()
+    await LocalLimiter.reconcile_async()
+    assert usage(session_token) == before + during
+    assert not LocalLimiter.has_pending()
+
+@pytest.mark.anyio
+async def test_usage_of_evicted_session_is_replayed(client, create_session, outage, monkeypatch):
+    monkeypatch.setattr(settings, "FALLBACK_MAX_SESSIONS", 1)
+    headers, session_token = start_session(client, create_session)
+    other, _ = start_session(client, create_session)
+    before = usage(session_token)
+    await UsageReconciler.flush()
+
+    outage()
+    during = send(client, headers)["token_usage"]
+    send(client, other)
+    assert session_token not in LocalLimiter._sessions
+
+    RedisCircuit.record_success()
+    await LocalLimiter.reconcile_async()
+    assert usage(session_token) == before + during
+    assert not LocalLimiter.has_pending()
+
+@pytest.mark.anyio
+async def test_usage_survives_a_failed_reconcile(client, create_session, outage, monkeypatch):
+    headers, session_token = start_session(client, create_session)
+    before = usage(session_token)
+    await UsageReconciler.flush()
+
+    outage()
+    during = send(client, headers)["token_usage"]
+
+    replay_usage = RedisTokenBucket.replay_usage_async
+    async def unreachable(*args):
+        raise ConnectionError("Redis went away again")
+    monkeypatch.setattr(RedisTokenBucket, "replay_usage_async", unreachable)
+    RedisCircuit.record_success()
+    with pytest.raises(ConnectionError):
+        await LocalLimiter.reconcile_async()
+    assert session_token not in LocalLimiter._sessions
+
+    monkeypatch.setattr(RedisTokenBucket, "replay_usage_async", replay_usage)
+    await LocalLimiter.reconcile_async()
+    assert usage(session_token) == before + during
@@ -0,0 +1,37 @@
+from app.core import settings
+
+API = settings.API_V1_STR
+
+def test_history_pages_by_cursor(client, create_session):
+    headers = create_session()
+    for text in ("one", "two", "three"):
+        client.post(f"{API}/chat/message", json={"message": text}, headers=headers)
+
+    latest = client.get(f"{API}/chat/history", params={"limit": 4}, headers=headers)
+    assert [message["content"] for message in latest.json()][::2] == ["two", "three"]
+
+    older = client.get(f"{API}/chat/history", params={"before": latest.headers["X-Cursor-Before"]}, headers=headers)
+    assert [message["content"] for message in older.json()][::2] == ["one"]
+    assert "X-Cursor-Before" not in older.headers
+
+    newer = client.get(f"{API}/chat/history", params={"after": latest.headers["X-Cursor-After"]}, headers=headers)
+    assert newer.json() == []
+
+def test_history_conditional_get(client, create_session):
+    headers = create_session()
+    client.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers)
+
+    first = client.get(f"{API}/chat/history", headers=headers)
+    etag = first.headers["ETag"]
+    assert first.headers["Last-Modified"]
+
+    unchanged = client.get(f"{API}/chat/history", headers={**headers, "If-None-Match": etag})
+    assert unchanged.status_code == 304
+    assert unchanged.headers["ETag"] == etag
+    assert unchanged.content == b""
+
+    client.post(f"{API}/chat/message", json={"message": "again"}, headers=headers)
+    changed = client.get(f"{API}/chat/history", headers={**headers, "If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert len(changed.json()) == 4
@@ -0,0 +1,48 @@
+import json
+import hashlib
+
+from app.core import settings, redis_client
+from app.idempotency import Idempotency
+
+API = settings.API_V1_STR
+
+BODY = json.dumps({"message": "hi"}).encode()
+
+def post(client, headers: dict, key: str, body: bytes = BODY):
+    return client.post(
+        f"{API}/chat/message",
+        content=body,
+        headers={**headers, "Idempotency-Key": key, "Content-Type": "application/json"}
+    )
+
+def test_retry_is_replayed_without_counting(client, create_session):
+    headers = create_session(rate_limit_rpm=5)
+
+    first = post(client, headers, "retry-1")
+    assert first.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+
+    replay = post(client, headers, "retry-1")
+    assert replay.status_code == 200
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert replay.json() == first.json()
+
+    assert client.get(f"{API}/sessions/status", headers=headers).json()["request_count"] == 1
+
+def test_key_reused_for_another_body_is_rejected(client, create_session):
+    headers = create_session()
+
+    assert post(client, headers, "retry-1").status_code == 200
+    response = post(client, headers, "retry-1", json.dumps({"message": "something else"}).encode())
+    assert response.status_code == 400
+
+def test_key_of_request_still_running_gets_409(client, create_session, monkeypatch):
+    monkeypatch.setattr(settings, "IDEMPOTENCY_WAIT_TIMEOUT", 0.05)
+    headers = create_session()
+    pending = {"state": "pending", "owner": "other-worker", "fingerprint": hashlib.sha256(BODY).hexdigest()}
+    redis_client.set(Idempotency._get_key(headers["X-Session-Token"], "retry-1"), json.dumps(pending))
+
+    response = post(client, headers, "retry-1")
+    assert response.status_code == 409
+    assert response.headers["Retry-After"] == "1"
+    assert client.get(f"{API}/sessions/status", headers=headers).json()["request_count"] == 0
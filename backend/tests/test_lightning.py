@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from app import lightning
+from app.core import settings, redis_client
+from app.lightning import LightningError, LightningSettlement, MockLnd
+
+API = settings.API_V1_STR
+
+class FlakyNode(MockLnd):
+    """Mock node whose first subscription fails before delivering anything"""
+
+    def __init__(self):
+        super().__init__()
+        self.subscribed_from = []
+
+    async def subscribe(self, settle_index: int):
+        self.subscribed_from.append(settle_index)
+        if len(self.subscribed_from) == 1:
+            raise LightningError("connection reset")
+        async for event in super().subscribe(settle_index):
+            yield event
+
+@pytest.fixture
+def node(monkeypatch):
+    monkeypatch.setattr(settings, "LIGHTNING", True)
+    monkeypatch.setattr(settings, "LIGHTNING_BACKEND", "mock")
+    monkeypatch.setattr(lightning, "_backend", FlakyNode())
+    return lightning.get_backend()
+
+@pytest.fixture
+def buy(client, node):
+    """Create an invoice through the API; returns its response body"""
+    def create(quantity: int, headers: dict = None) -> dict:
+        response = client.post(f"{API}/payments/invoices", json={"plan_type": "request", "quantity": quantity}, headers=headers or {})
+        assert response.status_code == 200, response.text
+        return response.json()
+    return create
+
+def session_status(client, session_token: str) -> dict:
+    return client.get(f"{API}/sessions/status", headers={"X-Session-Token": session_token}).json()
+
+def test_mock_settle_creates_session_without_subscriber(client, buy):
+    invoice = buy(5)
+    assert invoice["state"] == "open"
+    assert client.get(f"{API}/sessions/status", headers={"X-Session-Token": invoice["session_token"]}).status_code == 404
+
+    response = client.post(f"{API}/payments/mock/settle/{invoice['payment_hash']}")
+    assert response.status_code == 200
+    assert response.json()["state"] == "settled"
+    assert session_status(client, invoice["session_token"])["total_requests_limit"] == 5
+
+    assert client.post(f"{API}/payments/mock/settle/{invoice['payment_hash']}").status_code == 404
+
+@pytest.mark.anyio
+async def test_replayed_settlement_is_applied_once(client, buy, node):
+    first = buy(5)
+    client.post(f"{API}/payments/mock/settle/{first['payment_hash']}")
+    more = buy(3, headers={"X-Session-Token": first["session_token"]})
+    client.post(f"{API}/payments/mock/settle/{more['payment_hash']}")
+    assert session_status(client, first["session_token"])["total_requests_limit"] == 8
+
+    # Replay the subscription from the start, once past the Redis cache and once through it
+    redis_client.delete(*(LightningSettlement._settled_key(event["payment_hash"]) for event in node.settled))
+    for event in node.settled * 2:
+        await LightningSettlement.apply(event)
+
+    assert session_status(client, first["session_token"])["total_requests_limit"] == 8
+
+@pytest.mark.anyio
+async def test_expired_invoice_is_canceled_and_not_credited(client, buy, node):
+    invoice = buy(5)
+
+    await LightningSettlement.apply(node.cancel(invoice["payment_hash"]))
+    assert client.get(f"{API}/payments/invoices/{invoice['payment_hash']}").json()["state"] == "canceled"
+    assert client.post(f"{API}/payments/mock/settle/{invoice['payment_hash']}").status_code == 404
+
+    # A late settle event for it changes nothing either
+    event = {"payment_hash": invoice["payment_hash"], "state": "SETTLED", "amount_paid_sats": invoice["amount_sats"], "settle_index": 1}
+    await LightningSettlement.apply(event)
+    assert client.get(f"{API}/payments/invoices/{invoice['payment_hash']}").json()["state"] == "canceled"
+    assert client.get(f"{API}/sessions/status", headers={"X-Session-Token": invoice["session_token"]}).status_code == 404
+
+@pytest.mark.anyio
+async def test_subscriber_reconnects_and_resumes(client, buy, node):
+    first, second = buy(5), buy(7)
+    client.post(f"{API}/payments/mock/settle/{first['payment_hash']}")
+
+    stop = asyncio.Event()
+    subscriber = asyncio.create_task(LightningSettlement.run(stop))
+    try:
+        node.settle(second["payment_hash"])
+        await LightningSettlement.wait(second["payment_hash"], 5)
+        assert await LightningSettlement.is_settled(second["payment_hash"])
+    finally:
+        stop.set()
+        await subscriber
+
+    assert node.subscribed_from == [1, 1]
+    assert session_status(client, first["session_token"])["total_requests_limit"] == 5
+    assert session_status(client, second["session_token"])["total_requests_limit"] == 7
@@ -0,0 +1,30 @@
+import re
+
+from app.core import settings
+
+API = settings.API_V1_STR
+
+def sample(body: str, name: str) -> float:
+    match = re.search(rf"^{re.escape(name)} (\S+)$", body, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+def test_metrics_count_stages_and_rejections(client, create_session):
+    before = client.get("/metrics").text
+    headers = create_session(rate_limit_rpm=1)
+
+    client.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers)
+    assert client.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers).status_code == 429
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+
+    assert "# TYPE lightning_stage_duration_seconds histogram" in body
+    for name, delta in (
+        ('lightning_stage_duration_seconds_count{stage="model_call"}', 1),
+        ('lightning_stage_duration_seconds_count{stage="rate_limit"}', 2),
+        ('lightning_rate_limited_total{reason="requests_per_minute"}', 1),
+    ):
+        assert sample(body, name) - sample(before, name) == delta
+    assert sample(body, 'lightning_stage_duration_seconds_bucket{stage="model_call",le="+Inf"}') == sample(body, 'lightning_stage_duration_seconds_count{stage="model_call"}')
@@ -0,0 +1,84 @@
+import pytest
+import redis
+import redis.asyncio
+from redis.crc import key_slot
+from redis.exceptions import ResponseError
+
+from app.core import settings, redis_client
+from app.quota import Quota
+from app.redis import RedisTokenBucket
+
+API = settings.API_V1_STR
+
+def _keys(args) -> list:
+    name = str(args[0]).upper()
+    if name in ("EVAL", "EVALSHA"):
+        return list(args[3:3 + int(args[2])])
+    if name in ("DEL", "UNLINK", "EXISTS", "MGET"):
+        return list(args[1:])
+    return list(args[1:2])
+
+def _check_slot(commands):
+    slots = {key_slot(str(key).encode()) for args in commands for key in _keys(args)}
+    if len(slots) > 1:
+        raise ResponseError("CROSSSLOT Keys in request don't hash to the same slot")
+
+@pytest.fixture
+def cluster(monkeypatch):
+    """Run as on Redis Cluster: REDIS_CLUSTER set, and scripts or transactions spanning slots are refused"""
+    monkeypatch.setattr(settings, "REDIS_CLUSTER", True)
+
+    def guard_command(execute):
+        def execute_command(self, *args, **options):
+            _check_slot([args])
+            return execute(self, *args, **options)
+        return execute_command
+
+    def guard_transaction(execute):
+        def wrapper(self, *args, **kwargs):
+            if self.transaction:
+                _check_slot([command for command, _ in self.command_stack])
+            return execute(self, *args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(redis.Redis, "execute_command", guard_command(redis.Redis.execute_command))
+    monkeypatch.setattr(redis.asyncio.Redis, "execute_command", guard_command(redis.asyncio.Redis.execute_command))
+    monkeypatch.setattr(redis.client.Pipeline, "execute", guard_transaction(redis.client.Pipeline.execute))
+    monkeypatch.setattr(redis.asyncio.client.Pipeline, "execute", guard_transaction(redis.asyncio.client.Pipeline.execute))
+
+def test_cross_slot_script_is_refused(cluster):
+    with pytest.raises(ResponseError, match="CROSSSLOT"):
+        redis_client.eval("return 1", 2, "a:{one}", "b:{two}")
+
+@pytest.mark.parametrize("path", ["/chat/message", "/chat/stream"])
+def test_cluster_limits_hold_at_every_level(client, create_session, cluster, path):
+    user_id = client.post(f"{API}/quotas/users", json={"email": "a@example.com", "rate_limit_rpm": 3}).json()["id"]
+    first = create_session(user_id=user_id, rate_limit_rpm=2)
+    second = create_session(user_id=user_id, rate_limit_rpm=5)
+
+    for _ in range(2):
+        assert client.post(f"{API}{path}", json={"message": "hi"}, headers=first).status_code == 200
+    response = client.post(f"{API}{path}", json={"message": "hi"}, headers=first)
+    assert response.status_code == 429
+    assert response.json()["detail"] == "Rate limit exceeded: 2 requests per minute"
+
+    assert client.post(f"{API}{path}", json={"message": "hi"}, headers=second).status_code == 200
+    response = client.post(f"{API}{path}", json={"message": "hi"}, headers=second)
+    assert response.status_code == 429
+    assert response.json()["detail"] == "Account rate limit exceeded: 3 requests per minute"
+
+    usage = client.get(f"{API}/quotas/users/{user_id}").json()
+    assert usage["request_count"] == 3
+    assert usage["minute_requests"] == 3
+
+def test_cluster_tokens_are_charged_once(client, cluster, monkeypatch):
+    monkeypatch.setattr(settings, "GLOBAL_TOKEN_LIMIT_TPM", 1000000)
+    token = client.post(f"{API}/sessions/create", json={"plan_type": "token", "total_token_limit": 10000}).json()["session_token"]
+    headers = {"X-Session-Token": token}
+
+    for _ in range(2):
+        assert client.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers).status_code == 200
+
+    used = int(redis_client.get(RedisTokenBucket._get_token_usage_key(token)))
+    assert used > 0
+    assert int(redis_client.get(Quota._token_key(None))) == used
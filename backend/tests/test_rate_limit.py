@@ -0,0 +1,34 @@
+from app.core import settings
+
+API = settings.API_V1_STR
+
+def test_request_plan_over_rpm_gets_429_with_retry_after(client, create_session):
+    headers = create_session(rate_limit_rpm=2)
+
+    for remaining in ("1", "0"):
+        response = client.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers)
+        assert response.status_code == 200
+        assert response.headers["X-RateLimit-Limit"] == "2"
+        assert response.headers["X-RateLimit-Remaining"] == remaining
+
+    response = client.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers)
+    assert response.status_code == 429
+    assert 0 < int(response.headers["Retry-After"]) <= 60
+
+def test_request_plan_total_limit(client, create_session):
+    headers = create_session(total_requests_limit=1)
+
+    assert client.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers).status_code == 200
+    response = client.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers)
+    assert response.status_code == 429
+
+    status = client.get(f"{API}/sessions/status", headers=headers).json()
+    assert status["request_count"] == 1
+
+def test_rate_limit_is_per_session(client, create_session):
+    first = create_session(rate_limit_rpm=1)
+    second = create_session(rate_limit_rpm=1)
+
+    assert client.post(f"{API}/chat/message", json={"message": "hi"}, headers=first).status_code == 200
+    assert client.post(f"{API}/chat/message", json={"message": "hi"}, headers=first).status_code == 429
+    assert client.post(f"{API}/chat/message", json={"message": "hi"}, headers=second).status_code == 200
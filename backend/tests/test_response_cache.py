@@ -0,0 +1,84 @@
+import time
+
+import pytest
+from sqlalchemy import select
+
+from app.api import serve_cached_response, TokenLimiter
+from app.cache import ResponseCache
+from app.core import settings
+from app.data import ChatRequest, ChatSession, SessionLocal
+
+API = settings.API_V1_STR
+
+@pytest.fixture
+def response_cache(monkeypatch):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE", True)
+
+def test_key_keeps_inner_whitespace():
+    key = lambda message: ResponseCache.make_key("model", {}, [], message)
+
+    assert key("print('a  b')") != key("print('a b')")
+    assert key("line\n\nbreak") != key("line break")
+    assert key("  hello \n") == key("hello")
+
+def send(client, headers, message="what is 2+2?"):
+    response = client.post(f"{API}/chat/message", json={"message": message, "history": []}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def request_count(client, headers) -> int:
+    return client.get(f"{API}/sessions/status", headers=headers).json()["request_count"]
+
+def test_hit_is_served_from_cache(client, create_session, response_cache):
+    headers = create_session()
+
+    assert send(client, headers)["cached"] is False
+    assert send(client, headers)["cached"] is True
+    assert send(client, headers, "what is  2+2?")["cached"] is False
+
+def test_request_plan_hit_is_billed_by_default(client, create_session, response_cache):
+    headers = create_session(total_requests_limit=10)
+
+    send(client, headers)
+    hit = send(client, headers)
+    assert hit["cached"] is True
+    assert hit["requests_remaining"] == 8
+    assert request_count(client, headers) == 2
+
+def test_request_plan_hit_can_be_free(client, create_session, response_cache, monkeypatch):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_REQUEST_BILLING", "none")
+    headers = create_session(total_requests_limit=10)
+
+    send(client, headers)
+    hit = send(client, headers)
+    assert hit["cached"] is True
+    assert hit["requests_remaining"] == 9
+    assert request_count(client, headers) == 1
+
+def test_sync_path_refunds_request_plan_hit(client, create_session, monkeypatch):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_REQUEST_BILLING", "none")
+    headers = create_session(total_requests_limit=10)
+    send(client, headers)
+
+    entry = {"content": "4", "input_tokens": 3, "output_tokens": 1, "total_tokens": 4}
+    with SessionLocal() as db:
+        session = db.execute(select(ChatSession)).scalar_one()
+        response = serve_cached_response(db, session, ChatRequest(message="what is 2+2?"), entry, TokenLimiter(db), time.time())
+
+    assert response["cached"] is True
+    assert response["requests_remaining"] == 10
+    assert request_count(client, headers) == 0
+
+def test_free_hit_gives_back_rate_limit_windows(client, create_session, response_cache, monkeypatch):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_REQUEST_BILLING", "none")
+    user_id = client.post(f"{API}/quotas/users", json={"rate_limit_rpm": 2}).json()["id"]
+    headers = create_session(user_id=user_id, rate_limit_rpm=2)
+
+    send(client, headers)
+    for _ in range(3):
+        assert send(client, headers)["cached"] is True
+    assert client.get(f"{API}/quotas/users/{user_id}").json()["minute_requests"] == 1
+
+    send(client, headers, "a second question")
+    response = client.post(f"{API}/chat/message", json={"message": "a third question"}, headers=headers)
+    assert response.status_code == 429
@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy import func, select
+
+from app.core import settings
+from app.data import ChatMessage, SessionLocal
+from app.retention import ArchiveStore, Retention
+
+API = settings.API_V1_STR
+
+@pytest.fixture
+def retention(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "RETENTION", True)
+    monkeypatch.setattr(settings, "RETENTION_ARCHIVE_AFTER", 0)
+    monkeypatch.setattr(Retention, "store", ArchiveStore(str(tmp_path), 1024))
+
+def message_count() -> int:
+    with SessionLocal() as db:
+        return db.execute(select(func.count(ChatMessage.id))).scalar()
+
+def test_archived_history_round_trips(client, create_session, retention):
+    headers = create_session()
+    for text in ("first", "second", "third"):
+        assert client.post(f"{API}/chat/message", json={"message": text}, headers=headers).status_code == 200
+    history = client.get(f"{API}/chat/history", headers=headers).json()
+    assert client.get(f"{API}/chat/archive", headers=headers).status_code == 404
+
+    client.post(f"{API}/sessions/terminate", headers=headers)
+    stats = Retention.run_once()
+    assert stats["sessions_archived"] == 1
+    assert stats["messages_archived"] == len(history) == 6
+    assert message_count() == 0
+
+    archived = client.get(f"{API}/chat/archive", headers=headers).json()
+    assert archived == history
+
+    page = client.get(f"{API}/chat/archive", params={"limit": 2}, headers=headers)
+    assert page.json() == history[-2:]
+    older = client.get(f"{API}/chat/archive", params={"limit": 4, "before": page.headers["X-Cursor-Before"]}, headers=headers)
+    assert older.json() == history[:4]
+
+def test_active_sessions_are_not_archived(client, create_session, retention):
+    headers = create_session()
+    client.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers)
+
+    assert Retention.run_once()["sessions_archived"] == 0
+    assert message_count() == 2
@@ -0,0 +1,130 @@
+import json
+import asyncio
+
+import pytest
+from sqlalchemy import select
+
+from app.admission import AdmissionControl
+from app.api import stream_finishers
+from app.core import settings, redis_client
+from app.data import ChatMessage, SessionLocal
+from app.main import app
+from app.redis import RedisTokenBucket
+
+API = settings.API_V1_STR
+
+def parse_events(body: str):
+    events = []
+    for block in body.strip().split("\n\n"):
+        event, data = "message", None
+        for line in block.splitlines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+        events.append((event, data))
+    return events
+
+def test_stream_sends_chunks_and_done(client, create_session):
+    headers = create_session(plan_type="token", total_token_limit=10000)
+
+    response = client.post(f"{API}/chat/stream", json={"message": "hello"}, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+
+    events = parse_events(response.text)
+    chunks = [data["content"] for event, data in events if event == "message"]
+    event, done = events[-1]
+    assert chunks and event == "done"
+    assert done["finish_reason"] == "stop"
+    assert 0 < done["token_usage"] == 10000 - done["tokens_remaining"]
+
+    history = client.get(f"{API}/chat/history", headers=headers).json()
+    assert [message["role"] for message in history] == ["user", "assistant"]
+    assert history[1]["content"] == "".join(chunks)
+
+def test_stream_stops_at_total_token_limit(client, create_session, monkeypatch):
+    monkeypatch.setattr(settings, "STUB_OUTPUT_TOKENS", 2048)
+    headers = create_session(plan_type="token", total_token_limit=300)
+
+    events = parse_events(client.post(f"{API}/chat/stream", json={"message": "hello"}, headers=headers).text)
+    event, done = events[-1]
+    assert event == "done"
+    assert done["token_usage"] + done["tokens_remaining"] == 300
+
+    events = parse_events(client.post(f"{API}/chat/stream", json={"message": "hello"}, headers=headers).text)
+    event, done = events[-1]
+    assert event == "done"
+    assert done["finish_reason"] == "limit"
+    assert [event for event, _ in events] == ["done"]
+
+    response = client.post(f"{API}/chat/stream", json={"message": "hello " * 50}, headers=headers)
+    assert response.status_code == 429
+
+async def stream_until_first_chunk(headers: dict) -> list:
+    """Drive /chat/stream over raw ASGI and disconnect as soon as the first chunk arrives"""
+    body = json.dumps({"message": "hello"}).encode()
+    first_chunk = asyncio.Event()
+    sent = []
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await first_chunk.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+        if message["type"] == "http.response.body" and message.get("body"):
+            first_chunk.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": f"{API}/chat/stream",
+        "raw_path": f"{API}/chat/stream".encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json")] + [
+            (name.lower().encode(), value.encode()) for name, value in headers.items()
+        ],
+        "client": ("test", 1),
+        "server": ("test", 80),
+    }
+    await app(scope, receive, send)
+    return sent
+
+@pytest.mark.anyio
+async def test_stream_disconnect_still_settles_and_persists(create_session, monkeypatch):
+    monkeypatch.setattr(settings, "STUB_LATENCY_MS", 400.0)
+    monkeypatch.setattr(settings, "STUB_OUTPUT_TOKENS", 128)
+    monkeypatch.setattr(settings, "ADMISSION_CONTROL", True)
+    headers = create_session(plan_type="token", total_token_limit=100000)
+    session_token = headers["X-Session-Token"]
+
+    sent = await stream_until_first_chunk(headers)
+    assert sent[-1]["type"] == "http.response.body"
+    assert not any(b"event: done" in message.get("body", b"") for message in sent)
+
+    for _ in range(100):
+        if not stream_finishers:
+            break
+        await asyncio.sleep(0.05)
+    assert not stream_finishers
+
+    reservations = [
+        redis_client.get(key) for key in redis_client.scan_iter(f"token_reservation:{{{session_token}}}:*")
+    ]
+    assert reservations == ["settled"]
+    usage = int(redis_client.get(RedisTokenBucket._get_token_usage_key(session_token)))
+    assert 0 < usage < 128
+    assert redis_client.zcard(AdmissionControl.HOLDERS_KEY) == 0
+    with SessionLocal() as db:
+        roles = db.execute(select(ChatMessage.role).order_by(ChatMessage.id)).scalars().all()
+    assert roles == ["user", "assistant"]
@@ -0,0 +1,57 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api import send_message, send_message_async
+from app.core import settings
+from app.data import ChatResponse
+
+API = settings.API_V1_STR
+
+@pytest.fixture(params=[send_message, send_message_async], ids=["sync", "async"])
+def chat(request):
+    """A client serving POST /chat/message with the sync or the async handler, regardless of ASYNC_CHAT"""
+    chat_app = FastAPI()
+    chat_app.post(f"{API}/chat/message", response_model=ChatResponse)(request.param)
+    return TestClient(chat_app)
+
+def test_token_plan_is_cut_off_at_its_total(client, create_session, chat):
+    headers = create_session(plan_type="token", total_token_limit=150)
+
+    remaining = []
+    for _ in range(3):
+        response = chat.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers)
+        assert response.status_code == 200
+        remaining.append(response.json()["tokens_remaining"])
+    # The last call only got the tokens that were left for its output
+    assert remaining[0] > remaining[1] > remaining[2] >= 0
+
+    response = chat.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers)
+    assert response.status_code == 429
+    assert response.json()["detail"] == f"Insufficient tokens remaining: {remaining[2]} of 150 left"
+
+    status = client.get(f"{API}/sessions/status", headers=headers).json()
+    assert status["token_count"] == 150 - remaining[2]
+
+def test_request_plan_is_not_charged_tokens(client, create_session, chat):
+    headers = create_session(total_requests_limit=2)
+
+    body = chat.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers).json()
+    assert body["requests_remaining"] == 1
+    assert body["tokens_remaining"] is None and body["token_usage"] is None
+
+    assert chat.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers).json()["requests_remaining"] == 0
+    assert chat.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers).status_code == 429
+    assert client.get(f"{API}/sessions/status", headers=headers).json()["token_count"] == 0
+
+def test_token_config_errors_keep_their_status(client, create_session):
+    token_headers = create_session(plan_type="token", total_token_limit=150)
+    response = client.put(f"{API}/sessions/token-config", json={"total_token_limit": 500}, headers=token_headers)
+    assert response.status_code == 200
+    assert response.json()["total_token_limit"] == 500
+
+    response = client.put(f"{API}/sessions/token-config", json={"total_token_limit": 500}, headers=create_session())
+    assert response.status_code == 400
+
+    response = client.put(f"{API}/sessions/token-config", json={"total_token_limit": 500}, headers={"X-Session-Token": "missing"})
+    assert response.status_code == 404
@@ -0,0 +1,114 @@
+import json
+import asyncio
+
+import pytest
+from sqlalchemy import func, select
+
+from app.core import settings, async_redis_client
+from app.data import ChatMessage, ChatSession, SessionLocal
+from app.persistence import WriteBehind
+
+API = settings.API_V1_STR
+
+def message_count() -> int:
+    with SessionLocal() as db:
+        return db.execute(select(func.count(ChatMessage.id))).scalar()
+
+@pytest.fixture
+def write_behind(monkeypatch):
+    monkeypatch.setattr(settings, "WRITE_BEHIND", True)
+    monkeypatch.setattr(settings, "WRITE_BEHIND_BLOCK_MS", 10)
+
+async def read_entries(consumer: str = "test"):
+    await WriteBehind.ensure_group()
+    response = await async_redis_client.xreadgroup(WriteBehind.GROUP, consumer, {WriteBehind.STREAM_KEY: ">"}, count=100)
+    return response[0][1] if response else []
+
+@pytest.mark.anyio
+async def test_consumer_applies_entries_and_reclaims_abandoned_ones(client, create_session, write_behind, monkeypatch):
+    headers = create_session()
+    assert client.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers).status_code == 200
+    assert message_count() == 0
+
+    abandoned = await read_entries("crashed")
+    assert abandoned
+
+    monkeypatch.setattr(settings, "WRITE_BEHIND_CLAIM_IDLE_MS", 0)
+    stop = asyncio.Event()
+    consumer = asyncio.create_task(WriteBehind.run_consumer(stop, "survivor"))
+    for _ in range(100):
+        if message_count() == 2:
+            break
+        await asyncio.sleep(0.02)
+    stop.set()
+    await consumer
+
+    assert message_count() == 2
+    with SessionLocal() as db:
+        assert db.execute(select(ChatSession.request_count)).scalar() == 1
+    assert await async_redis_client.xlen(WriteBehind.STREAM_KEY) == 0
+    assert await async_redis_client.hlen(WriteBehind._get_pending_key(headers["X-Session-Token"])) == 0
+
+@pytest.mark.anyio
+async def test_history_reads_queued_messages(client, create_session, write_behind):
+    headers = create_session()
+    client.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers)
+
+    history = client.get(f"{API}/chat/history", headers=headers).json()
+    assert [message["role"] for message in history] == ["user", "assistant"]
+
+    entries = await read_entries()
+    assert await WriteBehind.apply_batch(entries) == len(entries)
+    assert message_count() == 2
+
+@pytest.mark.anyio
+async def test_malformed_entry_is_dead_lettered_without_blocking_the_batch(client, create_session, write_behind, monkeypatch):
+    monkeypatch.setattr(settings, "WRITE_BEHIND_MAX_DELIVERIES", 2)
+    headers = create_session()
+    await async_redis_client.xadd(WriteBehind.STREAM_KEY, {"type": "messages", "session_token": "x", "payload": "{not json"})
+    client.post(f"{API}/chat/message", json={"message": "hi"}, headers=headers)
+
+    entries = await read_entries()
+    assert await WriteBehind.apply_batch(entries) == len(entries) - 1
+    assert message_count() == 2
+    assert await async_redis_client.xlen(WriteBehind.DEAD_LETTER_KEY) == 0
+
+    _, reclaimed, _ = await async_redis_client.xautoclaim(WriteBehind.STREAM_KEY, WriteBehind.GROUP, "test", min_idle_time=0)
+    assert len(reclaimed) == 1
+    assert await WriteBehind.apply_batch(reclaimed) == 0
+
+    dead = await async_redis_client.xrange(WriteBehind.DEAD_LETTER_KEY)
+    assert len(dead) == 1
+    assert dead[0][1]["payload"] == "{not json"
+    assert dead[0][1]["deliveries"] == "2"
+    assert await async_redis_client.xlen(WriteBehind.STREAM_KEY) == 0
+    assert await async_redis_client.xpending(WriteBehind.STREAM_KEY, WriteBehind.GROUP) == {
+        "pending": 0, "min": None, "max": None, "consumers": []
+    }
+
+def sql_request_count() -> int:
+    with SessionLocal() as db:
+        return db.execute(select(ChatSession.request_count)).scalar()
+
+@pytest.fixture
+def free_cache_hits(monkeypatch):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE", True)
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_REQUEST_BILLING", "none")
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("batched", [True, False], ids=["one_batch", "entry_by_entry"])
+async def test_refunded_request_reaches_sql(client, create_session, write_behind, free_cache_hits, batched):
+    headers = create_session(total_requests_limit=10)
+    # Two misses and two unbilled hits
+    for message in ("what is 2+2?", "what is 2+2?", "and 3+3?", "and 3+3?"):
+        client.post(f"{API}/chat/message", json={"message": message, "history": []}, headers=headers)
+    assert client.get(f"{API}/sessions/status", headers=headers).json()["request_count"] == 2
+
+    entries = await read_entries()
+    for batch in [entries] if batched else [[entry] for entry in entries]:
+        await WriteBehind.apply_batch(batch)
+    assert sql_request_count() == 2
+
+    # A redelivered batch must not refund twice
+    await WriteBehind.apply_batch(entries)
+    assert sql_request_count() == 2